@@ -1,13 +1,14 @@
 import streamlit as st
 import pandas as pd
 from pathlib import Path
+from utils.data_loader import load_horse_index, get_recent_races
 
 # データの読み込み
 syutubahyo_path = Path("data/syutubahyo.csv")
 race_data_path = Path("data/race_data.csv")
 
 syutubahyo_df = pd.read_csv(syutubahyo_path)
-race_data_df = pd.read_csv(race_data_path)
+horse_index = load_horse_index(race_data_path, n=5)
 
 #タイトル
 st.title("出馬表＆競馬新聞")
@@ -110,7 +111,7 @@ for horse in syutubahyo_df["馬名"]:
         st.warning(f"『{horse}』は『消』印が付いているため、近5走は非表示です。")
         continue
 
-    horse_past = race_data_df[race_data_df["馬名"] == horse].head(5)
+    horse_past = get_recent_races(horse_index, horse, 5)
     if len(horse_past) == 0:
         continue
 
@@ -1,14 +1,50 @@
+import time
 import streamlit as st
 import pandas as pd
 from pathlib import Path
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from utils.data_loader import (
+    get_recent_races, load_archive_index, load_csv, load_horse_index, load_race_data, load_store_counts,
+    load_store_page,
+)
+from utils.archive import ARCHIVE_PATH
+from utils.marks_store import get_marks_store
+from utils.race_store import horse_netkeiba_ids
+from utils.newspaper import CSS as NEWSPAPER_CSS, render_newspaper, render_strip
+from utils.render_profile import get_render_profiler
+from utils.shared_data import format_bytes, load_shared_race, memory_report, track_session
+
+# ---- 描画の内訳（サイドバーか ?profile=1 で有効。無効なら何も測らない）----
+rerun_started = time.perf_counter()
+profiler = get_render_profiler(
+    st.session_state, st.sidebar.toggle("描画の内訳を表示", value=st.query_params.get("profile") == "1")
+)
 
-# データの読み込み
+# データの読み込み（ファイルが変わらない限り、再実行時はキャッシュから返る）
 syutubahyo_path = Path("data/syutubahyo_data.csv")
 race_data_path = Path("data/race_jp23_data.csv")
-
-syutubahyo_df = pd.read_csv(syutubahyo_path)
+store_path = Path("data/keiba.db")
+archive_path = ARCHIVE_PATH  # python -m utils.archive build で作る全期間の近走
+
+# 出馬表と近5走はサーバーのプロセスに1つだけ持ち、全セッションで同じものを読む（書き換えない）。
+# セッションごとに持つのは st.session_state の印・並び順などだけ。
+# 馬・騎手には整数キー（horse_key / jockey_key）が付く。結合や検索は馬名ではなくこのキーで行う
+with profiler.section("データ読み込み"):
+    shared_race = load_shared_race(syutubahyo_path, race_data_path, store_path, n=5, archive_path=archive_path)
+syutubahyo_df = shared_race.shutuba
 #race_data_df = pd.read_csv(race_data_path)
-race_data_df = pd.read_csv(race_data_path, engine="python", on_bad_lines="skip")
+horse_index = shared_race.horse_index
+past_source = shared_race.source  # "store" / "archive" / "csv"
+horse_ids = horse_netkeiba_ids(syutubahyo_df)  # ストアは馬のIDが分かればIDで引く
+
+
+def fmt(value, spec="g"):
+    """表示用の文字列に変換（欠損は空文字、小数は spec の書式で表示）"""
+    if value is None or pd.isna(value):
+        return ""
+    if pd.api.types.is_float(value):
+        return format(value, spec)
+    return str(value)
 
 
 #タイトル
@@ -18,58 +54,79 @@ st.title("2023ジャパンカップ出馬表＆競馬新聞")
 #印の選択肢
 mark_options = ["", "◎", "〇", "▲", "△", "✓", "消"]
 
-# セッションステートに印の状態を保存
-if "marks" not in st.session_state:
-    st.session_state["marks"] = {}
-
 # ---- 印の保存・読み込み機能 ----
+# 印はユーザー・レースごとに data/keiba.db へ保存する。
+# 変えた馬の分だけを、少し待ってからまとめて書き込む（utils.marks_store）
+RACE_KEY = "jp23"
 marks_path = Path("data/marks.csv")
-
-# 起動時に保存データがあれば読み込む
-if marks_path.exists():
-    saved_marks = pd.read_csv(marks_path)
-    for _, row in saved_marks.iterrows():
-        st.session_state["marks"][row["馬名"]] = row["印"]
-    st.info("過去の印データを読み込みました。")
-
-# 保存ボタン
+marks_store = get_marks_store(store_path)
+user = st.sidebar.text_input("ユーザー名（印の保存先）", value=st.query_params.get("user", ""))
+
+# セッションステートに印の状態を保存（horse_key → 印）。
+# 保存済みの印を読むのはセッションで1回だけ（再実行のたびに上書きしない）
+if st.session_state.get("marks_owner") != user:
+    with profiler.section("印の読み込み"):
+        if user == "" and marks_path.exists():
+            # 以前の data/marks.csv（全員共通）は、既定のユーザーに1回だけ取り込む（済んだことはストアに残る）
+            def load_legacy_marks():
+                legacy = load_csv(marks_path)
+                return dict(zip(legacy["馬名"], legacy["印"]))
+            marks_store.import_once("legacy_marks_csv", user, RACE_KEY, load_legacy_marks, horse_ids)
+        saved_marks = marks_store.get(user, RACE_KEY)
+        # 印はこのレースの出走馬に付いているので、出馬表の horse_key に付け替える
+        # （馬名だけで対応表を引くと、同じ馬名の昔の馬のキーになることがある）
+        field_keys = dict(zip(syutubahyo_df["馬名"].astype(str), syutubahyo_df["horse_key"]))
+        st.session_state["marks"] = {
+            int(field_keys[name]): mark
+            for name, mark in saved_marks.items()
+            if name in field_keys and not pd.isna(field_keys[name])
+        }
+        st.session_state["marks_owner"] = user
+    if saved_marks:
+        st.info("過去の印データを読み込みました。")
+
+# 印は変えるたびに自動で保存される。ボタンは書き込み待ちの分をすぐに書く
 if st.button("印を保存する"):
-    marks_df = pd.DataFrame(
-        [(name, mark) for name, mark in st.session_state["marks"].items()],
-        columns=["馬名", "印"]
-    )
-    marks_df.to_csv(marks_path, index=False, encoding="utf-8-sig")
+    marks_store.flush()
     st.success("印データを保存しました！")
 
 
 #----- 印選択部分 -----
-# 各馬ごとの印入力
-st.subheader("印選択") #見出し
-for i, row in syutubahyo_df.iterrows():#pandasのDataFrame（出馬表）を１行ずつ処理
-    horse_name = row["馬名"] #syutubahyo.csvから馬名を拾ってくる。○○＝row["〇〇"]で拡張可能
-    current_mark = st.session_state["marks"].get(horse_name, "")#印をsession_stateから取り出す
-    
+# 印を変えても、その馬のセレクトボックスだけを再実行する（st.fragment）。
+# 近5走の表示・非表示が変わる「消」の付け外しのときだけ全体を再実行する
+@st.fragment
+def mark_selector(horse_key, horse_name, label, user):
+    current_mark = st.session_state["marks"].get(horse_key, "")#印をsession_stateから取り出す
+
     # セレクトボックスで印選択
     selected_mark = st.selectbox(
-        f"{horse_name}（{row['性齢']}・{row['騎手']}・{row['人気']}番人気（{row['単勝オッズ']}倍）)",
+        label,
         mark_options,
         index=mark_options.index(current_mark) if current_mark in mark_options else 0,
-        key=f"mark_{horse_name}"#馬のセレクトボックスを識別
+        key=f"mark_{user}_{horse_name}"#馬のセレクトボックスを識別（ユーザーを切り替えたら作り直す）
     )#st.selectbox()でプルダウンメニュ＝を作る
-    
-    # 選択内容を保存
-    st.session_state["marks"][horse_name] = selected_mark
 
-# 「消」印を付けた馬を除外
-visible_horses = [
-    horse for horse, mark in st.session_state["marks"].items() if mark != "消"
-]
+    # 選択内容を保存（変わったときだけ書き込み待ちに入れる）
+    st.session_state["marks"][horse_key] = selected_mark
+    if selected_mark != current_mark:
+        marks_store.set(user, RACE_KEY, horse_name, selected_mark, netkeiba_id=horse_ids.get(horse_name))
+    if (selected_mark == "消") != (current_mark == "消"):
+        st.rerun()
 
-filtered_df = syutubahyo_df[syutubahyo_df["馬名"].isin(visible_horses)]
 
-# ---- 出馬表のデザイン ----
-st.write("２０２３ジャパンカップ出馬表")
+# 各馬ごとの印入力
+st.subheader("印選択") #見出し
+with profiler.section("印のセレクトボックス"):
+    for i, row in syutubahyo_df.iterrows():#pandasのDataFrame（出馬表）を１行ずつ処理
+        horse_name = row["馬名"] #syutubahyo.csvから馬名を拾ってくる。○○＝row["〇〇"]で拡張可能
+        mark_selector(
+            int(row["horse_key"]),
+            horse_name,
+            f"{horse_name}（{row['性齢']}・{row['騎手']}・{fmt(row['人気'])}番人気（{fmt(row['単勝オッズ'])}倍）)",
+            user,
+        )
 
+# ---- 出馬表のデザイン ----
 waku_colors = {
     1: "#FFFFFF",  # 白
     2: "#000000",  # 黒
@@ -81,125 +138,179 @@ waku_colors = {
     8: "#FF00D4",  # 桃
 }
 
-for _, row in syutubahyo_df.iterrows():
-    horse_name = row["馬名"]
-    mark = st.session_state["marks"].get(horse_name, "")
-    waku = int(row["枠番"])
-    umaban = int(row["馬番"])
-    color = waku_colors.get(waku, "#FFFFFF")
-    
-    st.markdown(
-        f"""
-        <div style='display:flex;align-items:center;
-                    border:1px solid #ccc;border-radius:8px;
-                    margin:6px 0;padding:8px;
-                    background-color:#f9f9f9;'>
-            <div style='background-color:{color};
-                        color:{'white' if waku in [2,3,7,8] else 'black'};
-                        font-weight:bold;font-size:20px;
-                        width:50px;height:50px;display:flex;
-                        align-items:center;justify-content:center;
-                        border-radius:6px;margin-right:10px;'>
-                {row['馬番']}
-            </div>
-            <div style='flex:1;'>
-                <b>{horse_name}</b>（{row['性齢']}・{row['騎手']}）<br>
-                <span style='font-size:12px;color:gray;'>馬番:{row['馬番']}・{row['人気']}人気({row['単勝オッズ']}倍)</span>
-            </div>
-        </div>
-        """,
-        unsafe_allow_html=True
-    )
-    #st.markdown(..., unsafe_allow_html=True)
-
-# ---- UIを競馬新聞風に----
-# ---- 並び替えオプション ----
-st.subheader("表示順の設定（競馬新聞部分）")
-
-sort_option = st.selectbox(
-    "表示順を選択してください",
-    ["馬番順（そのまま）", "人気順（昇順）", "単勝オッズ順（昇順）"]
-)
 
-# 並び替え用データフレーム
-sorted_df = syutubahyo_df.copy()
-if sort_option == "人気順（昇順）":
-    sorted_df = sorted_df.sort_values("人気", ascending=True)
-elif sort_option == "単勝オッズ順（昇順）":
-    sorted_df = sorted_df.sort_values("単勝オッズ", ascending=True)
-
-# 並び替え後の馬リストを使う
-horse_list = sorted_df["馬名"].tolist()
-
-
-# ---- 近5走データ-----
-st.write("### 近５走成績（競馬新聞風・高密度）")
+# 文字列は書き換えられないので、セッションごとにコピーを作らない cache_resource で共有する
+@st.cache_resource(show_spinner=False)
+def shutuba_cards_html(df: pd.DataFrame) -> str:
+    """出馬表のカードをまとめたHTML（出馬表が変わらない限り作り直さない）"""
+    cards = []
+    for _, row in df.iterrows():
+        horse_name = row["馬名"]
+        waku = int(row["枠番"])
+        color = waku_colors.get(waku, "#FFFFFF")
+        cards.append(
+            f"""
+            <div style='display:flex;align-items:center;
+                        border:1px solid #ccc;border-radius:8px;
+                        margin:6px 0;padding:8px;
+                        background-color:#f9f9f9;'>
+                <div style='background-color:{color};
+                            color:{'white' if waku in [2,3,7,8] else 'black'};
+                            font-weight:bold;font-size:20px;
+                            width:50px;height:50px;display:flex;
+                            align-items:center;justify-content:center;
+                            border-radius:6px;margin-right:10px;'>
+                    {row['馬番']}
+                </div>
+                <div style='flex:1;'>
+                    <b>{horse_name}</b>（{row['性齢']}・{row['騎手']}）<br>
+                    <span style='font-size:12px;color:gray;'>馬番:{row['馬番']}・{fmt(row['人気'])}人気({fmt(row['単勝オッズ'])}倍)</span>
+                </div>
+            </div>
+            """
+        )
+    return "".join(cards)
 
-# スクロールバーを非表示にするCSS
-st.markdown(
-    '<style>'
-    'div[data-testid="stHorizontalBlock"]::-webkit-scrollbar{display:none;}'
-    'div[data-testid="stHorizontalBlock"]{-ms-overflow-style:none;scrollbar-width:none;}'
-    '</style>',
-    unsafe_allow_html=True
-)
 
-for horse in horse_list:
-    mark = st.session_state["marks"].get(horse, "")
-    if mark == "消":
-        st.warning(f"『{horse}』は『消』印が付いているため、近5走は非表示です。")
-        continue
+# 印に左右されないので、印を変えても再実行されない
+@st.fragment
+def shutuba_block(df):
+    st.write("２０２３ジャパンカップ出馬表")
+    with profiler.section("出馬表カード"):
+        st.markdown(profiler.payload("出馬表カード", shutuba_cards_html(df)), unsafe_allow_html=True)
 
-    horse_past = race_data_df[race_data_df["馬名"] == horse].head(5)
-    if len(horse_past) == 0:
-        continue
 
-    st.markdown(f"#### 🐴 {horse}", unsafe_allow_html=True)
+shutuba_block(syutubahyo_df)
 
-    cards = []
-    for _, r in horse_past.iterrows():
-        race_name = str(r.get("レース名","") or "")
-        grade = str(r.get("グレード","") or "")
-        date = str(r.get("日付","") or r.get("レース日","") or "")
-        course = str(r.get("コース","") or "")
-        result = str(r.get("着順","") or "")
-        time = str(r.get("タイム","") or "")
-        pop = str(r.get("人気","") or "")
-        diff = str(r.get("着差","") or "")
-        jockey = str(r.get("騎手","") or "")
-        passing = str(r.get("通過","") or "")
-        weight = str(r.get("斤量","") or "")
-        last3f = str(r.get("上り","") or "")
-
-        # 着順に応じた色分け
-        bg_color = "#fffdfa"
-        border_color = "#ccc"
-        if result == "1":
-            bg_color = "#fff8dc"; border_color = "#d1b000"  # 金
-        elif result == "2":
-            bg_color = "#eaf3ff"; border_color = "#4a90e2"  # 青
-        elif result == "3":
-            bg_color = "#ffeaea"; border_color = "#ff7070"  # 赤
-
-        # HTMLを構築
-        card_html = (
-            f'<div style="flex:0 0 210px;height:150px;background:{bg_color};'
-            f'border:1px solid {border_color};border-radius:8px;box-shadow:1px 1px 3px rgba(0,0,0,0.12);'
-            f'padding:6px 8px;margin-right:8px;font-family:Yu Gothic,Meiryo,sans-serif;font-size:12px;line-height:1.3;color:#222;">'
-            f'<div style="font-weight:700;font-size:13px;color:#333;">{race_name} <span style="font-size:10px;color:#555;">{grade}</span></div>'
-            f'<div style="font-size:11px;color:#666;margin-bottom:4px;">{date}　{course}</div>'
-            f'<div style="margin-bottom:3px;">着：<b>{result}</b>　人：{pop}　差：{diff}　時計：{time} <span style="color:#777;">（上り {last3f}）</span></div>'
-            f'<div style="margin-bottom:3px;">{jockey}（{weight}）　通過：{passing}</div>'
-            f'</div>'
-        )
-        cards.append(card_html)
 
-    # 横並び表示
-    container_html = (
-        '<div style="display:flex;gap:8px;overflow-x:auto;padding:6px 2px;-webkit-overflow-scrolling:touch;">'
-        + ''.join(cards) +
-        '</div>'
+# ---- UIを競馬新聞風に----
+# 並び替えを変えても、この部分だけを再実行する
+@st.fragment
+def newspaper_block(df):
+    # ---- 並び替えオプション ----
+    st.subheader("表示順の設定（競馬新聞部分）")
+
+    sort_option = st.selectbox(
+        "表示順を選択してください",
+        ["馬番順（そのまま）", "人気順（昇順）", "単勝オッズ順（昇順）"]
     )
 
-
-    st.markdown(container_html, unsafe_allow_html=True)
+    # 並び替え用データフレーム
+    with profiler.section("並び替え"):
+        sorted_df = df
+        if sort_option == "人気順（昇順）":
+            sorted_df = sorted_df.sort_values("人気", ascending=True)
+        elif sort_option == "単勝オッズ順（昇順）":
+            sorted_df = sorted_df.sort_values("単勝オッズ", ascending=True)
+
+        # 並び替え後の馬リストを使う（horse_key, 馬名）
+        horse_list = list(zip(sorted_df["horse_key"].astype(int), sorted_df["馬名"]))
+
+
+    # ---- 近5走データ-----
+    st.write("### 近５走成績（競馬新聞風・高密度）")
+
+    view_mode = st.radio("表示方法", ["全頭まとめて", "1頭ずつ開く"], horizontal=True)
+    if view_mode == "1頭ずつ開く":
+        with profiler.section("近走カード（1頭ずつ）"):
+            lazy_past_races(horse_list)
+        return
+
+    # 全頭分を1つのHTMLにまとめて1回で送る（レース・「消」の馬・並び順が同じなら作り直さない）
+    with profiler.section("近走カード"):
+        hidden = frozenset(key for key, mark in st.session_state["marks"].items() if mark == "消")
+        html = render_newspaper(horse_index, horse_list, hidden, n=5)
+        st.markdown(profiler.payload("近走カード", html), unsafe_allow_html=True)
+
+
+# ---- 1頭ずつ開く表示 ----
+# 最初は1行の要約だけを出し、開いた馬の近走だけを1ページずつ読む。
+# 古い成績はページ送りで遡る（ストアがあれば必要な分だけをクエリで読む）
+def full_history_index():
+    if past_source == "archive":
+        # アーカイブからは出走馬を含む行グループだけを読む
+        return load_archive_index(syutubahyo_df["馬名"], n=None, path=archive_path, key_col="horse_key")
+    return load_horse_index(race_data_path, n=None, loader=load_race_data, key_col="horse_key")
+
+
+def past_race_counts(horse_list):
+    if past_source == "store":
+        counts = load_store_counts([horse for _, horse in horse_list], db_path=store_path, netkeiba_ids=horse_ids)
+        return {key: counts.get(horse, 0) for key, horse in horse_list}
+    index = full_history_index()
+    return {key: len(index.get(key, ())) for key, _ in horse_list}
+
+
+def load_past_page(horse_key, horse, page, per_page):
+    if past_source == "store":
+        return load_store_page(horse, page, per_page, db_path=store_path, netkeiba_id=horse_ids.get(horse))
+    return get_recent_races(full_history_index(), horse_key, per_page, offset=page * per_page)
+
+
+def turn_page(page_key, step):
+    st.session_state[page_key] = st.session_state.get(page_key, 0) + step
+
+
+# 開く・ページを送るときは、その馬の部分だけを再実行する
+@st.fragment
+def past_race_pager(horse_key, horse, total, per_page):
+    latest = get_recent_races(horse_index, horse_key, 1)
+    summary = f"（全{total}走）"
+    if len(latest):
+        r = latest.iloc[0]
+        summary = f"前走 {fmt(r.get('日付'))} {fmt(r.get('レース名'))} {fmt(r.get('着順'))}着" + summary
+    if not st.toggle(f"🐴 {horse}　{summary}", key=f"open_{horse_key}"):
+        return
+
+    pages = max(1, -(-total // per_page))
+    page_key = f"page_{horse_key}"
+    page = min(st.session_state.get(page_key, 0), pages - 1)
+    st.markdown(render_strip(load_past_page(horse_key, horse, page, per_page)), unsafe_allow_html=True)
+    if pages > 1:
+        prev_col, info_col, next_col = st.columns([1, 2, 1])
+        prev_col.button("← 新しい走", key=f"prev_{horse_key}", disabled=page == 0,
+                        on_click=turn_page, args=(page_key, -1))
+        info_col.caption(f"{page + 1} / {pages} ページ")
+        next_col.button("古い走 →", key=f"next_{horse_key}", disabled=page >= pages - 1,
+                        on_click=turn_page, args=(page_key, 1))
+
+
+def lazy_past_races(horse_list):
+    per_page = st.select_slider("1ページの走数", options=[5, 10, 20, 50], value=5)
+    st.markdown(NEWSPAPER_CSS, unsafe_allow_html=True)
+    counts = past_race_counts(horse_list)
+    for horse_key, horse in horse_list:
+        if st.session_state["marks"].get(horse_key, "") == "消":
+            st.caption(f"『{horse}』は『消』印が付いているため、近5走は非表示です。")
+            continue
+        if counts.get(horse_key, 0) == 0:
+            continue
+        past_race_pager(horse_key, horse, counts[horse_key], per_page)
+
+
+newspaper_block(syutubahyo_df)
+
+
+# ---- メモリの内訳（共有分とセッションごとの分）----
+ctx = get_script_run_ctx()
+if ctx is not None:
+    track_session(ctx.session_id, st.session_state.to_dict())
+if st.sidebar.toggle("メモリの内訳を表示"):
+    report = memory_report()
+    shared = report[report["区分"] == "共有"]["バイト数"].sum()
+    sessions = report[report["区分"] == "セッション"]["バイト数"]
+    st.sidebar.caption(
+        f"共有 {format_bytes(shared)} ／ セッション {len(sessions)}件（平均 {format_bytes(sessions.mean() if len(sessions) else 0)}）"
+    )
+    report["大きさ"] = report["バイト数"].map(format_bytes)
+    st.sidebar.dataframe(report[["区分", "内容", "件数", "大きさ"]], hide_index=True)
+
+# ---- 描画の内訳（区間ごとの今回の時間・送ったHTMLの大きさと、直近の再実行の百分位）----
+if profiler.enabled:
+    profiler.record("再実行全体", time.perf_counter() - rerun_started)
+    timings = profiler.report()
+    timings["大きさ"] = timings["バイト数"].map(lambda n: "" if pd.isna(n) else format_bytes(n))
+    st.sidebar.caption("描画の内訳（印・並び替えだけの再実行は、次に全体を再実行したときに反映）")
+    st.sidebar.dataframe(
+        timings.drop(columns="バイト数").round(1), hide_index=True,
+    )
@@ -0,0 +1 @@
+# tests/ から utils などをインポートできるよう、pytest にリポジトリのルートを sys.path へ入れさせる
@@ -1,35 +1,21 @@
-import time
-import json
 import pandas as pd
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from bs4 import BeautifulSoup
-from webdriver_manager.chrome import ChromeDriverManager
+from utils.browser import fetch_page_html
+from utils.extractors import extract_next_data
 
 def fetch_race_with_selenium(race_id):
     """netkeiba 出馬表ページから __NEXT_DATA__ をSeleniumで抽出"""
     url = f"https://race.netkeiba.com/race/shutuba.html?race_id={race_id}"
     print(f"📘 アクセス中: {url}")
 
-    options = Options()
-    options.add_argument("--headless")
-    options.add_argument("--no-sandbox")
-    options.add_argument("--disable-dev-shm-usage")
+    # キャッシュ → 普通のHTTP → 使い回しのブラウザ の順に試す（固定のsleepはしない）
+    html = fetch_page_html(url, ready_css="script#__NEXT_DATA__", marker="__NEXT_DATA__")
 
-    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-    driver.get(url)
-    time.sleep(4)  # JS描画待ち
-
-    soup = BeautifulSoup(driver.page_source, "html.parser")
-    driver.quit()
-
-    script_tag = soup.find("script", id="__NEXT_DATA__")
-    if not script_tag:
+    # __NEXT_DATA__ はDOMを作らずに切り出す
+    data = extract_next_data(html)
+    if data is None:
         print("❌ __NEXT_DATA__ が見つかりません。")
         return pd.DataFrame()
 
-    data = json.loads(script_tag.string)
     try:
         horses = data["props"]["pageProps"]["race"]["horses"]
     except KeyError:
@@ -0,0 +1,313 @@
+"""複数レースの出馬表と近5走をまとめて取得する（対話入力なし）
+
+使い方:
+    # レースIDの範囲（東京4回8日の1R〜12R）
+    python fetch_batch.py 202405040801-202405040812
+
+    # 開催（年+場+回+日）を指定すると1R〜12Rすべて
+    python fetch_batch.py --meeting 2024050408 2024090208
+
+    # 開催日と競馬場（省略すると全場）
+    python fetch_batch.py --date 20241123 --venue 東京 --venue 京都
+
+    # ストアにある近走を差分だけ更新する（前回の確認以降にレースが無い馬は取りに行かない）
+    python fetch_batch.py --incremental --meeting 2024050408
+
+    # 各馬の全成績をストアへ取り込む（近5走に切り詰めない。取り込み済みの馬は飛ばす）
+    # 全レースの出馬表・出走馬のページを 取得 → パース → 書き込み の段に分けて流し、各段の速さを表示する
+    python fetch_batch.py --backfill --meeting 2024050408
+
+結果はレースごとに data/races/<race_id>/ へ保存する（上書きし合わない）。
+各段（ブラウザ・HTTP・パース・書き込み）の時間は data/metrics/fetch_batch.json と .prom
+（Prometheus のテキスト形式）に書き出す。--profile を付けると cProfile の結果も書き出す。
+"""
+import argparse
+import os
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import pandas as pd
+
+from utils.extractors import shutuba_from_table
+from utils.http_cache import get_response_cache
+from utils.http_client import share_between_processes, shared_slots
+from utils.pipeline import run_pipeline
+from utils.race_writer import CheckpointWriter
+from utils.race_store import RaceStore, horse_netkeiba_ids, save_fetched_race
+from utils import timing
+from utils.timing import span, timed
+
+OUTPUT_DIR = Path("data/races")
+
+# レースIDの5〜6桁目の場コード
+VENUE_CODES = {
+    "札幌": "01", "函館": "02", "福島": "03", "新潟": "04", "東京": "05",
+    "中山": "06", "中京": "07", "京都": "08", "阪神": "09", "小倉": "10",
+}
+
+RACE_LIST_URL = "https://race.netkeiba.com/top/race_list_sub.html?kaisai_date={date}"
+SHUTUBA_URL = "https://race.netkeiba.com/race/shutuba.html?race_id={race_id}"
+
+
+# ==============================
+# レースIDの組み立て
+# ==============================
+def expand_race_ids(spec):
+    """'202405040801-202405040812' や '202405040811' をレースIDのリストにする"""
+    spec = spec.strip()
+    if "-" in spec:
+        start, end = (s.strip() for s in spec.split("-", 1))
+        if len(start) != 12 or len(end) != 12 or start[:10] != end[:10]:
+            raise ValueError(f"範囲は同じ開催のレースIDで指定してください: {spec}")
+        return [f"{start[:10]}{r:02d}" for r in range(int(start[10:]), int(end[10:]) + 1)]
+    if not re.fullmatch(r"\d{12}", spec):
+        raise ValueError(f"レースIDは12桁です: {spec}")
+    return [spec]
+
+
+def meeting_race_ids(meeting, races=12):
+    """開催ID（年4桁+場2桁+回2桁+日2桁）の1R〜racesRのレースID"""
+    if not re.fullmatch(r"\d{10}", meeting):
+        raise ValueError(f"開催IDは10桁です: {meeting}")
+    return [f"{meeting}{r:02d}" for r in range(1, races + 1)]
+
+
+def race_ids_for_date(date, venues=None):
+    """開催日のレース一覧ページからレースIDを拾う（venues で競馬場を絞り込む）"""
+    html = get_response_cache().fetch(RACE_LIST_URL.format(date=date))
+    race_ids = sorted(set(re.findall(r"race_id=(\d{12})", html)))
+    if venues:
+        codes = {VENUE_CODES[v] for v in venues}
+        race_ids = [r for r in race_ids if r[4:6] in codes]
+    return race_ids
+
+
+# ==============================
+# 1レース分の取得（ワーカープロセスで実行）
+# ==============================
+def race_output_dir(race_id, out_dir=OUTPUT_DIR):
+    return Path(out_dir) / race_id
+
+
+@timed("write.csv")
+def _replace_csv(df, path):
+    """一時ファイルに書いてから置き換える（途中で落ちても壊れたCSVを残さない）"""
+    tmp = path.with_name(f".{path.name}.tmp")
+    df.to_csv(tmp, index=False, encoding="utf-8-sig")
+    os.replace(tmp, path)
+
+
+def fetch_one_race(race_id, out_dir=OUTPUT_DIR, max_in_flight=4, force=False, incremental=False, backfill=False,
+                   parse_workers=1):
+    """1レースの出馬表と近5走を取得して data/races/<race_id>/ に保存する
+
+    force=True なら前回のチェックポイントを捨てて全馬取り直す。
+    incremental=True ならストアの近走を差分だけ更新し、race_data.csv はストアから書き出す。
+    backfill=True なら各馬の全成績をストアへ取り込んでから、同じくストアから書き出す
+    （取り込み済みの馬は force=True でなければ飛ばす）。
+    parse_workers … 馬ページをパースするプロセス数（レースごとにプロセスを分けているので既定は1）。
+    """
+    # Selenium等の読み込みはワーカー側だけで行う
+    from fetch_race import (
+        backfill_field, fetch_field_past_races, fetch_syutubahyo_selenium, refresh_field_incremental,
+    )
+
+    started = time.perf_counter()
+    dest = race_output_dir(race_id, out_dir)
+    dest.mkdir(parents=True, exist_ok=True)
+
+    df = fetch_syutubahyo_selenium(race_id, save_path=None)
+    if df.empty:
+        return race_id, 0, 0, time.perf_counter() - started, timing.drain()
+
+    df.insert(0, "race_id", race_id)
+    _replace_csv(df, dest / "syutubahyo.csv")
+
+    if incremental or backfill:
+        store = RaceStore()
+        with span("write.store"):
+            store.upsert_entries(race_id, df)
+        if backfill:
+            backfill_field(df, store, max_in_flight=max_in_flight, force=force, parse_workers=parse_workers)
+        else:
+            refresh_field_incremental(df, store, max_in_flight=max_in_flight, parse_workers=parse_workers)
+        recent = store.recent_results(df["馬名"], n=5, netkeiba_ids=horse_netkeiba_ids(df))
+        _replace_csv(recent, dest / "race_data.csv")
+        return race_id, len(df), len(recent), time.perf_counter() - started, timing.drain()
+
+    # 近走は1頭ずつ追記する。落ちたレースは再実行で取得済みの馬から再開する
+    if force:
+        shutil.rmtree(dest / "checkpoint", ignore_errors=True)
+    writer = CheckpointWriter(dest / "checkpoint")
+    fetch_field_past_races(df, race_id, writer, max_in_flight=max_in_flight, parse_workers=parse_workers)
+    rows = writer.export_csv(dest / "race_data.csv", order=df["馬名"].tolist())
+    with span("write.store"):
+        save_fetched_race(RaceStore(), race_id, df, list(writer.iter_rows()))
+    # このプロセスで計った時間は親へ渡して合算する
+    return race_id, len(df), rows, time.perf_counter() - started, timing.drain()
+
+
+def _init_worker(n_workers, slots):
+    """ワーカープロセスの初期化（ホストごとの上限をプロセス間で分け合い、親から引き継いだ時間の集計を空にする）"""
+    share_between_processes(n_workers, slots)
+    timing.reset()
+
+
+# ==============================
+# まとめてバックフィル（取得 → パース → 書き込み の段に分ける）
+# ==============================
+def backfill_races(race_ids, out_dir=OUTPUT_DIR, max_in_flight=8, force=False, parse_workers=None):
+    """複数レースの出走馬の全成績をまとめてストアへ取り込み、data/races/<race_id>/ にも書き出す
+
+    レースごとにプロセスを分ける代わりに、全レースの出馬表、続いて全出走馬のページを
+    取得（max_in_flight 本のスレッド）→ パース（parse_workers 個のプロセス。既定はCPU数）→
+    書き込み（このプロセスで1件ずつ）の段に流す。同じ馬が複数のレースに出ていても1回だけ取る。
+    (出馬表が取れたレース数, 取り込んだ頭数, 登録した行数) を返す。
+    """
+    # Selenium等の読み込みは使うときだけ行う
+    from fetch_race import backfill_field
+    from utils.browser import fetch_page_html
+
+    store = RaceStore()
+    fields = {}
+
+    def download(race_id):
+        url = SHUTUBA_URL.format(race_id=race_id)
+        print(f"📘 アクセス中: {url}")
+        return fetch_page_html(url, ready_css="table.RaceTable01", marker="RaceTable01")
+
+    def write(race_id, rows):
+        if not rows:
+            print(f"❌ {race_id}: 出馬表テーブルが見つかりません。")
+            return
+        df = pd.DataFrame(rows)
+        df.insert(0, "race_id", race_id)
+        dest = race_output_dir(race_id, out_dir)
+        dest.mkdir(parents=True, exist_ok=True)
+        _replace_csv(df, dest / "syutubahyo.csv")
+        with span("write.store"):
+            store.upsert_entries(race_id, df)
+        fields[race_id] = df
+        print(f"✅ {race_id}: 出馬表を取得しました（{len(df)}頭）")
+
+    stats = run_pipeline(race_ids, download, shutuba_from_table, write,
+                         download_workers=max_in_flight, parse_workers=parse_workers)
+    print("📊 出馬表")
+    print(stats.report())
+
+    # 複数のレースに出る馬は1回だけ取り込む
+    urls = {}
+    for df in fields.values():
+        urls.update(zip(df["馬名"], df["horse_url"]))
+    field = pd.DataFrame({"馬名": list(urls), "horse_url": list(urls.values())})
+    fetched, skipped, added = backfill_field(
+        field, store, max_in_flight=max_in_flight, force=force, parse_workers=parse_workers)
+
+    for race_id, df in fields.items():
+        recent = store.recent_results(df["馬名"], n=5, netkeiba_ids=horse_netkeiba_ids(df))
+        _replace_csv(recent, race_output_dir(race_id, out_dir) / "race_data.csv")
+    return len(fields), fetched, added
+
+
+# ==============================
+# メイン処理
+# ==============================
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="複数レースの出馬表と近5走をまとめて取得する")
+    parser.add_argument("race_ids", nargs="*", help="レースID、または 'ID-ID' の範囲")
+    parser.add_argument("--meeting", nargs="*", default=[], help="開催ID（10桁）。1R〜12Rを取得")
+    parser.add_argument("--date", help="開催日（YYYYMMDD）")
+    parser.add_argument("--venue", action="append", choices=list(VENUE_CODES), help="競馬場（複数指定可）")
+    parser.add_argument("--workers", type=int, default=min(6, os.cpu_count() or 1), help="並列プロセス数")
+    parser.add_argument("--per-race", type=int, default=4, help="1レース内で同時に取得する馬の数")
+    parser.add_argument("--out", default=str(OUTPUT_DIR), help="保存先ディレクトリ")
+    parser.add_argument("--force", action="store_true", help="取得済みのレースも取り直す")
+    parser.add_argument("--incremental", action="store_true",
+                        help="取得済みのレースも対象にし、近走はストアとの差分だけ更新する")
+    parser.add_argument("--backfill", action="store_true",
+                        help="取得済みのレースも対象にし、各馬の全成績をストアへ取り込む")
+    parser.add_argument("--profile", nargs="?", const=str(timing.METRICS_DIR / "fetch_batch.pstats"),
+                        help="cProfile の結果（pstats）を書き出す（既定 data/metrics/fetch_batch.pstats。"
+                             "メインプロセスのメインスレッドの分）")
+    parser.add_argument("--parse-workers", type=int,
+                        help="ページをパースするプロセス数（--backfill の既定はCPU数、それ以外は1レースに1つ）")
+    return parser.parse_args(argv)
+
+
+def collect_race_ids(args):
+    race_ids = []
+    for spec in args.race_ids:
+        race_ids.extend(expand_race_ids(spec))
+    for meeting in args.meeting:
+        race_ids.extend(meeting_race_ids(meeting))
+    if args.date:
+        race_ids.extend(race_ids_for_date(args.date, args.venue))
+    # 重複を除いて指定順を保つ
+    return list(dict.fromkeys(race_ids))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        with timing.profiled(args.profile):
+            run(args)
+    finally:
+        summary = timing.format_summary()
+        if summary:
+            print(summary)
+            paths = timing.write_metrics("fetch_batch", argv=sys.argv[1:] if argv is None else list(argv))
+            print("📊 " + " / ".join(str(p) for p in paths))
+
+
+def run(args):
+    race_ids = collect_race_ids(args)
+    if not (args.force or args.incremental or args.backfill):
+        race_ids = [r for r in race_ids if not (race_output_dir(r, args.out) / "race_data.csv").exists()]
+    if not race_ids:
+        print("取得するレースがありません。")
+        return
+
+    started = time.perf_counter()
+    if args.backfill:
+        # 1プロセスで段に分けて流す（同時に取得する数はレースごとに分けたときの合計と同じ）
+        print(f"🏇 {len(race_ids)}レースの出走馬の全成績を取り込みます")
+        races, fetched, added = backfill_races(
+            race_ids, args.out, max_in_flight=args.workers * args.per_race,
+            force=args.force, parse_workers=args.parse_workers,
+        )
+        print(f"⏱ 合計 {time.perf_counter() - started:.1f}秒（{races}/{len(race_ids)}レース・{fetched}頭・{added}件登録）")
+        return
+
+    print(f"🏇 {len(race_ids)}レースを{args.workers}プロセスで取得します")
+    failed = []
+    # ホストごとのアクセスの上限はプロセス間で分け合う（全体で上限を超えないように）
+    with ProcessPoolExecutor(
+        max_workers=args.workers, initializer=_init_worker, initargs=(args.workers, shared_slots()),
+    ) as pool:
+        futures = {
+            pool.submit(fetch_one_race, r, args.out, args.per_race, args.force, args.incremental, False,
+                        1 if args.parse_workers is None else args.parse_workers): r
+            for r in race_ids
+        }
+        for future in as_completed(futures):
+            race_id = futures[future]
+            try:
+                _, horses, rows, elapsed, spans = future.result()
+            except Exception as e:
+                print(f"❌ {race_id}: {e}")
+                failed.append(race_id)
+                continue
+            timing.merge(spans)
+            print(f"✅ {race_id}: {horses}頭 / 近走{rows}件（{elapsed:.1f}秒）")
+
+    print(f"⏱ 合計 {time.perf_counter() - started:.1f}秒（失敗 {len(failed)}件）")
+    if failed:
+        print("失敗したレース: " + " ".join(sorted(failed)))
+
+
+if __name__ == "__main__":
+    main()
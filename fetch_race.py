@@ -1,113 +1,42 @@
+import sys
 import time
 import pandas as pd
-import re
-import json
-import requests
-from urllib.parse import urljoin
-from bs4 import BeautifulSoup
-
-# Selenium関係
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.chrome import ChromeDriverManager
-
+from utils.http_client import make_session
+from utils.http_cache import get_response_cache
+from utils.browser import fetch_page_html
+from utils.extractors import extract_past_races, shutuba_from_table
+from utils.race_writer import checkpoint_for_race
+from utils.race_store import RaceStore, horse_netkeiba_ids, save_fetched_race
+from utils.ids import netkeiba_id
+from utils.incremental import last_results_ready, plan_refresh
+from utils.pipeline import run_pipeline
+from utils import timing
+from utils.timing import span
 
 # ==============================
-# 出馬表の取得（Selenium使用）
+# 出馬表の取得（必要なときだけSelenium使用）
 # ==============================
 #horse_url
-def fetch_syutubahyo_selenium(race_id):
-    """Seleniumで出馬表を取得（URL正規化付き）"""
-    from selenium import webdriver
-    from selenium.webdriver.chrome.service import Service
-    from selenium.webdriver.chrome.options import Options
-    from selenium.webdriver.common.by import By
-    from selenium.webdriver.support.ui import WebDriverWait
-    from selenium.webdriver.support import expected_conditions as EC
-    from webdriver_manager.chrome import ChromeDriverManager
-    from bs4 import BeautifulSoup
-    import re
-    from urllib.parse import urljoin
-    import pandas as pd
+def fetch_syutubahyo_selenium(race_id, save_path="data/syutubahyo_auto.csv"):
+    """Seleniumで出馬表を取得（URL正規化付き）
 
+    save_path=None なら保存しない（一括取得ではレースごとに別の場所へ保存する）。
+    """
     url = f"https://race.netkeiba.com/race/shutuba.html?race_id={race_id}"
-    print(f"📘 ブラウザでアクセス中: {url}")
-
-    options = Options()
-    options.add_argument("--headless=new")
-    options.add_argument("--no-sandbox")
-    options.add_argument("--disable-dev-shm-usage")
+    print(f"📘 アクセス中: {url}")
 
-    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-    driver.get(url)
+    # キャッシュ → 普通のHTTP → 使い回しのブラウザ の順に試す
+    html = fetch_page_html(url, ready_css="table.RaceTable01", marker="RaceTable01")
 
-    try:
-        WebDriverWait(driver, 15).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "table.RaceTable01"))
-        )
-    except:
-        print("⚠️ 出馬表ロードを待機しましたが、要素が見つかりませんでした。")
-
-    soup = BeautifulSoup(driver.page_source, "html.parser")
-    driver.quit()
-
-    rows = []
-    table = soup.select_one("table.RaceTable01")
-    if not table:
+    rows = shutuba_from_table(html)
+    if not rows:
         print("❌ 出馬表テーブルが見つかりません。")
         return pd.DataFrame()
 
-    for tr in table.find_all("tr"):
-        tds = tr.find_all("td")
-        if len(tds) < 8:
-            continue
-
-        horse_a = tr.find("a", href=re.compile("/horse/"))
-        if not horse_a:
-            continue
-
-        horse_name = horse_a.get_text(strip=True)
-        raw_href = horse_a.get("href", "").strip()
-
-        # --- URL正規化処理 ---
-        if not raw_href:
-            continue
-
-        # db.netkeiba.com に統一
-        if raw_href.startswith("http"):
-            horse_url = re.sub(r"^https*://race\.netkeiba\.com", "https://db.netkeiba.com", raw_href)
-        else:
-            horse_url = urljoin("https://db.netkeiba.com", raw_href)
-
-        # 二重コロン修正
-        horse_url = horse_url.replace("https::", "https:")
-
-        # 騎手情報などを抽出
-        jockey = tr.find("a", href=re.compile("/jockey/"))
-        jockey_name = jockey.get_text(strip=True) if jockey else ""
-        odds_tag = tr.find("td", class_="OddsTxt")
-        odds = odds_tag.get_text(strip=True) if odds_tag else ""
-        pop_tag = tr.find("td", class_="PopularTxt")
-        pop = pop_tag.get_text(strip=True) if pop_tag else ""
-        age = tds[3].get_text(strip=True)
-        weight = tds[4].get_text(strip=True)
-
-        rows.append({
-            "馬名": horse_name,
-            "騎手": jockey_name,
-            "斤量": weight,
-            "馬齢": age,
-            "人気": pop,
-            "単勝オッズ": odds,
-            "horse_url": horse_url
-        })
-
     df = pd.DataFrame(rows)
-    df.to_csv("data/syutubahyo_auto.csv", index=False, encoding="utf-8-sig")
+    if save_path:
+        with span("write.csv"):
+            df.to_csv(save_path, index=False, encoding="utf-8-sig")
     print(f"✅ 出馬表を取得しました（{len(df)}頭）")
     return df
 
@@ -115,89 +44,260 @@ def fetch_syutubahyo_selenium(race_id):
 # ==============================
 # 各馬の過去5走を取得
 # ==============================
-import pandas as pd
-import requests
-from io import StringIO
-from bs4 import BeautifulSoup
-import re
-
-def fetch_past_5races(horse_url, horse_name):
-    """pandas.read_html() + BeautifulSoup バックアップ併用版"""
-    print(f"🐎 {horse_name} の近5走を取得中...")
+def fetch_past_5races(horse_url, horse_name, session=None):
+    """馬ページから近5走を取得（ページのパースは1回だけ）
+
+    session を渡すとその接続プールを使い回す（並列取得時は共有のSessionを渡す）。
+    """
+    return fetch_horse_update(horse_url, horse_name, session=session)[0]
+
+
+def fetch_horse_update(horse_url, horse_name, session=None, fetched_after=None, limit=5, skip_unchanged=False):
+    """fetch_past_5races と同じだが (races, 状態) を返す
+
+    期限切れ（または fetched_after より前に取得した）キャッシュがあれば条件付きリクエストにし、
+    304（変更なし）なら保存済みのページをパースする。skip_unchanged=True（差分更新）のときだけ、
+    304ならパースせずに ([], "not_modified") を返す（前回から増えた成績が無い）。
+    状態は http_cache の fetch_with_status と同じ。limit=None ならページにある全成績を返す。
+    """
+    print(f"🐎 {horse_name} の{'全成績' if limit is None else f'近{limit}走'}を取得中...")
     try:
-        res = requests.get(horse_url, headers={"User-Agent": "Mozilla/5.0"})
-        res.encoding = "utf-8"
-        html = res.text
+        html, status = get_response_cache().fetch_with_status(
+            horse_url, session=session, fetched_after=fetched_after)
     except Exception as e:
         print(f"⚠️ {horse_name}: ページ取得失敗 ({e})")
-        return []
+        return [], "error"
+    if status == "not_modified" and skip_unchanged:
+        print(f"⏩ {horse_name}: 前回から変更なし")
+        return [], status
 
-    # --- 方法1: pandas.read_html() ---
-    try:
-        from io import StringIO
-        dfs = pd.read_html(StringIO(html))
-        for df in dfs:
-            if any("レース" in str(c) for c in df.columns):
-                df.columns = [re.sub(r'\s+', '', str(c)) for c in df.columns]
-                race_col = [c for c in df.columns if "レース" in c][0]
-                keep_cols = [race_col] + [c for c in ["日付", "着順", "タイム", "人気", "通過", "着差"] if c in df.columns]
-                df = df[keep_cols].head(5)
-                df["馬名"] = horse_name
-                print(f"✅ {horse_name}: {len(df)}件取得（read_html）")
-                return df.to_dict("records")
-    except Exception:
-        pass  # fallbackへ
-
-    # --- 方法2: BeautifulSoupでdiv構造を解析 ---
-    soup = BeautifulSoup(html, "html.parser")
-    race_blocks = soup.select("div.HorseList, div.Horse_5result, table.Horse_5result_table")
-
-    if not race_blocks:
+    races, strategy = parse_horse_page((html, horse_name, horse_url, limit))
+    if not races:
         print(f"⚠️ {horse_name}: 近走テーブルが見つかりません ({horse_url})")
-        return []
-
-    # 手動パース（最近の構成に対応）
-    races = []
-    rows = soup.select("tr.HorseList__row")
-    for row in rows[:5]:
-        cells = [td.get_text(strip=True) for td in row.find_all("td")]
-        if len(cells) < 6:
-            continue
-        races.append({
-            "馬名": horse_name,
-            "レース名": cells[1],
-            "日付": cells[0],
-            "着順": cells[2],
-            "タイム": cells[3],
-            "人気": cells[4],
-            "着差": cells[5] if len(cells) > 5 else "",
-        })
-
-    print(f"✅ {horse_name}: {len(races)}件取得（BeautifulSoup fallback）")
-    return races
+        return [], status
+
+    print(f"✅ {horse_name}: {len(races)}件取得（{strategy}）")
+    return races, status
+
+
+def parse_horse_page(job):
+    """(html, 馬名, horse_url, limit) から (races, 抽出方法) を取り出す
+
+    CPUを使うのはここだけなので、一括取得ではパース用のプロセスで呼ぶ（トップレベルに置く）。
+    """
+    html, horse_name, horse_url, limit = job
+    # __NEXT_DATA__ → 成績テーブル → HorseList行 のうち、成功率の高い順に試す
+    races, strategy = extract_past_races(html, horse_name, limit=limit)
+    horse_id = netkeiba_id(horse_url, "horse")
+    for race in races:
+        race["horse_id"] = horse_id
+    return races, strategy
+
+
+def fetch_full_history(horse_url, horse_name, session=None):
+    """馬ページから全成績を取得（近5走に切り詰めない。バックフィル用）"""
+    return fetch_horse_update(horse_url, horse_name, session=session, limit=None)[0]
+
+
+# ==============================
+# 近5走の並列取得
+# ==============================
+# 同時に投げるリクエストの上限（増やしすぎるとアクセス制限を受ける）
+MAX_IN_FLIGHT = 6
+
+
+def fetch_horses_pipelined(horses, on_result, limit=5, fetched_after=None, skip_unchanged=False,
+                           max_in_flight=MAX_IN_FLIGHT, parse_workers=None, session=None):
+    """(馬名, horse_url) のリストを 取得 → パース → 書き込み の段に分けて処理する
+
+    取得は max_in_flight 本のスレッド、パースは parse_workers 個のプロセス（既定はCPU数）で
+    並列に行うので、ネットワークの待ちとパースが重なる。on_result(馬名, races, 状態) は
+    呼び出したスレッドで1頭ずつ呼ぶ（状態と skip_unchanged は fetch_horse_update と同じ）。
+    各段の件数と速さ（utils.pipeline.PipelineStats）を返す。
+    """
+    own_session = session is None
+    session = session or make_session(pool_size=max_in_flight)
+    cache = get_response_cache()
+    statuses = {}
+
+    def download(horse):
+        horse_name, horse_url = horse
+        print(f"🐎 {horse_name} の{'全成績' if limit is None else f'近{limit}走'}を取得中...")
+        try:
+            html, statuses[horse_name] = cache.fetch_with_status(
+                horse_url, session=session, fetched_after=fetched_after)
+        except Exception as e:
+            print(f"⚠️ {horse_name}: ページ取得失敗 ({e})")
+            return None
+        if statuses[horse_name] == "not_modified" and skip_unchanged:
+            return None
+        return html, horse_name, horse_url, limit
+
+    def write(horse, result):
+        horse_name, horse_url = horse
+        status = statuses.get(horse_name, "error")
+        races, strategy = result or ([], None)
+        if status == "not_modified" and skip_unchanged:
+            print(f"⏩ {horse_name}: 前回から変更なし")
+        elif races:
+            print(f"✅ {horse_name}: {len(races)}件取得（{strategy}）")
+        elif status != "error":
+            print(f"⚠️ {horse_name}: 近走テーブルが見つかりません ({horse_url})")
+        on_result(horse_name, races, status)
+
+    try:
+        return run_pipeline(horses, download, parse_horse_page, write,
+                            download_workers=max_in_flight, parse_workers=parse_workers)
+    finally:
+        if own_session:
+            session.close()
+
+
+def fetch_field_past_races(df, race_id, writer, max_in_flight=MAX_IN_FLIGHT, parse_workers=None):
+    """出馬表の全馬の近5走を並列で取得し、1頭取れるたびに writer へ追記する
+
+    writer に取得済みとして記録されている馬は取り直さない（落ちた後の再実行で続きから再開）。
+    """
+    horses = list(zip(df["馬名"], df["horse_url"]))
+    pending = [(name, url) for name, url in horses if not writer.is_done(race_id, name)]
+    if len(pending) < len(horses):
+        print(f"⏩ 取得済みの{len(horses) - len(pending)}頭をスキップします")
+
+    def on_result(horse_name, races, status):
+        # 取れなかった馬は記録せず、次回の再実行で取り直す
+        if races:
+            writer.write_horse(race_id, horse_name, races)
+
+    return fetch_horses_pipelined(pending, on_result, max_in_flight=max_in_flight, parse_workers=parse_workers)
+
+
+def refresh_field_incremental(df, store, max_in_flight=MAX_IN_FLIGHT, parse_workers=None):
+    """出馬表の全馬の近走を差分更新する
+
+    前回の確認以降にレースが無かった馬はページを取りに行かず、取りに行った馬も
+    ストアに無い新しい行だけを登録する。(取得した頭数, 飛ばした頭数, 追加した行数) を返す。
+    """
+    urls = dict(zip(df["馬名"], df["horse_url"]))
+    ids = horse_netkeiba_ids(df)
+    to_fetch, skipped = plan_refresh(store, list(urls), netkeiba_ids=ids)
+    if skipped:
+        print(f"⏩ 前回の確認以降にレースが無い{len(skipped)}頭をスキップします")
+
+    # 直近で成績が出そろう前に取ったキャッシュは使わない（新しい成績が載っていないかもしれない）
+    ready = last_results_ready()
+
+    cache = get_response_cache()
+    added = 0
+
+    def on_result(horse_name, races, status):
+        nonlocal added
+        if status == "error" or (status != "not_modified" and not races):
+            # 取れなかった馬は確認済みにしない（次回また取りに行く）
+            return
+        # 確認した時刻はページを取得した時刻（キャッシュを使ったならその取得時刻）
+        meta = cache.lookup(urls[horse_name]) or {}
+        with span("write.store"):
+            added += store.merge_new_results(
+                horse_name, races, checked_at=meta.get("fetched_at", time.time()), netkeiba_id=ids.get(horse_name))
+
+    horses = [(name, urls[name]) for name in to_fetch]
+    # 304（前回から変わっていない）の馬はパースしない
+    fetch_horses_pipelined(horses, on_result, fetched_after=ready, skip_unchanged=True,
+                           max_in_flight=max_in_flight, parse_workers=parse_workers)
+    return len(to_fetch), len(skipped), added
+
+
+def backfill_field(df, store, max_in_flight=MAX_IN_FLIGHT, force=False, parse_workers=None):
+    """出馬表の全馬の全成績をストアへ取り込む（バックフィル）
+
+    取り込み済みの馬は force=True でなければ飛ばす（途中で落ちても続きから再開できる）。
+    一度取り込んだ馬は、その後 refresh_field_incremental で新しい成績だけを足せばよい。
+    (取り込んだ頭数, 飛ばした頭数, 登録した行数) を返す。
+
+    ページの取得とパースは別の段で並列に行い、終わったら各段の速さを表示する。
+    """
+    urls = dict(zip(df["馬名"], df["horse_url"]))
+    ids = horse_netkeiba_ids(df)
+    done = set() if force else store.backfilled(list(urls), ids)
+    if done:
+        print(f"⏩ 全成績を取り込み済みの{len(done)}頭をスキップします")
+
+    cache = get_response_cache()
+    fetched = added = 0
+
+    def on_result(horse_name, races, status):
+        nonlocal fetched, added
+        if not races:
+            # 取れなかった馬は取り込み済みにしない（次回また取りに行く）
+            return
+        meta = cache.lookup(urls[horse_name]) or {}
+        with span("write.store"):
+            added += store.backfill_results(
+                horse_name, races, checked_at=meta.get("fetched_at", time.time()), netkeiba_id=ids.get(horse_name))
+        fetched += 1
+
+    horses = [(name, url) for name, url in urls.items() if name not in done]
+    stats = fetch_horses_pipelined(horses, on_result, limit=None,
+                                   max_in_flight=max_in_flight, parse_workers=parse_workers)
+    if horses:
+        print("📊 馬ページ")
+        print(stats.report())
+    return fetched, len(done), added
 
 
 # ==============================
 # メイン処理
 # ==============================
-def main():
-    race_id = input("取得したいレースIDを入力（例：202405040811）: ").strip()
+def run(race_id):
     df = fetch_syutubahyo_selenium(race_id)
     if df.empty:
         return
 
-    all_races = []
-    for _, row in df.iterrows():
-        horse_name = row["馬名"]
-        horse_url = row["horse_url"]
-        print(f"🐎 {horse_name} の近5走を取得中...")
-        races = fetch_past_5races(horse_url, horse_name)
-        all_races.extend(races)
+    if "--backfill" in sys.argv[1:]:
+        # 近5走に切り詰めず、各馬の全成績をストアへ取り込む
+        store = RaceStore()
+        with span("write.store"):
+            store.upsert_entries(race_id, df)
+        fetched, skipped, added = backfill_field(df, store)
+        print(f"✅ {fetched}頭の全成績を取り込み（{skipped}頭は取り込み済み）・{added}件登録 → {store.path}")
+        return
+
+    if "--incremental" in sys.argv[1:]:
+        # ストアにある近走を差分だけ更新し、CSVはストアから書き出す
+        store = RaceStore()
+        with span("write.store"):
+            store.upsert_entries(race_id, df)
+        fetched, skipped, added = refresh_field_incremental(df, store)
+        with span("write.csv"):
+            store.recent_results(df["馬名"], n=5, netkeiba_ids=horse_netkeiba_ids(df)).to_csv(
+                "data/race_data_auto.csv", index=False, encoding="utf-8-sig")
+        print(f"✅ {fetched}頭を確認・{skipped}頭をスキップ・{added}件追加 → data/race_data_auto.csv")
+        return
 
-    race_df = pd.DataFrame(all_races)
-    race_df.to_csv("data/race_data_auto.csv", index=False, encoding="utf-8-sig")
+    # 1頭ごとに data/checkpoints/<race_id>/ へ追記し、最後にCSVへまとめる
+    writer = checkpoint_for_race(race_id)
+    fetch_field_past_races(df, race_id, writer)
+    writer.export_csv("data/race_data_auto.csv", order=df["馬名"].tolist())
+    with span("write.store"):
+        save_fetched_race(RaceStore(), race_id, df, list(writer.iter_rows()))
     print("✅ 全馬の過去5走を保存しました → data/race_data_auto.csv")
 
 
+def main():
+    race_id = input("取得したいレースIDを入力（例：202405040811）: ").strip()
+    # --profile なら data/metrics/fetch_race.pstats に cProfile の結果を書き出す
+    profile = timing.METRICS_DIR / "fetch_race.pstats" if "--profile" in sys.argv[1:] else None
+    try:
+        with timing.profiled(profile):
+            run(race_id)
+    finally:
+        # 各段の時間を data/metrics/fetch_race.json / .prom に書き出す
+        summary = timing.format_summary()
+        if summary:
+            print(summary)
+            paths = timing.write_metrics("fetch_race", race_id=race_id)
+            print("📊 " + " / ".join(str(p) for p in paths))
+
+
 if __name__ == "__main__":
     main()
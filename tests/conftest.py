@@ -0,0 +1,84 @@
+"""テスト共通：ローカルのスタブHTTPサーバー（utils.http_client / http_cache / pipeline のテストで使う）"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from utils import http_client
+from utils.http_client import RequestScheduler, ScheduledSession
+
+# スタブサーバーへのリクエストで流量制御に待たされないポリシー
+FAST_POLICY = {"rate": 1000.0, "burst": 1000, "max_concurrency": 8}
+
+
+class StubServer:
+    """パスごとに、返す応答 (ステータス, ヘッダー, 遅延秒[, 本文]) を順に使うHTTPサーバー
+
+    用意した応答を使い切ったら最後のものを返し続ける。同時に処理していた数の最大も数える。
+    受け取ったリクエストヘッダーは requests に順に残す。
+    """
+
+    def __init__(self):
+        self.responses = {}
+        self.hits = {}
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._lock:
+                    queue = stub.responses.get(self.path, [(200, {}, 0)])
+                    status, headers, delay, *body = queue.pop(0) if len(queue) > 1 else queue[0]
+                    stub.hits[self.path] = stub.hits.get(self.path, 0) + 1
+                    stub.requests.append((self.path, dict(self.headers)))
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                try:
+                    time.sleep(delay)
+                    # 304 は本文を付けない
+                    body = b"" if status == 304 else (body[0] if body else "ok").encode("utf-8")
+                    self.send_response(status)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # クライアントがタイムアウトで切った
+                    pass
+                finally:
+                    with stub._lock:
+                        stub.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def respond(self, path, *responses):
+        self.responses[path] = list(responses)
+        return self.url + path
+
+
+@pytest.fixture
+def server():
+    stub = StubServer()
+    thread = threading.Thread(target=stub.httpd.serve_forever, daemon=True)
+    thread.start()
+    yield stub
+    stub.httpd.shutdown()
+    stub.httpd.server_close()
+
+
+@pytest.fixture
+def session(monkeypatch):
+    # バックオフは待たない（Retry-After の分だけ待つ）。下げる間隔も空けない
+    monkeypatch.setattr(http_client, "backoff_delay", lambda attempt, *args, **kwargs: 0.0)
+    monkeypatch.setattr(http_client, "COOLDOWN_SECONDS", 0.0)
+    return ScheduledSession(RequestScheduler(policies={}, default=FAST_POLICY), max_retries=2)
@@ -0,0 +1,28 @@
+"""utils.data_loader の近走CSVの取り込み（列数の合わない行の隔離）"""
+import csv
+
+import pandas as pd
+
+from utils.data_loader import RACE_JP23_COLUMNS, ingest_race_csv
+
+ROW = ["イクイノックス", "2023/11/26", "ジャパンC", "G1", "18", "1", "2", "ルメール", "58",
+       "2400", "良", "2:21.8", "1", "1", "1-1", "33.5", "M", "0.7"]
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(RACE_JP23_COLUMNS)
+        writer.writerows(rows)
+
+
+def test_short_and_long_rows_are_quarantined(tmp_path):
+    path, quarantine = tmp_path / "race.csv", tmp_path / "bad.csv"
+    # 2行目は列が足りない、4行目は多すぎる。最後の列が空なだけの行は残す
+    write_csv(path, [ROW, ROW[:10], ROW[:-1] + [""], ROW + ["余り"], ["ドウデュース"] + ROW[1:]])
+
+    df = ingest_race_csv(path, quarantine_path=quarantine, typed=False)
+    assert df["馬名"].tolist() == ["イクイノックス", "イクイノックス", "ドウデュース"]
+    assert df.attrs["bad_lines"] == 2
+    bad = pd.read_csv(quarantine, encoding="utf-8-sig")
+    assert bad["行番号"].tolist() == [3, 5]
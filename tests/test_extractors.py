@@ -0,0 +1,37 @@
+"""utils.extractors の近走の抽出"""
+import pytest
+
+from utils import extractors
+from utils.extractors import extract_past_races
+
+RESULT_PAGE = (
+    "<html><table>"
+    "<tr><th>日付</th><th>開催</th><th>R</th><th>レース名</th><th>着順</th><th>騎手</th><th>距離</th></tr>"
+    '<tr><td>2024/05/04</td><td>2東京3</td><td>2</td><td><a href="/race/202405020302/">3歳未勝利</a></td>'
+    "<td>1</td><td>武豊</td><td>芝1600</td></tr>"
+    "</table></html>"
+)
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(
+        extractors, "_strategy_stats", {name: {"ok": 0, "ng": 0} for name in extractors.PAST_RACE_STRATEGIES})
+
+
+def test_strategies_are_not_dropped_before_any_success():
+    # 取得の最初にエラーページが続いても、どの方法も外さない
+    for _ in range(extractors.SKIP_AFTER_FAILURES + 5):
+        assert extract_past_races("<html><body>エラー</body></html>", "A") == ([], None)
+    races, strategy = extract_past_races(RESULT_PAGE, "A")
+    assert strategy == "table"
+    assert races[0]["レースID"] == "202405020302"
+    assert races[0]["クラス"] == "未勝利"
+
+
+def test_failing_strategy_is_skipped_once_another_succeeds():
+    extract_past_races(RESULT_PAGE, "A")
+    for _ in range(extractors.SKIP_AFTER_FAILURES):
+        extract_past_races("<html></html>", "A")
+    assert "table" in extractors._ordered_strategies()
+    assert "next_data" not in extractors._ordered_strategies()
@@ -0,0 +1,23 @@
+"""utils.http_cache の条件付きリクエスト（ローカルのスタブサーバーに投げる）"""
+from utils.http_cache import ResponseCache
+
+
+def test_not_modified_reuses_cached_body(tmp_path, server, session):
+    cache = ResponseCache(tmp_path)
+    url = server.respond("/page", (200, {"ETag": '"v1"'}, 0, "本文"), (304, {}, 0))
+    assert cache.fetch_with_status(url, session, ttl=-1) == ("本文", "fetched")
+    assert cache.fetch_with_status(url, session, ttl=-1) == ("本文", "not_modified")
+    assert server.requests[-1][1].get("If-None-Match") == '"v1"'
+
+
+def test_not_modified_without_cached_body_fetches_again(tmp_path, server, session):
+    cache = ResponseCache(tmp_path)
+    url = server.respond("/page", (200, {"ETag": '"v1"'}, 0, "本文"), (304, {}, 0), (200, {}, 0, "新しい本文"))
+    cache.fetch_with_status(url, session, ttl=-1)
+    # メタ情報だけが残り、本文が消えている
+    for obj in (tmp_path / "objects").glob("*/*.gz"):
+        obj.unlink()
+
+    assert cache.fetch_with_status(url, session, ttl=-1) == ("新しい本文", "fetched")
+    assert "If-None-Match" not in server.requests[-1][1]
+    assert cache.get(url, allow_stale=True) == "新しい本文"
@@ -0,0 +1,133 @@
+"""utils.http_client の再試行と流量制御（ローカルのスタブサーバーに投げる）"""
+import multiprocessing
+import threading
+import time
+
+import pytest
+import requests
+
+from tests.conftest import FAST_POLICY
+from utils import http_client
+from utils.http_client import HostLimiter, RequestScheduler, ScheduledSession
+
+
+# ==============================
+# 再試行
+# ==============================
+def test_retries_429_after_retry_after(server, session):
+    url = server.respond("/limited", (429, {"Retry-After": "1"}, 0), (200, {}, 0))
+    started = time.monotonic()
+    res = session.get(url)
+    assert res.status_code == 200
+    assert time.monotonic() - started >= 1.0
+    limiter = session.scheduler.limiter(url)
+    assert limiter.stats == {"requests": 2, "retries": 1, "throttled": 1, "errors": 0}
+    # 429で rate を半分にしてから、成功で少し戻す
+    assert limiter.rate < FAST_POLICY["rate"]
+
+
+def test_retries_5xx_until_success(server, session):
+    url = server.respond("/flaky", (503, {}, 0), (502, {}, 0), (200, {}, 0))
+    assert session.get(url).status_code == 200
+    assert server.hits["/flaky"] == 3
+    assert session.scheduler.limiter(url).stats["retries"] == 2
+
+
+def test_gives_up_after_max_retries(server, session):
+    url = server.respond("/down", (500, {}, 0))
+    assert session.get(url).status_code == 500
+    assert server.hits["/down"] == session.max_retries + 1
+
+
+def test_timeout_is_retried_then_raised(server, session):
+    url = server.respond("/slow", (200, {}, 1.0))
+    with pytest.raises(requests.Timeout):
+        session.get(url, timeout=0.2)
+    stats = session.scheduler.limiter(url).stats
+    assert stats["errors"] == session.max_retries + 1
+    assert stats["retries"] == session.max_retries
+
+
+# ==============================
+# 同時実行数（AIMD）
+# ==============================
+def test_aimd_raises_limit_on_success_and_cuts_on_errors(monkeypatch):
+    monkeypatch.setattr(http_client, "COOLDOWN_SECONDS", 0.0)
+    limiter = HostLimiter(rate=1000.0, burst=1000, max_concurrency=8)
+    assert limiter.limit == 4
+
+    for _ in range(40):
+        limiter.acquire()
+        limiter.release(0.1, status=200)
+    assert limiter.limit == 8
+
+    # いつもの SLOW_FACTOR 倍を超える応答が続くと下げる
+    for _ in range(5):
+        limiter.acquire()
+        limiter.release(1.0, status=200)
+    assert limiter.limit < 8
+    assert limiter.rate == 1000.0
+
+    # 429 で同時実行数も rate も半分
+    before = limiter.limit
+    limiter.acquire()
+    limiter.release(status=429, retry=True)
+    assert limiter.limit == max(1.0, before / 2)
+    assert limiter.rate == 500.0
+
+
+def test_cut_only_once_per_cooldown():
+    limiter = HostLimiter(rate=10.0, burst=10, max_concurrency=8)
+    for _ in range(3):
+        limiter.acquire()
+    for _ in range(3):
+        limiter.release(status=503, retry=True)
+    assert limiter.limit == 2
+
+
+def test_rate_limit_spaces_requests():
+    limiter = HostLimiter(rate=20.0, burst=1, max_concurrency=1)
+    started = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+        limiter.release(0.01, status=200)
+    # 最初の1件はバケットの分、残り4件は 1/20 秒ずつ
+    assert time.monotonic() - started >= 4 / 20 * 0.9
+
+
+# ==============================
+# プロセス間の同時実行数
+# ==============================
+def test_share_between_processes_keeps_host_concurrency(monkeypatch):
+    monkeypatch.setattr(http_client, "_scheduler", None)
+    slots = http_client.shared_slots()
+    http_client.share_between_processes(6, slots)
+    limiter = http_client.get_scheduler().limiter("https://race.netkeiba.com/race/shutuba.html")
+    assert limiter.shared is slots["race.netkeiba.com"]
+    assert limiter.max_concurrency == 4
+    assert limiter.rate == pytest.approx(2.0 / 6)
+
+
+def _fetch_many(url, slots, n):
+    """別プロセスで n 本のスレッドから同時に取得する"""
+    scheduler = RequestScheduler(policies={}, default=FAST_POLICY, shared=slots)
+    session = ScheduledSession(scheduler)
+    threads = [threading.Thread(target=session.get, args=(url,)) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_shared_slots_cap_concurrency_across_processes(server):
+    url = server.respond("/page", (200, {}, 0.2))
+    cap = 3
+    slots = {None: multiprocessing.BoundedSemaphore(cap)}
+    workers = [multiprocessing.Process(target=_fetch_many, args=(url, slots, 4)) for _ in range(3)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join(timeout=30)
+        assert p.exitcode == 0
+    assert server.hits["/page"] == 12
+    assert server.max_active <= cap
@@ -0,0 +1,41 @@
+"""utils.incremental の差分更新で取りに行く馬の選び方"""
+import datetime as dt
+
+import pandas as pd
+
+from utils.incremental import MAX_SKIP_DAYS, plan_refresh
+from utils.race_store import RaceStore
+
+# 日曜の夜に確認し、次の日曜（成績が出そろった後）に更新する
+CHECKED = dt.datetime(2024, 5, 5, 23, 0).timestamp()
+NOW = dt.datetime(2024, 5, 12, 23, 0).timestamp()
+
+
+def entries(*names):
+    return pd.DataFrame({"馬名": list(names), "馬番": range(1, len(names) + 1), "日付": "2024/05/11"})
+
+
+def test_skips_horses_that_did_not_run_since_the_check(tmp_path):
+    store = RaceStore(tmp_path / "keiba.db")
+    for name in ("走った馬", "休んだ馬"):
+        store.upsert_results(pd.DataFrame([{"馬名": name, "日付": "2024/04/28", "レース名": "未勝利", "着順": 2}]))
+        store.mark_checked(name, CHECKED)
+    # 5/11 の出馬表はストアにある。「走った馬」だけが出ていた
+    store.upsert_entries("202405020101", entries("走った馬", "別の馬"))
+
+    to_fetch, skipped = plan_refresh(store, ["走った馬", "休んだ馬", "初めての馬"], now=NOW)
+    assert to_fetch == ["走った馬", "初めての馬"]
+    assert skipped == ["休んだ馬"]
+
+    # 確認から日が経ちすぎた馬は取りに行く
+    later = NOW + MAX_SKIP_DAYS * 86400
+    assert plan_refresh(store, ["休んだ馬"], now=later)[0] == ["休んだ馬"]
+
+
+def test_fetches_when_no_race_day_is_known(tmp_path):
+    store = RaceStore(tmp_path / "keiba.db")
+    store.upsert_results(pd.DataFrame([{"馬名": "A", "日付": "2024/04/28", "レース名": "未勝利", "着順": 2}]))
+    store.mark_checked("A", CHECKED)
+    assert plan_refresh(store, ["A"], now=NOW) == (["A"], [])
+    # 成績が出そろった後に確認済みなら飛ばす
+    assert plan_refresh(store, ["A"], now=CHECKED + 3600) == ([], ["A"])
@@ -0,0 +1,45 @@
+"""馬ページの 取得 → パース → 書き込み のパイプライン（ローカルのスタブサーバーに投げる）"""
+import pytest
+
+import fetch_race
+from utils.http_cache import ResponseCache
+
+HORSE_PAGE = (
+    "<html><head><title>{name} (Horse) | 競走馬データ - netkeiba</title></head><table>"
+    "<tr><th>日付</th><th>開催</th><th>R</th><th>レース名</th><th>着順</th><th>騎手</th><th>距離</th></tr>"
+    '<tr><td>2024/05/04</td><td>2東京3</td><td>2</td><td><a href="/race/202405020302/">3歳未勝利</a></td>'
+    "<td>{finish}</td><td>武豊</td><td>芝1600</td></tr>"
+    "</table></html>"
+)
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path / "http_cache")
+    monkeypatch.setattr(fetch_race, "get_response_cache", lambda: cache)
+    return cache
+
+
+@pytest.mark.parametrize("parse_workers", [0, 2])
+def test_pipeline_fetches_parses_and_writes_each_horse(server, session, cache, parse_workers):
+    horses = [
+        (name, server.respond(f"/horse/{i}/", (200, {}, 0, HORSE_PAGE.format(name=name, finish=i))))
+        for i, name in enumerate(["イクイノックス", "リバティアイランド", "ドウデュース"], start=1)
+    ]
+    horses.append(("エラー", server.respond("/horse/9/", (500, {}, 0))))
+
+    written = {}
+    stats = fetch_race.fetch_horses_pipelined(
+        horses, lambda name, races, status: written.setdefault(name, (races, status)),
+        session=session, parse_workers=parse_workers)
+
+    assert set(written) == {name for name, _ in horses}
+    for i, (name, _) in enumerate(horses[:3], start=1):
+        races, status = written[name]
+        assert status == "fetched"
+        assert [(r["馬名"], r["着順"], r["レースID"]) for r in races] == [(name, str(i), "202405020302")]
+    assert written["エラー"] == ([], "error")
+    assert stats.download.count == 4 and stats.download.failed == 1
+    assert stats.write.count == 4
+    # 取れたページはキャッシュに入る
+    assert cache.get(horses[0][1]) is not None
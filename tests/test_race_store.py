@@ -0,0 +1,65 @@
+"""utils.race_store の馬の見分け方（netkeibaのID → 馬名の順）"""
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from utils.race_store import RaceStore
+
+OLD_ID, NEW_ID = 1985104215, 2021100001
+
+
+def result_row(date, race_id, horse_id):
+    return {"馬名": "オグリキャップ", "日付": date, "レース名": "3歳未勝利", "レースID": race_id,
+            "horse_id": horse_id, "着順": 1}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return RaceStore(tmp_path / "keiba.db")
+
+
+def test_same_name_horses_are_kept_apart(store):
+    store.upsert_results(pd.DataFrame([result_row("1988/05/04", "198805020302", OLD_ID)]))
+    store.upsert_results(pd.DataFrame([result_row("2024/05/04", "202405020302", NEW_ID)]))
+
+    old = store.recent_results(["オグリキャップ"], netkeiba_ids={"オグリキャップ": OLD_ID})
+    new = store.recent_results(["オグリキャップ"], netkeiba_ids={"オグリキャップ": NEW_ID})
+    assert old["日付"].tolist() == ["1988/05/04"]
+    assert new["日付"].tolist() == ["2024/05/04"]
+    # IDが分からなければ最近走った方
+    assert store.recent_results(["オグリキャップ"])["horse_id"].tolist() == [NEW_ID]
+    # まだ取っていない同名の馬は、昔の馬の成績を引き継がない
+    assert store.sync_state(["オグリキャップ"], {"オグリキャップ": 2022100002}) == {}
+
+
+def test_name_only_horse_takes_the_first_id(store):
+    store.upsert_results(pd.DataFrame([{"馬名": "ナナシ", "日付": "2024/05/04", "レース名": "新馬", "着順": 3}]))
+    ids = store.upsert_horses(["ナナシ"], netkeiba_ids={"ナナシ": NEW_ID})
+    assert store.horse_ids(["ナナシ"], {"ナナシ": NEW_ID}) == ids
+    assert store.result_counts(["ナナシ"], {"ナナシ": NEW_ID}) == {"ナナシ": 1}
+
+
+def test_migrates_unique_horse_names(tmp_path):
+    path = tmp_path / "old.db"
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE horses (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, url TEXT, netkeiba_id INTEGER);
+        INSERT INTO horses VALUES (7, 'オグリキャップ', NULL, 1985104215);
+    """)
+    conn.close()
+
+    store = RaceStore(path)
+    store.upsert_results(pd.DataFrame([result_row("2024/05/04", "202405020302", NEW_ID)]))
+    rows = store.connect().execute("SELECT id, netkeiba_id FROM horses ORDER BY id").fetchall()
+    assert rows[0] == (7, OLD_ID)
+    assert rows[1][1] == NEW_ID
+    assert store.connect().execute("PRAGMA foreign_keys").fetchone() == (1,)
+
+
+def test_marks_go_to_the_horse_with_the_id(store):
+    store.upsert_results(pd.DataFrame([result_row("1988/05/04", "198805020302", OLD_ID)]))
+    store.upsert_marks({"オグリキャップ": "◎"}, race_key="R1", netkeiba_ids={"オグリキャップ": NEW_ID})
+    assert store.marks(race_key="R1") == {"オグリキャップ": "◎"}
+    marked = store.connect().execute("SELECT h.netkeiba_id FROM marks m JOIN horses h ON h.id = m.horse_id")
+    assert marked.fetchall() == [(NEW_ID,)]
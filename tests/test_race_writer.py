@@ -0,0 +1,29 @@
+"""utils.race_writer の途中で落ちた後の再開"""
+import json
+
+from utils.race_writer import CheckpointWriter
+
+
+def test_uncommitted_rows_are_dropped_on_reopen(tmp_path):
+    writer = CheckpointWriter(tmp_path)
+    writer.write_horse("R1", "A", [{"馬名": "A", "着順": 1}])
+    # B の行を書き終えたが、確定行を書く前に落ちた
+    with open(writer.rows_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"race_id": "R1", "馬名": "B", "着順": 2}, ensure_ascii=False) + "\n")
+
+    writer = CheckpointWriter(tmp_path)
+    assert not writer.is_done("R1", "B")
+    writer.write_horse("R1", "C", [{"馬名": "C", "着順": 3}])
+    writer.write_horse("R1", "B", [{"馬名": "B", "着順": 2}])
+    assert [row["馬名"] for row in writer.iter_rows()] == ["A", "C", "B"]
+
+
+def test_partial_last_line_is_dropped_on_reopen(tmp_path):
+    writer = CheckpointWriter(tmp_path)
+    writer.write_horse("R1", "A", [{"馬名": "A", "着順": 1}])
+    with open(writer.rows_path, "a", encoding="utf-8") as f:
+        f.write('{"race_id": "R1", "馬名": "B", "着')
+
+    writer = CheckpointWriter(tmp_path)
+    writer.write_horse("R1", "B", [{"馬名": "B", "着順": 2}])
+    assert [row["馬名"] for row in writer.iter_rows()] == ["A", "B"]
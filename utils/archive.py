@@ -0,0 +1,209 @@
+"""全期間の近走を列指向のファイル（Arrow IPC）にまとめて持つ
+
+CSVは pd.read_csv のたびにプロセスごとに全体をコピーするが、ここで書くファイルは
+メモリマップで開くので、複数のプロセスで開いても中身はOSのページキャッシュを共有し、
+開くだけではデータを読まない。
+
+- 馬名順（同じ馬は新しい順）に並べて、ROW_GROUP_ROWS 行ずつのバッチ（行グループ）に分ける
+- バッチごとの馬名・日付の範囲をファイルのメタデータに持ち、指定した馬や期間を
+  含まないバッチは読まない。列も指定した分だけを取り出す
+
+    python -m utils.archive build [CSV ...]   # 既定は data/race_jp23_data.csv とストア（data/keiba.db）
+
+取得したレース（data/races/*/race_data.csv）は列構成が違うので、CSVではなく取り込み先のストアから読む
+（RaceStore.query_results の形を apply_result_schema で同じ型にそろえる）。
+
+pyarrow が無い環境では使えない（ARCHIVE_AVAILABLE が False）。
+"""
+import json
+import os
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+from utils.ids import KEY_COLUMNS, add_key_columns
+from utils.schema import RACE_CATEGORY_COLUMNS, apply_result_schema
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.ipc
+except ImportError:  # pyarrow はアーカイブを使うときだけ必要
+    pa = None
+
+ARCHIVE_AVAILABLE = pa is not None
+ARCHIVE_PATH = Path("data/archive/race_results.arrow")
+
+# 1バッチの行数（馬の絞り込みで読むのは、その馬を含むバッチだけ）
+ROW_GROUP_ROWS = 8192
+
+# バッチごとの範囲を入れるメタデータのキー
+_BATCHES_KEY = b"keiba.batches"
+# 期間の絞り込み用の列（日付を日付型にしたもの。読み出す列には含めない）
+_DATE_COL = "_date"
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("近走アーカイブには pyarrow が必要です（pip install pyarrow）")
+
+
+def _iso(value):
+    return None if pd.isna(value) else value.strftime("%Y-%m-%d")
+
+
+# ==============================
+# 書き出し
+# ==============================
+def write_archive(df: pd.DataFrame, path=ARCHIVE_PATH, row_group_rows: int = ROW_GROUP_ROWS):
+    """近走（ingest_race_csv の形）をアーカイブに書く。書いた行数を返す
+
+    プロセス内でしか通用しない整数キー（horse_key など）は書かず、読むときに付け直す。
+    一時ファイルに書いてから置き換えるので、開いているプロセスは古いファイルを読み続けられる。
+    """
+    _require_pyarrow()
+    path = Path(path)
+    df = df.drop(columns=[key_col for key_col, _ in KEY_COLUMNS.values() if key_col in df.columns])
+    dates = pd.to_datetime(df["日付"], errors="coerce") if "日付" in df.columns else pd.Series(pd.NaT, index=df.index)
+    df = df.assign(**{_DATE_COL: dates.dt.date})
+    order = pd.DataFrame({"name": df["馬名"].astype(str), "date": dates}).sort_values(
+        ["name", "date"], ascending=[True, False], kind="stable", na_position="last"
+    ).index
+    df = df.loc[order].reset_index(drop=True)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    batches = table.to_batches(max_chunksize=row_group_rows)
+    ranges, start = [], 0
+    for batch in batches:
+        names = df["馬名"].iloc[start:start + batch.num_rows].astype(str)
+        batch_dates = dates.loc[order].iloc[start:start + batch.num_rows]
+        ranges.append({
+            "first": names.iloc[0], "last": names.iloc[-1], "rows": batch.num_rows,
+            "min_date": _iso(batch_dates.min()), "max_date": _iso(batch_dates.max()),
+        })
+        start += batch.num_rows
+    schema = table.schema.with_metadata({**(table.schema.metadata or {}), _BATCHES_KEY: json.dumps(ranges)})
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    # 圧縮しない（圧縮するとメモリマップのまま読めず、開くたびに展開が必要になる）
+    with pa.OSFile(str(tmp), "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch.replace_schema_metadata(schema.metadata))
+    os.replace(tmp, path)
+    return len(df)
+
+
+def build_archive(csv_paths, path=ARCHIVE_PATH, row_group_rows: int = ROW_GROUP_ROWS, store=None):
+    """近走CSV（race_jp23_data.csv の形）とストアの成績をまとめてアーカイブにする
+
+    store … utils.race_store.RaceStore（取得したレースはここに入っている）。
+    同じ馬・日付・レースの行は1つにする（ストアの行を優先する）。
+    """
+    from utils.data_loader import ingest_race_csv
+
+    frames = []
+    if store is not None:
+        results = store.query_results()
+        if len(results):
+            frames.append(apply_result_schema(results))
+    for csv_path in csv_paths:
+        try:
+            frames.append(ingest_race_csv(csv_path, typed=True))
+        except ValueError as e:
+            # 列構成の違うCSV（取得途中の形式など）は飛ばす
+            print(f"⚠️ {e}")
+    if not frames:
+        raise ValueError("取り込める近走がありません")
+    df = pd.concat(frames, ignore_index=True)
+    df = df.drop_duplicates(subset=[c for c in ("馬名", "日付", "レース名") if c in df.columns])
+    for col in RACE_CATEGORY_COLUMNS:
+        if col in df.columns:
+            # CSVごとにカテゴリが違うと concat で文字列に戻るので揃え直す
+            df[col] = df[col].astype("category")
+    return write_archive(df, path, row_group_rows)
+
+
+# ==============================
+# 読み込み
+# ==============================
+class RaceArchive:
+    """アーカイブをメモリマップで開く（開くだけではデータを読まない）
+
+    read() は指定した馬・期間を含むバッチの、指定した列だけを取り出す。
+    """
+
+    def __init__(self, path=ARCHIVE_PATH):
+        _require_pyarrow()
+        self.path = Path(path)
+        self._source = pa.memory_map(str(self.path), "r")
+        self._reader = pa.ipc.open_file(self._source)
+        metadata = self._reader.schema.metadata or {}
+        self.batches = json.loads(metadata.get(_BATCHES_KEY, b"[]"))
+        self.columns = [c for c in self._reader.schema.names if c != _DATE_COL]
+
+    def __len__(self):
+        return sum(b["rows"] for b in self.batches)
+
+    def close(self):
+        self._source.close()
+
+    def _batch_ids(self, names=None, date_from=None, date_to=None):
+        for i, b in enumerate(self.batches):
+            if names is not None and not any(b["first"] <= name <= b["last"] for name in names):
+                continue
+            if date_from and b["max_date"] and b["max_date"] < date_from:
+                continue
+            if date_to and b["min_date"] and b["min_date"] > date_to:
+                continue
+            yield i
+
+    def read(self, columns=None, horses=None, date_from=None, date_to=None) -> pd.DataFrame:
+        """近走を取り出す（馬名順、同じ馬は新しい順）。horse_key などの整数キーの列も付ける
+
+        columns … 取り出す列（既定は全列）
+        horses … 馬名のリスト（既定は全馬）
+        date_from / date_to … 'YYYY-MM-DD'（両端を含む）
+        """
+        names = None if horses is None else sorted({str(h) for h in horses})
+        date_from = date_from and pd.Timestamp(date_from).strftime("%Y-%m-%d")
+        date_to = date_to and pd.Timestamp(date_to).strftime("%Y-%m-%d")
+        columns = list(columns or self.columns)
+        wanted = columns + [c for c in ("馬名", _DATE_COL) if c not in columns]
+        batches = [self._reader.get_batch(i).select(wanted) for i in self._batch_ids(names, date_from, date_to)]
+        if not batches:
+            return add_key_columns(self._empty(columns))
+
+        table = pa.Table.from_batches(batches)
+        mask = None
+        if names is not None:
+            mask = pc.is_in(pc.cast(table["馬名"], pa.string()), value_set=pa.array(names, pa.string()))
+        for op, value in ((pc.greater_equal, date_from), (pc.less_equal, date_to)):
+            if value:
+                cond = op(table[_DATE_COL], pa.scalar(pd.Timestamp(value).date(), pa.date32()))
+                mask = cond if mask is None else pc.and_(mask, cond)
+        if mask is not None:
+            table = table.filter(mask)
+        return add_key_columns(table.select(columns).to_pandas())
+
+    def _empty(self, columns):
+        return self._reader.schema.empty_table().select(columns).to_pandas()
+
+    def horse_counts(self, horses):
+        """{馬名: 成績の件数}（馬名の列だけを読む）"""
+        names = self.read(columns=["馬名"], horses=horses)["馬名"].astype(str)
+        counts = names.value_counts()
+        return {str(h): int(counts.get(str(h), 0)) for h in horses}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["build"]:
+        from utils.race_store import DB_PATH, RaceStore
+
+        sources = [Path(p) for p in sys.argv[2:]] or [Path("data/race_jp23_data.csv")]
+        store = RaceStore(DB_PATH) if DB_PATH.exists() else None
+        n_rows = build_archive([p for p in sources if p.exists()], store=store)
+        print(f"✅ 近走{n_rows}件を {ARCHIVE_PATH} に書き出しました")
+    else:
+        print(__doc__)
@@ -0,0 +1,182 @@
+import atexit
+import queue
+import threading
+from contextlib import contextmanager
+
+import requests
+
+from utils.http_cache import get_response_cache
+from utils.http_client import get_scheduler, get_shared_session
+from utils.timing import span, timed
+
+# ==============================
+# ヘッドレスChromeの使い回し
+# ==============================
+# ChromeDriverManager().install() はバージョン確認に通信するので1プロセス1回にする
+_driver_path = None
+_driver_path_lock = threading.Lock()
+
+
+def _chromedriver_path():
+    global _driver_path
+    with _driver_path_lock:
+        if _driver_path is None:
+            from webdriver_manager.chrome import ChromeDriverManager
+            _driver_path = ChromeDriverManager().install()
+        return _driver_path
+
+
+@timed("browser.startup")
+def _new_driver(headless: bool = True):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+
+    options = Options()
+    if headless:
+        options.add_argument("--headless=new")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    # 画像や広告の読み込み完了は待たない（DOMができた時点で get() から戻る）
+    options.page_load_strategy = "eager"
+    return webdriver.Chrome(service=Service(_chromedriver_path()), options=options)
+
+
+class BrowserPool:
+    """起動済みのChromeを貯めておき、レースIDをまたいで使い回す
+
+    ドライバーは必要になったときに size 台まで起動し、close() まで終了しない。
+    エラーを起こしたドライバーは捨てて、次に必要になったときに起動し直す。
+    """
+
+    def __init__(self, size: int = 1, headless: bool = True):
+        self.size = size
+        self.headless = headless
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._all = []
+
+    @contextmanager
+    def driver(self):
+        driver = self._acquire()
+        try:
+            yield driver
+        except Exception:
+            self._discard(driver)
+            raise
+        else:
+            self._idle.put(driver)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if not can_create:
+            return self._idle.get()
+        try:
+            driver = _new_driver(self.headless)
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+        with self._lock:
+            self._all.append(driver)
+        return driver
+
+    def _discard(self, driver):
+        with self._lock:
+            self._created -= 1
+            if driver in self._all:
+                self._all.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def render(self, url, ready_css, timeout: float = 15):
+        """URLを開き、ready_css の要素が現れた時点のHTMLを返す（固定のsleepはしない）"""
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        # ブラウザでのアクセスも requests と同じホストごとの流量制御に入れる
+        with self.driver() as driver, get_scheduler().slot(url):
+            with span("browser.page_wait"):
+                driver.get(url)
+                try:
+                    WebDriverWait(driver, timeout).until(
+                        EC.presence_of_element_located((By.CSS_SELECTOR, ready_css))
+                    )
+                except TimeoutException:
+                    print(f"⚠️ {ready_css} の表示を待機しましたが、要素が見つかりませんでした。")
+            return driver.page_source
+
+    def close(self):
+        with self._lock:
+            drivers, self._all = self._all, []
+            self._created = 0
+        self._idle = queue.LifoQueue()
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_browser_pool(size: int = 1):
+    """プロセス共通のブラウザプール（プロセス終了時に自動で閉じる）"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BrowserPool(size=size)
+            atexit.register(_pool.close)
+        return _pool
+
+
+# ==============================
+# ブラウザなしの高速経路
+# ==============================
+def fetch_server_html(url, session=None, timeout=None):
+    """普通のHTTPでHTMLを取得する（失敗したらNone。timeout を省くと接続5秒・読み込み20秒）"""
+    try:
+        res = (session or get_shared_session()).get(url, timeout=timeout)
+        res.raise_for_status()
+    except requests.RequestException:
+        return None
+    if not res.encoding or res.encoding.lower() == "iso-8859-1":
+        res.encoding = res.apparent_encoding
+    return res.text
+
+
+def fetch_page_html(url, ready_css, marker, session=None, timeout: float = 15):
+    """出馬表ページのHTMLを一番安い方法で取得する
+
+    1. キャッシュにあればそれを返す
+    2. 普通のHTTPで取ったHTMLに必要なデータ（marker）が入っていればそれを使う
+    3. 入っていなければブラウザプールでJSを実行し、ready_css が現れるまで待つ
+    """
+    cache = get_response_cache()
+    html = cache.replay(url)
+    if html is not None:
+        print("💾 キャッシュから読み込みました")
+        return html
+
+    html = fetch_server_html(url, session=session)
+    if html is None or marker not in html:
+        print("🌐 ブラウザで描画します")
+        html = get_browser_pool().render(url, ready_css, timeout=timeout)
+
+    if marker in html:
+        cache.put(url, html)
+    return html
@@ -1,9 +1,382 @@
+import csv
+import os
+import threading
+import warnings
+from pathlib import Path
+from types import MappingProxyType
 import pandas as pd
+from utils.ids import add_key_columns
+from utils.schema import apply_entry_schema, apply_race_schema
 
-def load_shutsuba_data(file_path: str):
+
+# ==============================
+# 読み込みキャッシュ
+# ==============================
+# Streamlitは操作のたびにスクリプト全体を再実行するが、importしたモジュールは
+# プロセス内で使い回されるので、ここに置いたキャッシュは全セッションで共有される。
+# key -> ((mtime_ns, size), value)
+_cache = {}
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def cached_load(file_path, loader, *args, **kwargs):
+    """loader(path, *args, **kwargs) の結果を (パス, 更新時刻, サイズ) でキャッシュする
+
+    ファイルが変わっていなければディスクを読まずに前回の結果を返す。
+    返り値は全セッションで共有されるので、呼び出し側で書き換えないこと。
+    """
+    path = os.path.abspath(os.fspath(file_path))
+    key = (path, loader.__module__, loader.__qualname__, args, tuple(sorted(kwargs.items())))
+    return _cached(key, _file_signature(path), lambda: loader(path, *args, **kwargs))
+
+
+def _cached(key, signature, build):
+    """signature が前回と同じなら前回の値を、違えば build() の結果を返す"""
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached and cached[0] == signature:
+            _cache_stats["hits"] += 1
+            return cached[1]
+        _cache_stats["misses"] += 1
+
+    value = build()
+    with _cache_lock:
+        _cache[key] = (signature, value)
+    return value
+
+
+def get_cache_stats():
+    """キャッシュのヒット数・ミス数・保持件数を返す"""
+    with _cache_lock:
+        return {**_cache_stats, "entries": len(_cache)}
+
+
+def cache_items():
+    """キャッシュの (key, value) の一覧（メモリの内訳を出す用。値は書き換えないこと）"""
+    with _cache_lock:
+        return [(key, value) for key, (_, value) in _cache.items()]
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+        _cache_stats["hits"] = 0
+        _cache_stats["misses"] = 0
+
+
+def load_csv(file_path, **read_csv_kwargs):
+    """pd.read_csv のキャッシュ付き版（ファイルが変わったときだけ読み直す）"""
+    return cached_load(file_path, pd.read_csv, **read_csv_kwargs)
+
+
+def _read_shutsuba(path, typed):
+    df = pd.read_csv(path)
+    return add_key_columns(apply_entry_schema(df)) if typed else df
+
+
+def load_shutsuba_data(file_path: str, typed: bool = False):
+    """出馬表CSVを読み込む
+
+    typed=True なら馬番・人気・オッズなどを数値型に変換し、馬・騎手・調教師の
+    整数キー（horse_key など。utils.ids を参照）の列を足す。
+    """
     try:
-        df = pd.read_csv(file_path)
+        df = cached_load(file_path, _read_shutsuba, typed)
         return df
     except Exception as e:
         print(f"CSV読み込みエラー: {e}")
         return None
+
+
+# ==============================
+# 近走CSVの取り込み（高速パーサ＋不正行の隔離）
+# ==============================
+# race_jp23_data.csv の列構成
+RACE_JP23_COLUMNS = [
+    "馬名", "日付", "レース名", "クラス", "頭数", "枠番", "馬番", "騎手", "斤量",
+    "距離", "馬場", "タイム", "着順", "人気", "コーナー通過", "上り", "ペース", "着差",
+]
+
+
+def default_quarantine_path(file_path):
+    """data/xxx.csv → data/quarantine/xxx_bad_lines.csv"""
+    path = Path(file_path)
+    return path.parent / "quarantine" / f"{path.stem}_bad_lines.csv"
+
+
+def _read_lines(path, line_numbers):
+    """指定した行番号（1始まり）の生テキストを取り出す"""
+    wanted = set(line_numbers)
+    found = {}
+    with open(path, encoding="utf-8-sig", errors="replace") as f:
+        for no, line in enumerate(f, start=1):
+            if no in wanted:
+                found[no] = line.rstrip("\r\n")
+                if len(found) == len(wanted):
+                    break
+    return [(no, found.get(no, "")) for no in line_numbers]
+
+
+def _short_records(path, n_columns):
+    """列が足りないレコードの (DataFrame での位置, 行番号) のリスト
+
+    Cエンジンは列が足りない行を欠損で埋めて読んでしまうので、csv.reader で
+    レコードごとの列数を数え直す。空行と列が多すぎる行は DataFrame に入らないので位置を数えない。
+    """
+    short = []
+    position = 0
+    with open(path, newline="", encoding="utf-8-sig", errors="replace") as f:
+        reader = csv.reader(f)
+        next(reader, None)  # ヘッダー
+        start = reader.line_num + 1
+        for row in reader:
+            line_no, start = start, reader.line_num + 1
+            if not row or (len(row) == 1 and not row[0].strip()):
+                continue
+            if len(row) > n_columns:
+                continue
+            if len(row) < n_columns:
+                short.append((position, line_no))
+            position += 1
+    return short
+
+
+def _write_quarantine(quarantine_path, bad_lines):
+    quarantine_path = Path(quarantine_path)
+    if not bad_lines:
+        # 前回の隔離ファイルが残っていると紛らわしいので消しておく
+        if quarantine_path.exists():
+            quarantine_path.unlink()
+        return
+    quarantine_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(quarantine_path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(["行番号", "内容"])
+        writer.writerows(bad_lines)
+
+
+def ingest_race_csv(file_path, columns=None, quarantine_path=None, engine: str = "c", typed: bool = True):
+    """近走CSVを高速パーサで読み込み、列数の合わない行は隔離ファイルへ書き出す
+
+    typed=True なら utils.schema.apply_race_schema で省メモリな型に変換し、
+    馬・騎手の整数キー（horse_key, jockey_key）の列を足して返す。
+
+    engine="python" は遅いうえに不正行を黙って捨ててしまうので使わない。
+    Cエンジン（既定）は列が多すぎる行を警告付きで読み飛ばすので、その行番号を
+    拾って元の行を隔離ファイルに書き出す。列が足りない行は欠損で埋めて読むので、
+    最後の列が空の行があれば列数を数え直して取り除き、同じく隔離する。engine="pyarrow" も指定できるが、
+    pyarrowは列が足りない行も不正行として扱い、行番号も取れないことがある。
+    """
+    columns = list(columns or RACE_JP23_COLUMNS)
+    quarantine_path = quarantine_path or default_quarantine_path(file_path)
+
+    with open(file_path, encoding="utf-8-sig") as f:
+        header = next(csv.reader(f), [])
+    if [c.strip() for c in header] != columns:
+        raise ValueError(f"列構成が想定と違います: {file_path} {header}")
+
+    # 型推論をさせず全列を文字列で読む（数値化は apply_race_schema でまとめて行う）
+    read_kwargs = dict(header=0, names=columns, dtype=str, encoding="utf-8-sig", skip_blank_lines=True)
+
+    bad_lines = []
+    if engine == "pyarrow":
+        def on_bad_line(row):
+            bad_lines.append((row.number if row.number is not None else "", row.text))
+            return "skip"
+
+        df = pd.read_csv(file_path, engine="pyarrow", on_bad_lines=on_bad_line, **read_kwargs)
+    else:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", pd.errors.ParserWarning)
+            df = pd.read_csv(file_path, engine="c", on_bad_lines="warn", **read_kwargs)
+        line_numbers = []
+        for w in caught:
+            if not issubclass(w.category, pd.errors.ParserWarning):
+                warnings.warn_explicit(w.message, w.category, w.filename, w.lineno)
+                continue
+            for msg in str(w.message).splitlines():
+                if msg.startswith("Skipping line "):
+                    line_numbers.append(int(msg[len("Skipping line "):].split(":")[0]))
+        bad_lines = _read_lines(file_path, line_numbers)
+        # 列が足りない行は最後の列が欠損になる（最後の列が空の行が無ければ数え直さない）
+        if df[columns[-1]].isna().any():
+            short = _short_records(file_path, len(columns))
+            if short:
+                df = df.drop(index=df.index[[pos for pos, _ in short]]).reset_index(drop=True)
+                bad_lines = sorted(bad_lines + _read_lines(file_path, [no for _, no in short]))
+
+    _write_quarantine(quarantine_path, bad_lines)
+    if bad_lines:
+        print(f"⚠️ {file_path}: 不正な行を{len(bad_lines)}件隔離しました → {quarantine_path}")
+    if typed:
+        df = add_key_columns(apply_race_schema(df))
+    df.attrs["bad_lines"] = len(bad_lines)
+    return df
+
+
+def load_race_data(file_path, **kwargs):
+    """ingest_race_csv のキャッシュ付き版"""
+    return cached_load(file_path, ingest_race_csv, **kwargs)
+
+
+# ==============================
+# 馬名 → 近走 インデックス
+# ==============================
+def build_horse_index(race_df: pd.DataFrame, n: int = 5, key_col: str = "馬名", date_col: str = "日付"):
+    """近走データを馬ごとにまとめ、日付の新しい順に直近n走（n=None なら全走）を持つ辞書を作る"""
+    if race_df is None or race_df.empty or key_col not in race_df.columns:
+        return MappingProxyType({})
+
+    df = race_df
+    if date_col in df.columns:
+        # 日付が読めない行は末尾へ（元の並び順は保つ）
+        dates = pd.to_datetime(df[date_col], errors="coerce")
+        df = df.assign(_date=dates).sort_values("_date", ascending=False, kind="stable", na_position="last")
+        df = df.drop(columns="_date")
+
+    if n is not None:
+        df = df.groupby(key_col, sort=False, observed=True).head(n)
+    return _frozen_index(df.groupby(key_col, sort=False, observed=True))
+
+
+def _frozen_index(groups):
+    """groupby の結果を 馬 → 近走 の読み取り専用の辞書にする
+
+    インデックスは全セッションで共有するので、馬の追加・差し替えはできないようにしておく。
+    各DataFrameは pandas の Copy-on-Write により、セッション側で加工しても元は変わらない。
+    """
+    return MappingProxyType({key: group.reset_index(drop=True) for key, group in groups})
+
+
+def _read_horse_index(path, n, loader, key_col="馬名", **loader_kwargs):
+    return build_horse_index(loader(path, **loader_kwargs), n=n, key_col=key_col)
+
+
+def load_horse_index(file_path, n: int = 5, loader=load_csv, key_col: str = "馬名", **loader_kwargs):
+    """CSVから馬ごとの近走インデックスを読み込む（ファイルが変わったときだけ作り直す）
+
+    loader には load_csv（既定）か load_race_data を渡す。load_race_data なら
+    key_col="horse_key" で整数キー → 近走 のインデックスにできる。
+    """
+    return cached_load(file_path, _read_horse_index, n, loader, key_col, **loader_kwargs)
+
+
+def get_recent_races(index, horse, n: int = 5, offset: int = 0):
+    """インデックスから馬の近走を取り出す（horse は馬名か horse_key。見つからなければ空のDataFrame）
+
+    offset を渡すと、新しい方から offset 走飛ばした n 走を返す（ページ送り用）。
+    """
+    past = index.get(horse)
+    if past is None:
+        return pd.DataFrame()
+    return past.iloc[offset:offset + n]
+
+
+# ==============================
+# SQLiteストアからの読み込み
+# ==============================
+def load_store_index(horse_names, n: int = 5, db_path=None, key_col: str = "馬名", netkeiba_ids=None):
+    """ストア（utils.race_store）から指定した馬の近n走を1回のクエリで読み、馬 → 近走 の辞書を返す
+
+    key_col="horse_key" なら整数キー → 近走 の辞書にする。netkeiba_ids（{馬名: netkeibaのID}）が
+    あれば、その馬はIDで引く。ストアが変わっていなければ前回の結果を返す。
+    """
+    from utils.race_store import DB_PATH
+
+    path = os.path.abspath(os.fspath(db_path or DB_PATH))
+    names = tuple(str(h) for h in horse_names)
+    ids = tuple(sorted((str(k), v) for k, v in (netkeiba_ids or {}).items()))
+
+    def build():
+        recent = add_key_columns(_get_store(path).recent_results(list(names), n=n, netkeiba_ids=dict(ids)))
+        return _frozen_index(recent.groupby(key_col, sort=False))
+
+    return _cached((path, "store_index", names, n, key_col, ids), _store_signature(path), build)
+
+
+def _store_signature(path):
+    """書き込みはまずWALファイルに入るので、本体とWALの両方を見る"""
+    return _file_signature(path), _wal_signature(path)
+
+
+def load_store_page(horse_name, page: int = 0, per_page: int = 5, db_path=None, netkeiba_id=None):
+    """ストアから1頭の成績を1ページ分だけ読む（page=0 が最新。開いた馬の分だけ読む）"""
+    from utils.race_store import DB_PATH
+
+    path = os.path.abspath(os.fspath(db_path or DB_PATH))
+    return _cached(
+        (path, "store_page", str(horse_name), netkeiba_id, page, per_page),
+        _store_signature(path),
+        lambda: _get_store(path).results_page(
+            horse_name, limit=per_page, offset=page * per_page, netkeiba_id=netkeiba_id),
+    )
+
+
+def load_store_counts(horse_names, db_path=None, netkeiba_ids=None):
+    """ストアにある馬ごとの成績の件数 {馬名: 件数}（netkeiba_ids は load_store_index と同じ）"""
+    from utils.race_store import DB_PATH
+
+    path = os.path.abspath(os.fspath(db_path or DB_PATH))
+    names = tuple(str(h) for h in horse_names)
+    ids = tuple(sorted((str(k), v) for k, v in (netkeiba_ids or {}).items()))
+    return _cached(
+        (path, "store_counts", names, ids),
+        _store_signature(path),
+        lambda: _get_store(path).result_counts(names, dict(ids)),
+    )
+
+
+# ==============================
+# 列指向アーカイブからの読み込み
+# ==============================
+def load_archive(path=None):
+    """近走アーカイブ（utils.archive）をメモリマップで開く
+
+    プロセスに1つだけ開き、ファイルが置き換わったら開き直す。複数のプロセスで開いても
+    中身はOSのページキャッシュを共有する。
+    """
+    from utils.archive import ARCHIVE_PATH, RaceArchive
+
+    path = os.path.abspath(os.fspath(path or ARCHIVE_PATH))
+    return _cached((path, "archive"), _file_signature(path), lambda: RaceArchive(path))
+
+
+def load_archive_index(horse_names, n: int = 5, path=None, key_col: str = "馬名"):
+    """アーカイブから指定した馬の近n走（n=None なら全走）だけを読み、馬 → 近走 の辞書を返す
+
+    読むのは指定した馬を含む行グループだけ。
+    """
+    archive = load_archive(path)
+    names = tuple(str(h) for h in horse_names)
+    return _cached(
+        (str(archive.path), "archive_index", names, n, key_col),
+        _file_signature(archive.path),
+        lambda: build_horse_index(archive.read(horses=names), n=n, key_col=key_col),
+    )
+
+
+def _wal_signature(path):
+    try:
+        return _file_signature(path + "-wal")
+    except OSError:
+        return None
+
+
+_stores = {}
+
+
+def _get_store(db_path):
+    from utils.race_store import RaceStore
+
+    key = os.path.abspath(os.fspath(db_path))
+    with _cache_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = RaceStore(db_path)
+    return store
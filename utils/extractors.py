@@ -0,0 +1,387 @@
+import json
+import re
+import threading
+from urllib.parse import urljoin
+
+import lxml.html
+from bs4 import BeautifulSoup, SoupStrainer
+
+from utils.ids import netkeiba_id
+from utils.schema import race_class
+from utils.timing import span, timed
+
+# BeautifulSoupを使うときもlxmlで組み立てる（html.parserより数倍速い）
+HTML_PARSER = "lxml"
+
+
+# ==============================
+# パースの共通部品
+# ==============================
+def table_region(html):
+    """最初の<table>から最後の</table>までを切り出す（表以外の大部分をパースせずに済む）"""
+    start = html.find("<table")
+    end = html.rfind("</table>")
+    if start < 0 or end < start:
+        return html
+    return html[start:end + len("</table>")]
+
+
+def make_soup(html, only=None):
+    """速いパーサでBeautifulSoupを作る。only="table" なら表の部分だけをDOMにする"""
+    if only == "table":
+        html = table_region(html)
+    parse_only = SoupStrainer(only) if only else None
+    return BeautifulSoup(html, HTML_PARSER, parse_only=parse_only)
+
+
+_NEXT_DATA_ID = 'id="__NEXT_DATA__"'
+
+
+def extract_next_data(html):
+    """<script id="__NEXT_DATA__"> の中身のJSONを、DOMを作らずに文字列から切り出す
+
+    見つからない・壊れている場合はNone。
+    """
+    pos = html.find(_NEXT_DATA_ID)
+    if pos < 0:
+        return None
+    start = html.find(">", pos)
+    end = html.find("</script>", start)
+    if start < 0 or end < 0:
+        return None
+    try:
+        return json.loads(html[start + 1:end])
+    except ValueError:
+        return None
+
+
+def _text(el):
+    return "".join(el.itertext()).strip()
+
+
+class _Page:
+    """1ページ分のHTML。DOMが必要になったときに1回だけlxmlでパースする
+
+    近走の抽出で見るのは表だけなので、表の部分だけをパースする。
+    """
+
+    def __init__(self, html):
+        self.html = html
+        self._tree = None
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = lxml.html.document_fromstring(table_region(self.html))
+        return self._tree
+
+
+# ==============================
+# 近走の抽出方法
+# ==============================
+# 成績テーブルから拾う列（あるものだけ）。開催・距離・馬場などは条件での絞り込みに使う
+# （開催と R は、レースIDが取れなかったときにレースを見分けるのに使う）
+PAST_RACE_COLUMNS = [
+    "日付", "開催", "R", "頭数", "枠番", "馬番", "着順", "騎手", "斤量", "距離", "馬場",
+    "タイム", "人気", "通過", "ペース", "上り", "着差",
+]
+
+# レース名のリンク（/race/202405050811/ や result.html?race_id=...）からレースIDを取る。
+# 海外のレースは '2023J0100101' のように英字を含むので文字列のまま持つ
+_RACE_ID_RE = re.compile(r"/race/(?:result\.html\?race_id=)?(\w{12})\b")
+# グレードのアイコン（class="Icon_GradeType Icon_GradeType1" など）
+_GRADE_ICON_RE = re.compile(r"Icon_GradeType([1-3])\b")
+
+
+def race_id_from_url(href):
+    """レースのURLからnetkeibaのレースID（文字列）を取る。取れなければNone"""
+    m = _RACE_ID_RE.search(href or "")
+    return m.group(1) if m else None
+
+
+def _race_link(cell):
+    """レース名のセルから (レースID, アイコンのグレード) を取る（無いものはNone）"""
+    hrefs = cell.xpath(".//a/@href")
+    race_id = next((rid for rid in map(race_id_from_url, hrefs) if rid), None)
+    icons = _GRADE_ICON_RE.search(" ".join(cell.xpath(".//@class")))
+    return race_id, f"G{icons.group(1)}" if icons else None
+
+
+def _from_next_data(page, horse_name, limit):
+    """__NEXT_DATA__ の pastResults から取る"""
+    data = extract_next_data(page.html)
+    if data is None:
+        return None
+    try:
+        race_list = data["props"]["pageProps"]["horseResult"]["pastResults"]
+    except (KeyError, TypeError):
+        return None
+
+    races = []
+    for r in race_list[:limit]:
+        races.append({
+            "馬名": horse_name,
+            "レースID": r.get("raceId") or None,
+            "レース名": r.get("raceName", ""),
+            "グレード": r.get("grade", ""),
+            "クラス": race_class(r.get("raceName"), r.get("grade")),
+            "日付": r.get("date", ""),
+            "コース": r.get("courseName", ""),
+            "着順": r.get("finish", ""),
+            "タイム": r.get("time", ""),
+            "人気": r.get("popularity", ""),
+            "着差": r.get("margin", ""),
+        })
+    return races
+
+
+def _from_result_table(page, horse_name, limit):
+    """見出しに「レース」を含む成績テーブルから取る（旧 pandas.read_html 方式）"""
+    for table in page.tree.iter("table"):
+        rows = table.xpath(".//tr")
+        if not rows:
+            continue
+        headers = [re.sub(r"\s+", "", _text(c)) for c in rows[0].xpath("./th|./td")]
+        race_cols = [c for c in headers if "レース" in c]
+        if not race_cols:
+            continue
+
+        race_col = race_cols[0]
+        keep_cols = [race_col] + [c for c in PAST_RACE_COLUMNS if c in headers]
+        positions = {c: headers.index(c) for c in keep_cols}
+
+        races = []
+        for tr in rows[1:]:
+            tds = tr.xpath("./td|./th")
+            cells = [_text(c) for c in tds]
+            if len(cells) < len(headers):
+                continue
+            race = {c: cells[i] for c, i in positions.items()}
+            race["馬名"] = horse_name
+            race["レースID"], grade = _race_link(tds[positions[race_col]])
+            race["クラス"] = race_class(race[race_col], grade)
+            races.append(race)
+            if limit is not None and len(races) >= limit:
+                break
+        return races
+    return None
+
+
+def _from_horse_list(page, horse_name, limit):
+    """tr.HorseList__row の行を手動で読む（最近のレイアウト向け）"""
+    rows = page.tree.xpath('//tr[contains(concat(" ", normalize-space(@class), " "), " HorseList__row ")]')
+    if not rows:
+        return None
+
+    races = []
+    for row in rows[:limit]:
+        tds = row.xpath("./td")
+        cells = [_text(td) for td in tds]
+        if len(cells) < 6:
+            continue
+        race_id, grade = _race_link(tds[1])
+        races.append({
+            "馬名": horse_name,
+            "レースID": race_id,
+            "レース名": cells[1],
+            "クラス": race_class(cells[1], grade),
+            "日付": cells[0],
+            "着順": cells[2],
+            "タイム": cells[3],
+            "人気": cells[4],
+            "着差": cells[5] if len(cells) > 5 else "",
+        })
+    return races
+
+
+PAST_RACE_STRATEGIES = {
+    "next_data": _from_next_data,
+    "table": _from_result_table,
+    "horse_list": _from_horse_list,
+}
+
+# 抽出方法ごとの成功・失敗回数。成功率の高い順に試す
+_strategy_stats = {name: {"ok": 0, "ng": 0} for name in PAST_RACE_STRATEGIES}
+_stats_lock = threading.Lock()
+
+# これだけ失敗し、一度も成功していない方法は試さない。ただし他の方法が一度でも成功してから
+# （どの方法もまだ成功していなければ、エラーページが続いただけかもしれないので全部試す）
+SKIP_AFTER_FAILURES = 20
+
+
+def _ordered_strategies():
+    with _stats_lock:
+        stats = {name: dict(s) for name, s in _strategy_stats.items()}
+
+    def rate(name):
+        s = stats[name]
+        return (s["ok"] + 1) / (s["ok"] + s["ng"] + 2)
+
+    names = list(PAST_RACE_STRATEGIES)
+    if any(s["ok"] for s in stats.values()):
+        names = [name for name in names if stats[name]["ok"] > 0 or stats[name]["ng"] < SKIP_AFTER_FAILURES]
+    return sorted(names, key=rate, reverse=True)
+
+
+def _record(name, ok):
+    with _stats_lock:
+        _strategy_stats[name]["ok" if ok else "ng"] += 1
+
+
+def get_strategy_stats():
+    with _stats_lock:
+        return {name: dict(s) for name, s in _strategy_stats.items()}
+
+
+def extract_past_races(html, horse_name, limit=5):
+    """馬ページのHTMLから近走を取り出す。(races, 使った抽出方法) を返す
+
+    limit=None ならページに載っている全成績を取る。
+
+    HTMLのパースは1ページにつき最大1回。__NEXT_DATA__ はDOMを作らずに読む。
+    どの方法でも取れなければ ([], None)。
+    """
+    page = _Page(html)
+    for name in _ordered_strategies():
+        try:
+            with span(f"parse.{name}"):
+                races = PAST_RACE_STRATEGIES[name](page, horse_name, limit)
+        except Exception:
+            races = None
+        _record(name, bool(races))
+        if races:
+            return races, name
+    return [], None
+
+
+# ==============================
+# 馬名
+# ==============================
+_TITLE_RE = re.compile(r"<title>\s*([^<|(（]+?)\s*[(（|]")
+
+
+def horse_name_from_page(html):
+    """馬ページの <title>（'イクイノックス (Equinox) | 競走馬データ - netkeiba'）から馬名を取る。無ければNone"""
+    m = _TITLE_RE.search(html[:4096])
+    return m.group(1).strip() if m else None
+
+
+_RACE_DATE_RE = re.compile(r"(\d{4})年(\d{1,2})月(\d{1,2})日")
+
+
+def race_date_from_page(html):
+    """レースのページの <title>（'ジャパンカップ(G1) 出馬表 | 2023年11月26日 東京11R …'）から
+    開催日を 'YYYY/MM/DD' で取る。無ければNone"""
+    m = _RACE_DATE_RE.search(html[:4096])
+    return f"{int(m.group(1)):04d}/{int(m.group(2)):02d}/{int(m.group(3)):02d}" if m else None
+
+
+# ==============================
+# 出馬表の抽出
+# ==============================
+@timed("parse.shutuba_table")
+def shutuba_from_table(html):
+    """出馬表ページの table.RaceTable01 から各馬の行を取る（表が無ければNone）
+
+    馬のURLは db.netkeiba.com に揃える。
+    """
+    # 出馬表テーブル以外はDOMにしない
+    soup = make_soup(html, only="table")
+    table = soup.select_one("table.RaceTable01")
+    if not table:
+        return None
+
+    date = race_date_from_page(html)
+    rows = []
+    for tr in table.find_all("tr"):
+        tds = tr.find_all("td")
+        if len(tds) < 8:
+            continue
+
+        horse_a = tr.find("a", href=re.compile("/horse/"))
+        if not horse_a:
+            continue
+
+        horse_name = horse_a.get_text(strip=True)
+        raw_href = horse_a.get("href", "").strip()
+
+        # --- URL正規化処理 ---
+        if not raw_href:
+            continue
+
+        # db.netkeiba.com に統一
+        if raw_href.startswith("http"):
+            horse_url = re.sub(r"^https*://race\.netkeiba\.com", "https://db.netkeiba.com", raw_href)
+        else:
+            horse_url = urljoin("https://db.netkeiba.com", raw_href)
+
+        # 二重コロン修正
+        horse_url = horse_url.replace("https::", "https:")
+
+        # 騎手情報などを抽出
+        jockey = tr.find("a", href=re.compile("/jockey/"))
+        jockey_name = jockey.get_text(strip=True) if jockey else ""
+        odds_tag = tr.find("td", class_="OddsTxt")
+        odds = odds_tag.get_text(strip=True) if odds_tag else ""
+        pop_tag = tr.find("td", class_="PopularTxt")
+        pop = pop_tag.get_text(strip=True) if pop_tag else ""
+        age = tds[3].get_text(strip=True)
+        weight = tds[4].get_text(strip=True)
+
+        rows.append({
+            "馬名": horse_name,
+            "騎手": jockey_name,
+            "斤量": weight,
+            "馬齢": age,
+            "人気": pop,
+            "単勝オッズ": odds,
+            "horse_url": horse_url,
+            # netkeibaのID（名前の表記揺れに左右されない結合キー）
+            "horse_id": netkeiba_id(horse_url, "horse"),
+            "jockey_id": netkeiba_id(jockey.get("href", ""), "jockey") if jockey else None,
+            "日付": date,
+        })
+    return rows
+
+
+@timed("parse.shutuba_next_data")
+def shutuba_from_next_data(html):
+    """出馬表ページの __NEXT_DATA__ の race.horses から各馬の行を取る（無ければNone）"""
+    data = extract_next_data(html)
+    if data is None:
+        return None
+    try:
+        horses = data["props"]["pageProps"]["race"]["horses"]
+    except (KeyError, TypeError):
+        return None
+
+    date = race_date_from_page(html)
+    rows = []
+    for h in horses:
+        jockey_id = h.get("jockey", {}).get("id", "")
+        horse_id = h.get("id", "")
+        rows.append({
+            "馬名": h.get("name", ""),
+            "騎手": h.get("jockey", {}).get("name", ""),
+            "斤量": h.get("burdenWeight", ""),
+            "馬齢": h.get("age", ""),
+            "人気": h.get("popularity", ""),
+            "単勝オッズ": h.get("odds", ""),
+            "horse_url": f"https://db.netkeiba.com/horse/{horse_id}/",
+            "horse_id": netkeiba_id(horse_id),
+            "jockey_id": netkeiba_id(jockey_id, "jockey"),
+            "日付": date,
+        })
+    return rows
+
+
+def extract_shutuba(html):
+    """出馬表ページから各馬の行を取る。(rows, 使った抽出方法) を返す（取れなければ ([], None)）"""
+    for name, func in (("table", shutuba_from_table), ("next_data", shutuba_from_next_data)):
+        try:
+            rows = func(html)
+        except Exception:
+            rows = None
+        if rows:
+            return rows, name
+    return [], None
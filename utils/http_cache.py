@@ -0,0 +1,245 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+from utils.http_client import get_shared_session
+from utils.incremental import next_results_ready
+
+# ==============================
+# 取得ページのディスクキャッシュ
+# ==============================
+# data/http_cache/
+#   index/ab/<URLのsha256>.json     … URL → 本文のハッシュ・取得時刻・期限（最新の1件）
+#   history/ab/<URLのsha256>.jsonl  … URL の本文が変わるたびに (取得時刻, 本文のハッシュ) を追記
+#   objects/cd/<本文のsha256>.gz    … 本文（同じ内容は1つだけ保存される。古い版も消さない）
+# 期限切れのページも objects に残るので、パーサを直したときはネットワークなしで
+# 取り直せる（utils.reparse）。
+CACHE_DIR = Path("data/http_cache")
+
+# URLの種類ごとの有効期限（秒）。上から順に最初に一致したものを使う
+TTL_RULES = [
+    # 出馬表はオッズや取消で変わるので短め
+    (re.compile(r"race\.netkeiba\.com/race/shutuba"), 10 * 60),
+]
+# 期限を時刻で決めるURL（取得時刻 → 期限のUNIX時刻）。TTL_RULES より優先する
+EXPIRY_RULES = [
+    # 馬の成績ページは新しい成績が載るまで変わらない（次に成績が出そろう時刻まで使う）
+    (re.compile(r"db\.netkeiba\.com/horse/"), next_results_ready),
+]
+DEFAULT_TTL = 60 * 60
+
+
+class OfflineCacheMiss(Exception):
+    """オフラインモードでキャッシュに無いURLを要求した"""
+
+
+def ttl_for(url):
+    for pattern, ttl in TTL_RULES:
+        if pattern.search(url):
+            return ttl
+    return DEFAULT_TTL
+
+
+def expires_at_for(url, now):
+    """now に取得した url の期限（UNIX時刻）。EXPIRY_RULES → TTL_RULES の順に決める"""
+    for pattern, expiry in EXPIRY_RULES:
+        if pattern.search(url):
+            return expiry(now)
+    return now + ttl_for(url)
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _atomic_write(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+class ResponseCache:
+    """URLごとにページ本文をディスクへ保存し、期限内なら再取得せずに返す
+
+    offline=True のときはネットワークに出ず、期限切れでもキャッシュから返す。
+    キャッシュに無ければ OfflineCacheMiss を送出する。
+    """
+
+    def __init__(self, root=CACHE_DIR, offline: bool = False):
+        self.root = Path(root)
+        self.offline = offline
+
+    def _index_path(self, url):
+        key = _sha256(url.encode("utf-8"))
+        return self.root / "index" / key[:2] / f"{key}.json"
+
+    def _object_path(self, digest):
+        return self.root / "objects" / digest[:2] / f"{digest}.gz"
+
+    def _history_path(self, url):
+        key = _sha256(url.encode("utf-8"))
+        return self.root / "history" / key[:2] / f"{key}.jsonl"
+
+    def lookup(self, url):
+        """キャッシュのメタ情報を返す（無ければNone）"""
+        path = self._index_path(url)
+        if not path.exists():
+            return None
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def get(self, url, allow_stale: bool = False):
+        """期限内（allow_stale=True なら期限切れも）の本文を返す。無ければNone"""
+        meta = self.lookup(url)
+        if meta is None:
+            return None
+        if not allow_stale and meta["expires_at"] < time.time():
+            return None
+        return self.load_object(meta["sha256"])
+
+    def load_object(self, digest):
+        """本文のハッシュから本文を返す（無ければNone）"""
+        try:
+            return gzip.decompress(self._object_path(digest).read_bytes()).decode("utf-8")
+        except OSError:
+            return None
+
+    def history(self, url):
+        """URL の取得履歴 [{"url", "fetched_at", "sha256"}]（古い順。本文が変わったときだけ記録）"""
+        entries = []
+        try:
+            with open(self._history_path(url), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # 書き込み途中で落ちた行
+                        continue
+        except OSError:
+            pass
+        meta = self.lookup(url)
+        if meta and not any(e["sha256"] == meta["sha256"] for e in entries):
+            # 履歴を取り始める前に保存したページ
+            entries.append({"url": url, "fetched_at": meta["fetched_at"], "sha256": meta["sha256"]})
+        return entries
+
+    def iter_pages(self, pattern=None, all_versions=False):
+        """保存してあるページの (url, 取得時刻, 本文のハッシュ) を順に返す
+
+        pattern（正規表現）を渡すと一致するURLだけ。all_versions=False なら URL ごとに最新の版だけ。
+        """
+        regex = re.compile(pattern) if pattern else None
+        for path in sorted((self.root / "index").glob("*/*.json")):
+            try:
+                url = json.loads(path.read_text(encoding="utf-8"))["url"]
+            except (OSError, ValueError, KeyError):
+                continue
+            if regex and not regex.search(url):
+                continue
+            entries = self.history(url)
+            for entry in entries if all_versions else entries[-1:]:
+                yield url, entry["fetched_at"], entry["sha256"]
+
+    def replay(self, url):
+        """キャッシュから本文を返す。無ければNone（オフラインモードなら OfflineCacheMiss）"""
+        text = self.get(url, allow_stale=self.offline)
+        if text is None and self.offline:
+            raise OfflineCacheMiss(f"オフラインモードでキャッシュにありません: {url}")
+        return text
+
+    def put(self, url, text, ttl=None, expires_at=None, etag=None, last_modified=None):
+        """本文を保存する。expires_at（UNIX時刻）> ttl（秒）> URLごとの規則（expires_at_for）の順に期限を決める
+
+        etag / last_modified は期限切れ後の条件付きリクエストに使う。
+        """
+        body = text.encode("utf-8")
+        digest = _sha256(body)
+        obj = self._object_path(digest)
+        if not obj.exists():
+            _atomic_write(obj, gzip.compress(body))
+
+        now = time.time()
+        previous = self.lookup(url)
+        if previous is None or previous.get("sha256") != digest:
+            self._append_history(url, {"url": url, "fetched_at": now, "sha256": digest})
+        if expires_at is None:
+            expires_at = now + ttl if ttl is not None else expires_at_for(url, now)
+        meta = {"url": url, "sha256": digest, "fetched_at": now, "expires_at": expires_at}
+        if etag:
+            meta["etag"] = etag
+        if last_modified:
+            meta["last_modified"] = last_modified
+        _atomic_write(self._index_path(url), json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+
+    def _append_history(self, url, entry):
+        path = self._history_path(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def fetch(self, url, session=None, ttl=None, expires_at=None, encoding="utf-8", timeout=None):
+        """キャッシュにあればそれを、無ければ取得して保存してから本文を返す"""
+        return self.fetch_with_status(url, session, ttl, expires_at, encoding, timeout)[0]
+
+    def fetch_with_status(self, url, session=None, ttl=None, expires_at=None, encoding="utf-8", timeout=None,
+                          fetched_after=None):
+        """fetch と同じだが (本文, 状態) を返す
+
+        状態は "cache"（期限内のキャッシュ）/ "not_modified"（条件付きリクエストで304）/
+        "fetched"（新しく取得）のいずれか。fetched_after（UNIX時刻）より前に取得した
+        キャッシュは期限内でも使わず、サーバーに確認する。
+        """
+        stale = self.lookup(url)
+        outdated = fetched_after is not None and stale and stale["fetched_at"] < fetched_after
+        if not outdated or self.offline:
+            text = self.replay(url)
+            if text is not None:
+                return text, "cache"
+
+        # 期限切れのキャッシュがあれば ETag / Last-Modified で条件付きリクエストにする
+        headers = {}
+        if stale:
+            if stale.get("etag"):
+                headers["If-None-Match"] = stale["etag"]
+            if stale.get("last_modified"):
+                headers["If-Modified-Since"] = stale["last_modified"]
+
+        # 流量制御・タイムアウト・再試行は Session 側（utils.http_client.ScheduledSession）で行う
+        session = session or get_shared_session()
+        res = session.get(url, headers=headers, timeout=timeout)
+
+        if res.status_code == 304 and headers:
+            text = self.get(url, allow_stale=True)
+            if text is not None:
+                self.put(url, text, ttl=ttl, expires_at=expires_at,
+                         etag=stale.get("etag"), last_modified=stale.get("last_modified"))
+                return text, "not_modified"
+            # メタ情報だけ残って本文が無い。キャッシュに無いものとして条件を付けずに取り直す
+            res = session.get(url, timeout=timeout)
+
+        res.raise_for_status()
+        res.encoding = encoding
+        text = res.text
+        self.put(url, text, ttl=ttl, expires_at=expires_at,
+                 etag=res.headers.get("ETag"), last_modified=res.headers.get("Last-Modified"))
+        return text, "fetched"
+
+
+_default_cache = None
+
+
+def get_response_cache():
+    """フェッチャー共通のキャッシュ（環境変数 KEIBA_OFFLINE=1 でオフラインモード）"""
+    global _default_cache
+    if _default_cache is None:
+        offline = os.environ.get("KEIBA_OFFLINE", "") not in ("", "0")
+        _default_cache = ResponseCache(offline=offline)
+    return _default_cache
@@ -0,0 +1,304 @@
+import multiprocessing
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.timing import span
+
+# netkeibaにアクセスするときの共通ヘッダー
+DEFAULT_HEADERS = {"User-Agent": "Mozilla/5.0"}
+
+# (接続のタイムアウト, 読み込みのタイムアウト) 秒。呼び出し側で timeout を渡せばそちらを使う
+DEFAULT_TIMEOUT = (5, 20)
+
+
+# ==============================
+# ホストごとの流量制御
+# ==============================
+# ホストごとの上限
+#   rate / burst … 1秒あたりのリクエスト数と、まとめて出してよい数（トークンバケット）
+#   max_concurrency … 同時に投げる数の上限（応答が遅くなったら自動で下げる）
+# race.netkeiba.com（出馬表）と db.netkeiba.com（馬の成績）は別々に数える
+HOST_POLICIES = {
+    "race.netkeiba.com": {"rate": 2.0, "burst": 4, "max_concurrency": 4},
+    "db.netkeiba.com": {"rate": 4.0, "burst": 8, "max_concurrency": 8},
+}
+DEFAULT_POLICY = {"rate": 2.0, "burst": 4, "max_concurrency": 4}
+
+# 429が続いても、これより遅くはしない（1秒あたり）
+MIN_RATE = 0.2
+
+# 再試行するステータス（429は制限、5xxはサーバー側の一時的なエラー）
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 4
+BACKOFF_BASE = 1.0   # 1回目の待ち時間の上限（秒）。2回目以降は倍々
+BACKOFF_MAX = 60.0
+
+# 応答時間がいつもの何倍を超えたら同時実行数を下げるか
+SLOW_FACTOR = 2.0
+# 同時実行数や rate を下げた後、次に下げられるまでの秒数
+COOLDOWN_SECONDS = 1.0
+
+
+class HostLimiter:
+    """1ホスト分のトークンバケットと、応答時間に合わせて増減する同時実行数
+
+    - 成功して応答も速い … 同時実行数を少しずつ上げる（上限 max_concurrency）。
+      429で下げた rate も少しずつ戻す
+    - 応答が遅い（いつもの SLOW_FACTOR 倍超） … 同時実行数を下げる
+    - 429 / 接続エラー … 同時実行数と rate を半分にする。5xx … 同時実行数だけ半分にする
+
+    同時に投げていた分がまとめて失敗しても何度も下げないよう、下げるのは
+    COOLDOWN_SECONDS に1回まで。
+
+    shared … 複数プロセスで使う同時実行の枠（multiprocessing のセマフォ。shared_slots() で作る）。
+    渡すと、このプロセスの枠に加えてこちらも取る（プロセスをまたいだ同時実行数の上限）
+    """
+
+    def __init__(self, rate: float, burst: int, max_concurrency: int, shared=None):
+        self.max_rate = self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.limit = max(1.0, max_concurrency / 2)
+        self.in_flight = 0
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._cut_at = 0.0
+        self._latency = None    # 応答時間の移動平均
+        self._baseline = None   # 空いているときの応答時間（移動平均の最小値。少しずつ上げて追従する）
+        self.shared = shared
+        self._cond = threading.Condition()
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "errors": 0}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def acquire(self):
+        """同時実行の枠とトークンが空くまで待つ"""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                self._cond.wait((1 - self._tokens) / self.rate)
+        if self.shared is not None:
+            # 他のプロセスの分も含めた枠（ロックの外で待つ）
+            self.shared.acquire()
+
+    def _cut(self, factor, slow_down=False):
+        now = time.monotonic()
+        if now - self._cut_at < COOLDOWN_SECONDS:
+            return
+        self._cut_at = now
+        self.limit = max(1.0, self.limit * factor)
+        if slow_down:
+            self.rate = max(MIN_RATE, self.rate * factor)
+
+    def release(self, latency=None, status=None, error=False, retry=False):
+        """1件終わったことを記録し、結果に合わせて同時実行数と rate を調整する
+
+        status … HTTPのステータス。error … 接続エラーやタイムアウトで終わった。
+        retry … この後で再試行する
+        """
+        if self.shared is not None:
+            self.shared.release()
+        with self._cond:
+            self.in_flight -= 1
+            self.stats["requests"] += 1
+            self.stats["errors"] += error
+            self.stats["retries"] += retry
+            if error or status == 429:
+                self.stats["throttled"] += status == 429
+                self._cut(0.5, slow_down=True)
+            elif status in RETRY_STATUSES:
+                self._cut(0.5)
+            elif latency is not None:
+                self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+                self._baseline = min(self._latency, (self._baseline or self._latency) * 1.01)
+                if self._latency > SLOW_FACTOR * self._baseline:
+                    self._cut(0.75)
+                else:
+                    # 同時実行数ぶん成功したら1つ増やす（AIMD）。rate は20回の成功で元に戻る
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                    self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                **self.stats, "in_flight": self.in_flight, "concurrency": int(self.limit),
+                "rate": round(self.rate, 2), "latency": self._latency,
+            }
+
+
+class RequestScheduler:
+    """ホストごとの HostLimiter をまとめて持つ（プロセスに1つ。get_scheduler() を使う）"""
+
+    def __init__(self, policies=None, default=DEFAULT_POLICY, shared=None):
+        self.policies = dict(HOST_POLICIES if policies is None else policies)
+        self.default = default
+        # ホスト → プロセス間で共有する同時実行の枠（None のキーはポリシーの無いホスト全部）
+        self.shared = shared or {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, url) -> HostLimiter:
+        host = urlsplit(url).hostname or ""
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                shared = self.shared.get(host if host in self.policies else None)
+                limiter = self._limiters[host] = HostLimiter(**self.policies.get(host, self.default), shared=shared)
+            return limiter
+
+    @contextmanager
+    def slot(self, url):
+        """ホストの枠を1つ使う（ブラウザでの描画など、requests を通さないアクセス用）"""
+        limiter = self.limiter(url)
+        with span("http.wait"):
+            limiter.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        except Exception:
+            limiter.release(error=True)
+            raise
+        limiter.release(time.monotonic() - started)
+
+    def stats(self):
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {host: limiter.snapshot() for host, limiter in limiters.items()}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """プロセス共通の RequestScheduler（同じプロセスのSessionはすべてこれで流量を合わせる）"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
+
+
+def _divide(policy, n):
+    """rate と burst を n 等分する（同時実行数はプロセス間の共有の枠で抑えるので分けない）"""
+    return {**policy, "rate": policy["rate"] / n, "burst": max(1, policy["burst"] // n)}
+
+
+def shared_slots():
+    """プロセス間で共有する、ホストごとの同時実行の枠 {ホスト: セマフォ}（None はポリシーの無いホスト）
+
+    親プロセスで作り、share_between_processes() に渡す（ProcessPoolExecutor の initargs など）。
+    """
+    slots = {host: multiprocessing.BoundedSemaphore(policy["max_concurrency"]) for host, policy in HOST_POLICIES.items()}
+    slots[None] = multiprocessing.BoundedSemaphore(DEFAULT_POLICY["max_concurrency"])
+    return slots
+
+
+def share_between_processes(n: int, slots):
+    """n プロセスで並行して取得するとき、各プロセスで最初に呼ぶ
+
+    rate はホストごとに n 等分する（burst は1未満にできないので、プロセス数が burst より多いと
+    まとめて出せる数は少し上限を超える）。同時実行数は親で作った slots（shared_slots()）を全プロセスで
+    取り合うので、プロセス数によらずホストごとの max_concurrency を超えない。
+    """
+    global _scheduler
+    policies = {host: _divide(policy, n) for host, policy in HOST_POLICIES.items()}
+    with _scheduler_lock:
+        _scheduler = RequestScheduler(policies, _divide(DEFAULT_POLICY, n), shared=slots)
+
+
+def _retry_after(res):
+    """Retry-After ヘッダーの秒数（無いか日付形式ならNone）"""
+    value = res.headers.get("Retry-After", "")
+    return float(value) if value.strip().isdigit() else None
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """attempt 回目の再試行までの待ち時間（0〜上限の一様乱数。同時に再試行が集中しないように）"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class ScheduledSession(requests.Session):
+    """ホストごとの流量制御・タイムアウト・再試行付きの Session
+
+    - リクエストの前に、そのホストのトークンと同時実行の枠を取る
+    - timeout を渡さなければ DEFAULT_TIMEOUT（接続, 読み込み）
+    - 429 / 5xx / 接続エラー / タイムアウトは、ジッター付きの指数バックオフで
+      max_retries 回まで再試行する（Retry-After があればそれ以上待つ）
+    """
+
+    def __init__(self, scheduler=None, max_retries: int = MAX_RETRIES):
+        super().__init__()
+        self.scheduler = scheduler or get_scheduler()
+        self.max_retries = max_retries
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = DEFAULT_TIMEOUT
+        limiter = self.scheduler.limiter(url)
+        attempt = 0
+        while True:
+            with span("http.wait"):
+                limiter.acquire()
+            started = time.monotonic()
+            try:
+                with span("http.request"):
+                    res = super().request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                retry = attempt < self.max_retries
+                limiter.release(error=True, retry=retry)
+                if not retry:
+                    raise
+                wait = backoff_delay(attempt)
+            else:
+                retry = res.status_code in RETRY_STATUSES and attempt < self.max_retries
+                limiter.release(time.monotonic() - started, status=res.status_code, retry=retry)
+                if not retry:
+                    return res
+                wait = max(backoff_delay(attempt), _retry_after(res) or 0)
+                res.close()
+            attempt += 1
+            time.sleep(wait)
+
+
+def make_session(pool_size: int = 8, scheduler=None):
+    """keep-aliveで接続を使い回すSessionを作る
+
+    pool_size はホストごとに保持する接続数。並列取得の同時実行数以上にしておく。
+    リクエストはホストごとに流量を制御し、失敗は再試行する（ScheduledSession）。
+    """
+    session = ScheduledSession(scheduler)
+    session.headers.update(DEFAULT_HEADERS)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def get_shared_session():
+    """Sessionを渡されなかったときに使う、プロセス共通の Session"""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = make_session()
+        return _shared_session
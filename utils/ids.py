@@ -0,0 +1,220 @@
+"""馬・騎手・調教師の整数ID
+
+表示用の名前（馬名・騎手名）は表記が揺れる（出馬表は「川田」、近走は「川田将雅」）。
+アプリ内の結合や検索は名前ではなく、ここで振る整数のキーで行う。
+
+- horse_id / jockey_id / trainer_id … netkeibaのID（URLや __NEXT_DATA__ から取る）。
+  取得からストアまで持ち回る
+- horse_key / jockey_key / trainer_key … プロセス内で振る整数（Int32）。netkeibaのIDがある行は
+  IDごと（同名の別馬は別のキー）、無い行は名前ごとに振る。IDが無いCSVにも付けられるので、
+  アプリの結合はこちらを使う
+"""
+import re
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+
+_NETKEIBA_ID_RE = {
+    "horse": re.compile(r"/horse/(?:ped/|result/)?(\w+)"),
+    "jockey": re.compile(r"/jockey/(?:result/recent/|profile/)?(\w+)"),
+    "trainer": re.compile(r"/trainer/(?:result/recent/|profile/)?(\w+)"),
+}
+
+# 見習い騎手の減量記号（▲△☆◇★）。人名の前に付くだけなので比べるときは外す
+_WEIGHT_MARKS_RE = re.compile(r"^[▲△☆◇★]+")
+# 外国人騎手の頭文字（C.ルメール / Cルメール / Ｃ．ルメール）。別人の区別に要るので外さず 'C.' にそろえる
+_INITIAL_RE = re.compile(r"^([A-ZＡ-Ｚ])[.．]?(?=[゠-ヿ])")
+_FULLWIDTH = str.maketrans("ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺ", "ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
+
+def netkeiba_id(value, kind: str = "horse"):
+    """URL（または数字だけの文字列）からnetkeibaのIDを整数で取り出す（取れなければNone）
+
+    外国馬の '000a01b2c3' のように数字以外を含むIDは整数にできないのでNone。
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    text = str(value).strip()
+    m = _NETKEIBA_ID_RE[kind].search(text)
+    if m:
+        text = m.group(1)
+    return int(text) if text.isdigit() else None
+
+
+def normalize_name(name, person: bool = False):
+    """表記揺れを吸収した比較用の名前（空白を除く。person=True なら減量記号を外し、頭文字を 'C.' の形に）。欠損はNone"""
+    if name is None or (not isinstance(name, str) and pd.isna(name)):
+        return None
+    key = re.sub(r"\s+", "", str(name))
+    if person:
+        key = _WEIGHT_MARKS_RE.sub("", key)
+        key = _INITIAL_RE.sub(lambda m: f"{m.group(1).translate(_FULLWIDTH)}.", key)
+    return key or None
+
+
+def _split_initial(key):
+    """'C.ルメール' → ('C', 'ルメール')。頭文字が無ければ ('', key)"""
+    if len(key) > 2 and key[1] == "." and "A" <= key[0] <= "Z":
+        return key[0], key[2:]
+    return "", key
+
+
+def _same_person(a, b):
+    """略称とフルネームの関係か（頭文字が食い違わず、名前の一方がもう一方で始まる）"""
+    (ia, ra), (ib, rb) = _split_initial(a), _split_initial(b)
+    return (not ia or not ib or ia == ib) and (ra.startswith(rb) or rb.startswith(ra))
+
+
+class Interner:
+    """名前 → 整数キー の対応表（1から順に振る。プロセス内で一度振ったキーは変わらない）
+
+    netkeibaのID（馬なら horse_id）が分かる行は、名前よりIDを優先する。同じ名前でもIDが違えば
+    別のキー、名前の表記が違ってもIDが同じなら同じキー。IDの無い名前は、その名前で最初に
+    登録されたキーになる。
+
+    person=True（騎手・調教師）なら減量記号を無視し、初めて見る名前が登録済みのどれか1人
+    （その人の一番長い名前）と前方一致するとき同じ人とみなす（「川田」と「川田将雅」）。
+    頭文字が違えば別人（M.デムーロ と C.デムーロ）。候補が複数ある略称は別のキーにする。
+    略称として見つけた名前は、次の照合の候補にはしない（「武」経由で 武豊 と 武幸四郎 をつなげない）。
+    """
+
+    def __init__(self, person: bool = False):
+        self.person = person
+        self._keys = {}        # 比較用の名前 → キー（略称として見つけたものも含む）
+        self._full = [None]    # キー → 比較用の名前のうち一番長いもの（前方一致の候補）
+        self._names = [None]   # キー → 表示名
+        self._by_id = {}       # netkeibaのID → キー
+        self._ids = [None]     # キー → netkeibaのID
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names) - 1
+
+    def __sizeof__(self):
+        """名前の文字列まで含めたバイト数（sys.getsizeof 用）"""
+        with self._lock:
+            return (
+                object.__sizeof__(self) + sys.getsizeof(self._keys) + sys.getsizeof(self._names)
+                + sys.getsizeof(self._full) + sys.getsizeof(self._by_id) + sys.getsizeof(self._ids)
+                + sum(sys.getsizeof(k) for k in self._keys) + sum(sys.getsizeof(n) for n in self._names)
+            )
+
+    def find(self, name):
+        """登録済みならキーを返す（登録はしない）"""
+        key = normalize_name(name, self.person)
+        if key is None:
+            return None
+        with self._lock:
+            return self._find(key)
+
+    def _find(self, key):
+        found = self._keys.get(key)
+        if found is not None or not self.person:
+            return found
+        candidates = [i for i in range(1, len(self._full)) if _same_person(self._full[i], key)]
+        if len(candidates) == 1:
+            found = candidates[0]
+            self._keys[key] = found
+            if len(key) > len(self._full[found]):
+                self._full[found] = key
+        return found
+
+    def _new(self, key, name, nid=None):
+        found = len(self._names)
+        self._keys.setdefault(key, found)
+        self._full.append(key)
+        self._names.append(str(name).strip())
+        self._ids.append(nid)
+        if nid is not None:
+            self._by_id[nid] = found
+        return found
+
+    def intern(self, name, netkeiba_id=None):
+        """名前のキーを返す（初めての名前なら新しく振る）。欠損はNone
+
+        netkeiba_id を渡すと、そのIDのキーを返す（IDの違う同名の馬を別にする）。
+        """
+        key = normalize_name(name, self.person)
+        if netkeiba_id is not None and pd.isna(netkeiba_id):
+            netkeiba_id = None
+        if key is None:
+            return None
+        with self._lock:
+            found = self._by_id.get(netkeiba_id) if netkeiba_id is not None else None
+            if found is None:
+                found = self._find(key)
+                if found is not None and netkeiba_id is not None:
+                    if self._ids[found] is None:
+                        # 名前だけで登録されていたキーにIDを結びつける
+                        self._ids[found] = netkeiba_id
+                        self._by_id[netkeiba_id] = found
+                    elif self._ids[found] != netkeiba_id:
+                        # 同じ名前の別の馬（人）
+                        found = None
+            if found is None:
+                return self._new(key, name, netkeiba_id)
+            self._keys.setdefault(key, found)
+            if len(key) > len(normalize_name(self._names[found], self.person)):
+                # 略称で先に登録されていたら、表示名は長い方（フルネーム）にする
+                self._names[found] = str(name).strip()
+            return found
+
+    def name(self, key):
+        return self._names[key] if 0 < key < len(self._names) else None
+
+    def keys_for(self, series: pd.Series, ids=None) -> pd.Series:
+        """列の値をまとめてキーに変換する（Int32）。名前ごとの処理は重複を除いた分だけ
+
+        ids … 行ごとのnetkeibaのID（series と同じ長さ。欠損の行は名前だけで決める）
+        """
+        if ids is not None and pd.Series(ids).notna().any():
+            pairs = pd.DataFrame({"name": series.astype(object).to_numpy(), "id": pd.Series(ids).astype(object).to_numpy()})
+            codes, uniques = pd.factorize(pd.MultiIndex.from_frame(pairs.where(pairs.notna(), None)))
+            lookup = np.array([self.intern(n, i) or 0 for n, i in uniques] + [0], dtype="int32")
+            values = lookup[codes]
+        elif isinstance(series.dtype, pd.CategoricalDtype):
+            lookup = np.array([self.intern(c) or 0 for c in series.cat.categories] + [0], dtype="int32")
+            codes = series.cat.codes.to_numpy()
+            values = lookup[codes]  # codes の -1（欠損）は末尾の0を指す
+        else:
+            uniques, codes = np.unique(series.astype(object).where(series.notna(), ""), return_inverse=True)
+            lookup = np.array([self.intern(u) or 0 for u in uniques], dtype="int32")
+            values = lookup[codes.reshape(-1)]
+        return pd.Series(pd.arrays.IntegerArray(values, values == 0), index=series.index)
+
+
+# プロセス共通の対応表（Streamlitの全セッションで共有される）
+HORSES = Interner()
+JOCKEYS = Interner(person=True)
+TRAINERS = Interner(person=True)
+
+# 名前の列 → (キーの列, 対応表)
+KEY_COLUMNS = {
+    "馬名": ("horse_key", HORSES),
+    "騎手": ("jockey_key", JOCKEYS),
+    "調教師": ("trainer_key", TRAINERS),
+}
+
+
+# 名前の列 → netkeibaのIDの列（あればキーを振るときに名前より優先する）
+ID_COLUMNS = {
+    "馬名": "horse_id",
+    "騎手": "jockey_id",
+    "調教師": "trainer_id",
+}
+
+
+def add_key_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """馬名・騎手・調教師の列があれば、それぞれの整数キーの列を末尾に足す
+
+    horse_id などのnetkeibaのIDの列があれば、同じ名前の別の馬を別のキーにする。
+    """
+    for col, (key_col, interner) in KEY_COLUMNS.items():
+        if col in df.columns and key_col not in df.columns:
+            id_col = ID_COLUMNS[col]
+            ids = pd.to_numeric(df[id_col], errors="coerce") if id_col in df.columns else None
+            df[key_col] = interner.keys_for(df[col], ids=ids)
+    return df
+
@@ -0,0 +1,84 @@
+"""近走の差分更新
+
+前回確認してから成績が出そろう時刻（RESULTS_READY）を一度も過ぎていない馬は、ページを
+取りに行かなくても新しい成績が増えていないことが分かる。そういう馬は飛ばし、取りに行く馬も
+ストアに無い（把握している最新の出走日より新しい）行だけを登録する。
+
+確認から日が経っていても、その間の開催日の出馬表がストアにあれば、出走したかどうかは分かる。
+- 出馬表に載ったレースが成績の出そろった後で、把握している最新の出走日より新しい → 取りに行く
+- その間に出馬表を取り込んだ開催日があり、どれにも出ていない → 飛ばす
+- その間の開催日がストアに1日も無い（何も分からない）→ 取りに行く
+
+中央の開催は土日（と祝日）だが、地方の交流重賞やナイターは平日にも走るので、曜日では判断しない。
+ストアに出馬表の無いレースに出ていることもあるので、確認から MAX_SKIP_DAYS 日を過ぎた馬は
+必ず取りに行く（前回と変わっていなければ条件付きリクエストの304で済む）。
+"""
+import datetime as dt
+import time
+
+# この時刻を過ぎれば、その日の成績はページに載っているとみなす（地方のナイターが終わった後）
+RESULTS_READY = dt.time(22, 0)
+
+# 出馬表から出走していないと分かっても、確認からこれだけ日が経った馬は取りに行く
+MAX_SKIP_DAYS = 28
+
+
+def last_results_ready(now=None):
+    """直近で成績が出そろった時刻（UNIX時刻）。now 以前で一番新しいもの"""
+    now = dt.datetime.fromtimestamp(now if now is not None else time.time())
+    ready = dt.datetime.combine(now.date(), RESULTS_READY)
+    if ready > now:
+        ready -= dt.timedelta(days=1)
+    return ready.timestamp()
+
+
+def next_results_ready(now=None):
+    """次に成績が出そろう時刻（UNIX時刻）。now より後で一番早いもの"""
+    now = dt.datetime.fromtimestamp(now if now is not None else time.time())
+    ready = dt.datetime.combine(now.date(), RESULTS_READY)
+    if ready <= now:
+        ready += dt.timedelta(days=1)
+    return ready.timestamp()
+
+
+def _ready_day(timestamp):
+    """その時刻までに成績が出そろった一番新しい日（YYYY-MM-DD）"""
+    return dt.date.fromtimestamp(last_results_ready(timestamp)).isoformat()
+
+
+def plan_refresh(store, horse_names, now=None, netkeiba_ids=None):
+    """取りに行く馬と飛ばす馬に分ける。(to_fetch, skipped) を返す
+
+    確認した後に成績が出そろった開催日のうち、ストアに出馬表がある日を見て、
+    新しい成績があり得る馬だけを取りに行く（判断の仕方はモジュールの説明のとおり）。
+    netkeiba_ids（{馬名: netkeibaのID}）があれば、その馬はIDでストアを引く。
+    """
+    now = now if now is not None else time.time()
+    ready = last_results_ready(now)
+    ready_day = _ready_day(now)
+    state = store.sync_state(horse_names, netkeiba_ids)
+    entered = store.entry_dates(horse_names, netkeiba_ids)
+    checked = [c for _, c in state.values() if c is not None]
+    race_days = store.entry_days(_ready_day(min(checked)), ready_day) if checked else set()
+
+    to_fetch, skipped = [], []
+    for name in horse_names:
+        latest, checked_at = state.get(str(name), (None, None))
+        if checked_at is None:
+            to_fetch.append(name)
+            continue
+        if checked_at >= ready:
+            skipped.append(name)
+            continue
+        # 確認した時点ではまだ成績が出そろっていなかった日から、直近で出そろった日まで
+        since = _ready_day(checked_at)
+        ran = any(
+            since < day <= ready_day and (latest is None or day > latest)
+            for day in entered.get(str(name), ())
+        )
+        known = any(since < day <= ready_day for day in race_days)
+        if ran or not known or now - checked_at > MAX_SKIP_DAYS * 86400:
+            to_fetch.append(name)
+        else:
+            skipped.append(name)
+    return to_fetch, skipped
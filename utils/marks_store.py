@@ -0,0 +1,149 @@
+"""ユーザー・レースごとの印の保存（変更はまとめて後から書き込む）
+
+印は (ユーザー, レース, 馬) ごとに RaceStore の marks テーブルへ入れる。
+1つのCSVを丸ごと書き直す代わりに、変わった馬の行だけを書く。
+1つのレースの中では馬名で扱い、DBへ書くときは分かっていればnetkeibaのIDで馬を引く
+（同じ馬名の昔の馬に印を付けない）。
+
+- 読み込み … プロセス内のキャッシュから返す（DBを読むのは (ユーザー, レース) ごとに最初の1回）。
+  キャッシュの辞書は書き換えずに差し替えるので、読む側はロックを取らない
+- 書き込み … キャッシュはすぐに更新し、DBへは最後の変更から DEBOUNCE_SECONDS 後に
+  バックグラウンドのスレッドでまとめて書く。プロセス終了時にも書き残しを書き出す
+"""
+import atexit
+import sys
+import threading
+import time
+
+from utils.race_store import DB_PATH, RaceStore
+
+# 最後の変更からこれだけ待ってから書き込む（連続して印を変えても1回にまとめる）
+DEBOUNCE_SECONDS = 1.0
+
+
+class MarksStore:
+    def __init__(self, store=None, debounce: float = DEBOUNCE_SECONDS):
+        self.store = store or RaceStore()
+        self.debounce = debounce
+        # (user, race_key) -> {馬名: 印}。中身は書き換えず、変更時は新しい辞書に差し替える
+        self._cache = {}
+        self._pending = {}
+        # (user, race_key) -> {馬名: netkeibaのID}（書き込むときに馬を引く）
+        self._ids = {}
+        self._lock = threading.Lock()
+        # 書き込みは1本ずつ（先に取り出した変更が後から書かれないように）
+        self._write_lock = threading.Lock()
+        self._timer = None
+
+    def get(self, user, race_key):
+        """{馬名: 印}（読み取り専用。書き換えないこと）"""
+        key = (str(user), str(race_key))
+        marks = self._cache.get(key)
+        if marks is None:
+            loaded = self.store.marks(user=key[0], race_key=key[1])
+            with self._lock:
+                # 読んでいる間に書かれた分は残す
+                marks = self._cache.setdefault(key, loaded)
+        return marks
+
+    def __sizeof__(self):
+        """キャッシュしている印まで含めたバイト数（sys.getsizeof 用）"""
+        cache = self._cache
+        return object.__sizeof__(self) + sys.getsizeof(cache) + sum(
+            sys.getsizeof(marks) + sum(sys.getsizeof(name) + sys.getsizeof(mark) for name, mark in marks.items())
+            for marks in cache.values()
+        )
+
+    def set(self, user, race_key, horse_name, mark, netkeiba_id=None):
+        """印を変える。キャッシュにはすぐ反映し、DBへは少し後にまとめて書く"""
+        self.update(user, race_key, {horse_name: mark}, {horse_name: netkeiba_id})
+
+    def update(self, user, race_key, marks, netkeiba_ids=None):
+        """marks: {馬名: 印}。変わった馬の分だけを書き込み待ちにする
+
+        netkeiba_ids（{馬名: netkeibaのID}）を渡すと、書き込むときにその馬をIDで引く。
+        """
+        key = (str(user), str(race_key))
+        current = self.get(*key)
+        # CSVから読んだ空の印は NaN なので、文字列以外は「印なし」として扱う
+        marks = {str(name): mark if isinstance(mark, str) else "" for name, mark in marks.items()}
+        changes = {name: mark for name, mark in marks.items() if current.get(name, "") != mark}
+        if not changes:
+            return
+        with self._lock:
+            merged = dict(self._cache.get(key, current))
+            for name, mark in changes.items():
+                if mark:
+                    merged[name] = mark
+                else:
+                    merged.pop(name, None)
+            self._cache[key] = merged
+            self._pending.setdefault(key, {}).update(changes)
+            ids = {str(name): nid for name, nid in (netkeiba_ids or {}).items() if nid is not None}
+            if ids:
+                self._ids[key] = {**self._ids.get(key, {}), **ids}
+            self._schedule()
+
+    def import_once(self, tag, user, race_key, load, netkeiba_ids=None):
+        """load() が返す {馬名: 印} を取り込む。tag の取り込みが済んでいれば load も呼ばない（取り込んだら True）
+
+        済んだことはストアの meta テーブルに記録する（印を全部消した後も取り込み直さない）。
+        """
+        if self.store.get_meta(tag) is not None:
+            return False
+        self.update(user, race_key, load(), netkeiba_ids)
+        # 印を書いてから記録する（途中で落ちても取り込み直せるように）
+        self.flush()
+        self.store.set_meta(tag, time.time())
+        return True
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(self.debounce, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def pending_count(self):
+        with self._lock:
+            return sum(len(changes) for changes in self._pending.values())
+
+    def flush(self):
+        """書き込み待ちの変更をすぐにDBへ書く。書いた件数を返す"""
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            written = 0
+            try:
+                for (user, race_key), changes in pending.items():
+                    ids = self._ids.get((user, race_key), {})
+                    self.store.upsert_marks(
+                        changes, user=user, race_key=race_key,
+                        netkeiba_ids={name: ids[name] for name in changes if name in ids},
+                    )
+                    written += len(changes)
+            except Exception:
+                # 書けなかった分は戻して次の機会に書く（後から入った変更を優先する）
+                with self._lock:
+                    for key, changes in pending.items():
+                        self._pending[key] = {**changes, **self._pending.get(key, {})}
+                raise
+            return written
+
+
+_marks_stores = {}
+_marks_stores_lock = threading.Lock()
+
+
+def get_marks_store(db_path=DB_PATH):
+    """プロセス共通の MarksStore（Streamlitの全セッションで共有。終了時に書き残しを書く）"""
+    key = str(db_path)
+    with _marks_stores_lock:
+        marks_store = _marks_stores.get(key)
+        if marks_store is None:
+            marks_store = _marks_stores[key] = MarksStore(RaceStore(db_path))
+            atexit.register(marks_store.flush)
+        return marks_store
@@ -0,0 +1,212 @@
+"""競馬新聞風の近走カードをまとめて1つのHTMLにする
+
+カードごとにインラインのstyleを繰り返さず、共通のCSSクラスを使う。
+各列は列ごとにまとめて文字列に変換し（iterrowsは使わない）、
+組み立て済みのテンプレートに流し込む。
+"""
+import html
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from utils.schema import format_time
+
+CSS = (
+    "<style>"
+    ".kp-row{display:flex;gap:8px;overflow-x:auto;padding:6px 2px;-webkit-overflow-scrolling:touch;"
+    "-ms-overflow-style:none;scrollbar-width:none;}"
+    ".kp-row::-webkit-scrollbar{display:none;}"
+    ".kp-card{flex:0 0 210px;height:150px;background:#fffdfa;border:1px solid #ccc;border-radius:8px;"
+    "box-shadow:1px 1px 3px rgba(0,0,0,0.12);padding:6px 8px;margin-right:8px;"
+    "font-family:Yu Gothic,Meiryo,sans-serif;font-size:12px;line-height:1.3;color:#222;}"
+    ".kp-card.f1{background:#fff8dc;border-color:#d1b000;}"  # 金
+    ".kp-card.f2{background:#eaf3ff;border-color:#4a90e2;}"  # 青
+    ".kp-card.f3{background:#ffeaea;border-color:#ff7070;}"  # 赤
+    ".kp-t{font-weight:700;font-size:13px;color:#333;}"
+    ".kp-g{font-size:10px;color:#555;}"
+    ".kp-d{font-size:11px;color:#666;margin-bottom:4px;}"
+    ".kp-l{margin-bottom:3px;}"
+    ".kp-m{color:#777;}"
+    ".kp-warn{background:#fffbe6;color:#8a6d00;border-radius:6px;padding:10px 14px;margin:8px 0;}"
+    "</style>"
+)
+
+# カード1枚のテンプレート（% で流し込む。並びは _CARD_FIELDS の順）
+_CARD = (
+    '<div class="kp-card%s">'
+    '<div class="kp-t">%s <span class="kp-g">%s</span></div>'
+    '<div class="kp-d">%s　%s</div>'
+    '<div class="kp-l">着：<b>%s</b>　人：%s　差：%s　時計：%s <span class="kp-m">（上り %s）</span></div>'
+    '<div class="kp-l">%s（%s）　通過：%s</div>'
+    '</div>'
+)
+_CARD_FIELDS = [
+    "cls", "race", "grade", "date", "course", "result", "pop", "diff", "time", "last3f",
+    "jockey", "weight", "passing",
+]
+_HEADER = '<h4>🐴 %s</h4><div class="kp-row">'
+_HIDDEN = '<div class="kp-warn">『%s』は『消』印が付いているため、近5走は非表示です。</div>'
+
+
+# ==============================
+# 列ごとの文字列化
+# ==============================
+def _format_column(series, func):
+    """値の種類ごとに1回だけ func を呼んで文字列の配列にする（欠損は空文字）"""
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    table = np.array([func(u) for u in uniques] + [""], dtype=object)
+    return table[codes]  # 欠損の -1 は末尾の空文字を指す
+
+
+def _text(value):
+    return html.escape(str(value))
+
+
+def _number(spec):
+    def func(value):
+        if pd.api.types.is_float(value):
+            return format(value, spec)
+        return _text(value)
+    return func
+
+
+def _column(df, *names, func=_text):
+    for name in names:
+        if name in df.columns:
+            return _format_column(df[name], func)
+    return np.full(len(df), "", dtype=object)
+
+
+def _card_columns(df):
+    finish = np.full(len(df), np.nan)
+    if "着順" in df.columns:
+        finish = pd.to_numeric(df["着順"], errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+    cls = np.select([finish == 1, finish == 2, finish == 3], [" f1", " f2", " f3"], default="")
+    date = _column(df, "日付")
+    if "レース日" in df.columns:
+        date = np.where(date == "", _column(df, "レース日"), date)
+    return {
+        "cls": cls,
+        "race": _column(df, "レース名"),
+        "grade": _column(df, "グレード"),
+        "date": date,
+        "course": _column(df, "コース"),
+        "result": _column(df, "着順", func=_number("g")),
+        "pop": _column(df, "人気", func=_number("g")),
+        "diff": _column(df, "着差", func=_number("g")),
+        "time": _column(df, "タイム", func=format_time),
+        "last3f": _column(df, "上り", func=_number(".1f")),
+        "jockey": _column(df, "騎手"),
+        "weight": _column(df, "斤量", func=_number("g")),
+        "passing": _column(df, "通過", "コーナー通過"),
+    }
+
+
+# ==============================
+# 新聞全体
+# ==============================
+def render_cards(df: pd.DataFrame):
+    """近走の行をカードのHTML文字列のリストにする"""
+    if df.empty:
+        return []
+    columns = _card_columns(df)
+    return [_CARD % values for values in zip(*(columns[f] for f in _CARD_FIELDS))]
+
+
+def _render_index(index, horse_keys, n):
+    """horse_keys の馬のカードを1回でまとめて作る。{horse_key: [カードのHTML]}
+
+    CSVのインデックスは全期間の全馬を持つので、出走馬の分だけを作る。
+    """
+    keys = [key for key in horse_keys if len(index.get(key, ()))]
+    if not keys:
+        return {}
+    frames = [index[key] if len(index[key]) <= n else index[key].head(n) for key in keys]
+    cards = render_cards(pd.concat(frames, ignore_index=True))
+    by_key, pos = {}, 0
+    for key, frame in zip(keys, frames):
+        by_key[key] = cards[pos:pos + len(frame)]
+        pos += len(frame)
+    return by_key
+
+
+def render_strip(df: pd.DataFrame) -> str:
+    """1頭分の近走カードを横並びにしたHTML（クラスの定義 CSS はページ内で別に1回出しておく）"""
+    return '<div class="kp-row">' + "".join(render_cards(df)) + "</div>"
+
+
+class _Memo:
+    """オブジェクトの同一性を含むキーで結果を覚えておくLRU
+
+    インデックスはファイルが変わるまで同じオブジェクトなので id() をキーに使う。
+    値と一緒にインデックスも持っておき、同じidの別オブジェクトと取り違えないようにする。
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, index, key, build):
+        key = (id(index), *key)
+        with self._lock:
+            cached = self._items.get(key)
+            if cached is not None and cached[0] is index:
+                self._items.move_to_end(key)
+                return cached[1]
+        value = build()
+        with self._lock:
+            self._items[key] = (index, value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return value
+
+    def values(self):
+        """覚えている結果の一覧（インデックス自体は含めない）"""
+        with self._lock:
+            return [value for _, value in self._items.values()]
+
+
+# インデックスごとのカード（データが変わるまで作り直さない）
+_card_memo = _Memo(8)
+# (インデックス, 表示順, 消した馬, n) → 新聞全体のHTML
+_page_memo = _Memo(64)
+
+
+def memo_items():
+    """覚えているHTML {"近走カード": [...], "新聞HTML": [...]}（メモリの内訳を出す用）"""
+    return {"近走カード": _card_memo.values(), "新聞HTML": _page_memo.values()}
+
+
+def build_newspaper(index, horses, hidden=frozenset(), n: int = 5):
+    """表示順の (horse_key, 馬名) のリストから近走部分のHTMLを1つ作る
+
+    index は horse_key → 近走 の辞書（utils.data_loader.load_horse_index など）。
+    hidden に入っている馬は「消」の注意書きだけを出す。カードはインデックスと出走馬の
+    組ごとに1回だけ作り（並び順や「消」が変わっても作り直さない）、ここでは並べ替えてつなぐだけにする。
+    """
+    horses = list(horses)
+    field = frozenset(key for key, _ in horses)
+    cards = _card_memo.get(index, (field, n), lambda: _render_index(index, field, n))
+    parts = [CSS]
+    for key, name in horses:
+        if key in hidden:
+            parts.append(_HIDDEN % _text(name))
+            continue
+        horse_cards = cards.get(key)
+        if not horse_cards:
+            continue
+        parts.append(_HEADER % _text(name))
+        parts.extend(horse_cards)
+        parts.append("</div>")
+    return "".join(parts)
+
+
+def render_newspaper(index, horses, hidden=frozenset(), n: int = 5):
+    """build_newspaper のメモ化版（レース・印・並び順が同じなら作り直さない）"""
+    horses = tuple(horses)
+    # 表示しない馬以外の印は結果に影響しないので、キーには出走馬の「消」だけを入れる
+    hidden = frozenset(key for key, _ in horses if key in hidden)
+    return _page_memo.get(index, (horses, hidden, n), lambda: build_newspaper(index, horses, hidden, n))
@@ -0,0 +1,236 @@
+"""取得 → パース → 書き込み を段に分けて並列に流す
+
+ページの取得は待ち時間がほとんど（I/O）、BeautifulSoup/lxml でのパースはCPUを使うので、
+同じスレッドで順にやると1コアしか使えず、パースの間はネットワークも止まる。ここでは
+
+    取得（スレッド download_workers 本） → [キュー] → パース（プロセスプール parse_workers 個）
+        → [キュー] → 書き込み（呼び出したスレッドで1件ずつ）
+
+に分けて、取得とパースを重ねる。段の間のキューは queue_size 件までなので、パースや書き込みが
+追いつかなければ取得が待つ（取得したHTMLがメモリに溜まり続けない）。
+
+各段の処理件数・かかった時間・1秒あたりの件数は run_pipeline() の戻り値（PipelineStats）に入る。
+パース用のプロセスで計ったスパン（utils.timing）は、1件ごとにこのプロセスの集計へ足す。
+
+パース用のプロセスは fork で作らない（forkserver、無ければ spawn）。プロセスは最初の submit で
+作られ、そのとき取得のスレッドが timing や流量制御のロックを持っていることがあり、fork した子には
+ロックが持たれたまま写ってデッドロックするため。
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from utils import timing
+
+# 段の間のキューに溜めてよい件数（既定は並列数の2倍）
+QUEUE_FACTOR = 2
+
+_DONE = object()
+
+
+def _mp_context():
+    """パース用のプロセスの起動方法（スレッドのロックを引き継がない forkserver か spawn）"""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+# ==============================
+# 段ごとの集計
+# ==============================
+class StageStats:
+    """1段分の件数と時間
+
+    busy … 各件の処理時間の合計（並列に動いた分も足す）
+    elapsed … 最初の1件が始まってから最後の1件が終わるまで
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.failed = 0
+        self.busy = 0.0
+        self._first = None
+        self._last = None
+        self._lock = threading.Lock()
+
+    def record(self, started, ended, ok=True):
+        """started / ended は time.time()（パースは別プロセスで測るので monotonic は使えない）"""
+        with self._lock:
+            self.count += 1
+            self.failed += not ok
+            self.busy += ended - started
+            self._first = started if self._first is None else min(self._first, started)
+            self._last = ended if self._last is None else max(self._last, ended)
+
+    @property
+    def elapsed(self):
+        return 0.0 if self._first is None else self._last - self._first
+
+    @property
+    def rate(self):
+        """1秒あたりの件数"""
+        return self.count / self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            "stage": self.name, "pages": self.count, "failed": self.failed,
+            "elapsed": round(self.elapsed, 3), "busy": round(self.busy, 3), "pages_per_sec": round(self.rate, 2),
+        }
+
+
+class PipelineStats:
+    def __init__(self):
+        self.download = StageStats("取得")
+        self.parse = StageStats("パース")
+        self.write = StageStats("書き込み")
+        self.elapsed = 0.0
+
+    @property
+    def stages(self):
+        return [self.download, self.parse, self.write]
+
+    def report(self) -> str:
+        lines = []
+        for stage in self.stages:
+            failed = f"（失敗 {stage.failed}）" if stage.failed else ""
+            lines.append(
+                f"⏱ {stage.name}: {stage.count}ページ {stage.elapsed:.1f}秒 "
+                f"{stage.rate:.1f}ページ/秒 処理時間の合計 {stage.busy:.1f}秒{failed}"
+            )
+        lines.append(f"⏱ 全体: {self.elapsed:.1f}秒")
+        return "\n".join(lines)
+
+
+def _timed(parse, payload):
+    """ワーカープロセスで parse を呼び、(結果, 開始時刻, 終了時刻, その間のスパン) を返す"""
+    started = time.time()
+    result = parse(payload)
+    return result, started, time.time(), timing.drain()
+
+
+def _put(q, value, stop):
+    """q が空くまで待って入れる（stop が立ったら諦める）"""
+    while not stop.is_set():
+        try:
+            q.put(value, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+# ==============================
+# 実行
+# ==============================
+def run_pipeline(items, download, parse, write, download_workers=4, parse_workers=None, queue_size=None):
+    """items を 取得 → パース → 書き込み の順に流す。PipelineStats を返す
+
+    download(item) … パースに渡すもの（payload）を返す。スレッドで並列に呼ぶ。
+        None を返すか例外なら、パースせずに write(item, None) を呼ぶ
+    parse(payload) … プロセスプールで呼ぶ（別プロセスに送るので、トップレベルの関数にする）。
+        例外なら write(item, None)
+    write(item, result) … 呼び出したスレッドで1件ずつ呼ぶ（DBやファイルへの書き込みをまとめる）
+
+    parse_workers … パースのプロセス数（既定はCPU数）。0 ならプロセスを分けず、
+        1本のスレッドでパースする（すでにレースごとにプロセスを分けているときなど）
+    """
+    items = list(items)
+    stats = PipelineStats()
+    if not items:
+        return stats
+    parse_workers = (os.cpu_count() or 1) if parse_workers is None else parse_workers
+    queue_size = queue_size or QUEUE_FACTOR * max(download_workers, parse_workers, 1)
+
+    todo = queue.Queue()
+    for item in items:
+        todo.put(item)
+    downloaded = queue.Queue(maxsize=queue_size)
+    parsed = queue.Queue()
+    # パース中と、パースが終わって書き込み待ちの件数の上限
+    slots = threading.Semaphore(queue_size)
+    stop = threading.Event()
+
+    def downloader():
+        while not stop.is_set():
+            try:
+                item = todo.get_nowait()
+            except queue.Empty:
+                return
+            started = time.time()
+            try:
+                payload = download(item)
+            except Exception as e:
+                print(f"⚠️ {item}: 取得中にエラー ({e})")
+                payload = None
+            stats.download.record(started, time.time(), ok=payload is not None)
+            if not _put(downloaded, (item, payload), stop):
+                return
+
+    def close_downloads(threads):
+        for t in threads:
+            t.join()
+        _put(downloaded, _DONE, stop)
+
+    def dispatcher(pool):
+        futures = []
+        while not stop.is_set():
+            try:
+                entry = downloaded.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if entry is _DONE:
+                break
+            item, payload = entry
+            if payload is None:
+                parsed.put((item, None))
+                continue
+            while not slots.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            future = pool.submit(_timed, parse, payload)
+            future.add_done_callback(lambda f, item=item: parsed.put((item, f)))
+            futures.append(future)
+        wait(futures)
+        parsed.put(_DONE)
+
+    started = time.perf_counter()
+    if parse_workers:
+        # 新しいインタプリタで始まるので、親のロックも集計も引き継がない
+        pool = ProcessPoolExecutor(max_workers=parse_workers, mp_context=_mp_context())
+    else:
+        pool = ThreadPoolExecutor(max_workers=1)
+    threads = [threading.Thread(target=downloader, daemon=True) for _ in range(min(download_workers, len(items)))]
+    helpers = [
+        threading.Thread(target=close_downloads, args=(threads,), daemon=True),
+        threading.Thread(target=dispatcher, args=(pool,), daemon=True),
+    ]
+    for t in threads + helpers:
+        t.start()
+    try:
+        while True:
+            entry = parsed.get()
+            if entry is _DONE:
+                break
+            item, future = entry
+            result = None
+            if future is not None:
+                slots.release()
+                try:
+                    result, parse_started, parse_ended, spans = future.result()
+                    stats.parse.record(parse_started, parse_ended)
+                    timing.merge(spans)
+                except Exception as e:
+                    print(f"⚠️ {item}: パース中にエラー ({e})")
+                    now = time.time()
+                    stats.parse.record(now, now, ok=False)
+            write_started = time.time()
+            write(item, result)
+            stats.write.record(write_started, time.time(), ok=result is not None)
+    finally:
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+        stats.elapsed = time.perf_counter() - started
+    return stats
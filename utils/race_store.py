@@ -0,0 +1,949 @@
+"""出馬表・近走・印をまとめて持つSQLiteのストア
+
+CSVをアプリの描画時に馬名でつなぐ代わりに、ここへまとめて入れておき、
+「この18頭の近5走」を1回のインデックス付きクエリで取り出す。
+
+    python -m utils.race_store import   # data/ のCSVを取り込む
+    python -m utils.race_store query --surface 芝 --min-distance 2400 --last 10 イクイノックス
+"""
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+from utils.ids import Interner, netkeiba_id, normalize_name
+from utils.schema import apply_entry_schema, apply_race_schema, race_class
+
+DB_PATH = Path("data/keiba.db")
+
+SCHEMA = """
+-- 馬はnetkeibaのIDで見分ける（同じ馬名の別の馬がいるので name は一意にしない）
+CREATE TABLE IF NOT EXISTS horses (
+    id          INTEGER PRIMARY KEY,
+    name        TEXT NOT NULL,
+    url         TEXT,
+    netkeiba_id INTEGER               -- db.netkeiba.com/horse/<ID>/
+);
+
+-- 騎手・調教師。出馬表の略称（川田）と成績のフルネーム（川田将雅）は同じ行にまとめる
+CREATE TABLE IF NOT EXISTS jockeys (
+    id          INTEGER PRIMARY KEY,
+    name        TEXT NOT NULL UNIQUE,
+    netkeiba_id INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS trainers (
+    id          INTEGER PRIMARY KEY,
+    name        TEXT NOT NULL UNIQUE,
+    netkeiba_id INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS races (
+    id         INTEGER PRIMARY KEY,
+    race_key   TEXT NOT NULL UNIQUE,  -- netkeibaのレースID。無ければ '日付:開催:R'（古いCSVは '日付:レース名'）
+    date       TEXT,                  -- YYYY-MM-DD
+    name       TEXT,
+    class      TEXT,
+    surface    TEXT,
+    distance   INTEGER,
+    going      TEXT,
+    field_size INTEGER,
+    pace       TEXT
+);
+
+CREATE TABLE IF NOT EXISTS entries (
+    race_id    INTEGER NOT NULL REFERENCES races(id),
+    horse_id   INTEGER NOT NULL REFERENCES horses(id),
+    waku       INTEGER,
+    umaban     INTEGER,
+    sex_age    TEXT,
+    weight     REAL,
+    jockey     TEXT,
+    trainer    TEXT,
+    jockey_id  INTEGER REFERENCES jockeys(id),
+    trainer_id INTEGER REFERENCES trainers(id),
+    body_weight INTEGER,
+    odds       REAL,
+    popularity INTEGER,
+    PRIMARY KEY (race_id, horse_id)
+);
+
+CREATE TABLE IF NOT EXISTS results (
+    horse_id   INTEGER NOT NULL REFERENCES horses(id),
+    race_id    INTEGER NOT NULL REFERENCES races(id),
+    date       TEXT,                  -- races.date の写し（馬ごとの新しい順で引くため）
+    waku       INTEGER,
+    umaban     INTEGER,
+    jockey     TEXT,
+    jockey_id  INTEGER REFERENCES jockeys(id),
+    weight     REAL,
+    time_sec   REAL,
+    finish     INTEGER,
+    popularity INTEGER,
+    passing    TEXT,
+    last3f     REAL,
+    margin     TEXT,
+    PRIMARY KEY (horse_id, race_id)
+);
+
+CREATE TABLE IF NOT EXISTS marks (
+    user     TEXT NOT NULL DEFAULT '',
+    race_id  INTEGER NOT NULL DEFAULT 0,
+    horse_id INTEGER NOT NULL REFERENCES horses(id),
+    mark     TEXT NOT NULL,
+    PRIMARY KEY (user, race_id, horse_id)
+);
+
+-- 差分更新用：馬ごとに把握している最新の出走日と、最後に確認した時刻
+CREATE TABLE IF NOT EXISTS horse_sync (
+    horse_id    INTEGER PRIMARY KEY REFERENCES horses(id),
+    latest_date TEXT,                 -- YYYY-MM-DD
+    checked_at  REAL                  -- UNIX時刻
+);
+
+-- 一度だけ行う処理（古いファイルの取り込みなど）を済ませたかどうか
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_results_horse_date ON results (horse_id, date DESC);
+CREATE INDEX IF NOT EXISTS idx_results_race ON results (race_id);
+CREATE INDEX IF NOT EXISTS idx_entries_race ON entries (race_id);
+"""
+
+# 後から足した列（古いDBには ALTER TABLE で足す）
+ADDED_COLUMNS = [
+    ("horses", "netkeiba_id", "INTEGER"),
+    ("entries", "jockey_id", "INTEGER REFERENCES jockeys(id)"),
+    ("entries", "trainer_id", "INTEGER REFERENCES trainers(id)"),
+    ("results", "jockey_id", "INTEGER REFERENCES jockeys(id)"),
+    ("races", "venue", "TEXT"),                # 競馬場（東京・中山 …）
+    ("horse_sync", "backfilled_at", "REAL"),   # 全成績を取り込んだ時刻（UNIX時刻）
+]
+
+# 足した列を使うインデックス（列を足した後に作る）
+POST_MIGRATION = """
+CREATE UNIQUE INDEX IF NOT EXISTS idx_horses_netkeiba ON horses (netkeiba_id);
+CREATE INDEX IF NOT EXISTS idx_horses_name ON horses (name);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_jockeys_netkeiba ON jockeys (netkeiba_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_trainers_netkeiba ON trainers (netkeiba_id);
+CREATE INDEX IF NOT EXISTS idx_races_date ON races (date);
+CREATE INDEX IF NOT EXISTS idx_races_course ON races (surface, distance);
+"""
+
+# 以前の horses（name が UNIQUE）を作り直す。外部キーの検査を切ってから行う
+HORSES_REBUILD = [
+    "CREATE TABLE horses_new (id INTEGER PRIMARY KEY, name TEXT NOT NULL, url TEXT, netkeiba_id INTEGER)",
+    "INSERT INTO horses_new (id, name, url, netkeiba_id) SELECT id, name, url, netkeiba_id FROM horses",
+    "DROP TABLE horses",
+    "ALTER TABLE horses_new RENAME TO horses",
+]
+
+# results/races の列 → アプリで使っている日本語の列名
+RESULT_COLUMNS = {
+    "horse_name": "馬名",
+    "netkeiba_id": "horse_id",
+    "date": "日付",
+    "race_name": "レース名",
+    "class": "クラス",
+    "field_size": "頭数",
+    "waku": "枠番",
+    "umaban": "馬番",
+    "jockey": "騎手",
+    "weight": "斤量",
+    "surface": "芝ダ",
+    "distance": "距離",
+    "going": "馬場",
+    "time_sec": "タイム",
+    "finish": "着順",
+    "popularity": "人気",
+    "passing": "コーナー通過",
+    "last3f": "上り",
+    "pace": "ペース",
+    "margin": "着差",
+    "venue": "場",
+}
+
+ENTRY_COLUMNS = {
+    "umaban": "馬番",
+    "waku": "枠番",
+    "horse_name": "馬名",
+    "sex_age": "性齢",
+    "weight": "斤量",
+    "jockey": "騎手",
+    "trainer": "調教師",
+    "body_weight": "馬体重",
+    "odds": "単勝オッズ",
+    "popularity": "人気",
+}
+
+
+def _value(v):
+    """pandasの欠損やnumpyの数値をSQLiteに入れられる形にする"""
+    if v is None:
+        return None
+    try:
+        if pd.isna(v):
+            return None
+    except (TypeError, ValueError):
+        pass
+    v = v.item() if hasattr(v, "item") else v
+    if isinstance(v, float):
+        # float32 由来の 115.199997 を 115.2 に戻す（どの列も小数2桁までしか使わない）
+        return round(v, 4)
+    return v
+
+
+def _netkeiba_ids(df, id_col, name_col="馬名"):
+    """{名前: netkeibaのID}（id_col が無ければ空）"""
+    if id_col not in df.columns or name_col not in df.columns:
+        return {}
+    ids = pd.to_numeric(df[id_col], errors="coerce")
+    return {name: int(i) for name, i in zip(df[name_col], ids) if not pd.isna(i) and not pd.isna(name)}
+
+
+def horse_netkeiba_ids(df):
+    """{馬名: netkeibaの馬ID}（horse_id 列、無ければ horse_url から取る。どちらも無ければ空）"""
+    ids = _netkeiba_ids(df, "horse_id")
+    if not ids and "horse_url" in df.columns and "馬名" in df.columns:
+        ids = {
+            name: netkeiba_id(url) for name, url in zip(df["馬名"], df["horse_url"])
+            if netkeiba_id(url) is not None and not pd.isna(name)
+        }
+    return ids
+
+
+def _rows_netkeiba_id(rows, netkeiba_id=None):
+    """1頭分の近走（dictのリスト）の horse_id。netkeiba_id を渡せばそれを使う"""
+    if netkeiba_id is None:
+        netkeiba_id = next((r.get("horse_id") for r in rows if _value(r.get("horse_id")) is not None), None)
+    return _value(netkeiba_id)
+
+
+def _horse_key(name, nid=None):
+    """馬を引くときの (馬名, netkeibaのID)。IDが分からなければ None"""
+    nid = _value(nid)
+    return str(name), None if nid is None else int(nid)
+
+
+def _name_is_unique(conn):
+    """horses の name に UNIQUE 制約がある（以前のスキーマの）DBか"""
+    for _, index, unique, origin, *_ in conn.execute("PRAGMA index_list(horses)").fetchall():
+        columns = [row[2] for row in conn.execute(f'PRAGMA index_info("{index}")')]
+        if unique and origin == "u" and columns == ["name"]:
+            return True
+    return False
+
+
+def _past_race_keys(df, dates):
+    """近走の各行の race_key と、以前の形の '日付:レース名'（(keys, legacy) の組）
+
+    netkeibaのレースID（レース名のリンクから取った レースID 列）→ 日付:開催:R → 日付:レース名 の順に使う。
+    同じ日の同じ名前のレース（3歳未勝利など）が別の競馬場にあっても1つにまとめないため。
+    """
+    dates = dates.fillna("").astype(str)
+    legacy = dates + ":" + df["レース名"].astype(str)
+    keys = legacy
+    if "開催" in df.columns and "R" in df.columns:
+        meeting, number = df["開催"].astype("string").str.strip(), df["R"].astype("string").str.strip()
+        known = meeting.fillna("").ne("") & number.fillna("").ne("")
+        keys = (dates + ":" + meeting.fillna("") + ":" + number.fillna("")).where(known, keys)
+    if "レースID" in df.columns:
+        ids = df["レースID"]
+        if pd.api.types.is_numeric_dtype(ids):
+            # CSVから読むと数値になっていることがある
+            ids = ids.astype("Int64")
+        ids = ids.astype("string").str.strip()
+        keys = ids.where(ids.fillna("").ne(""), keys)
+    return keys.astype(str), legacy
+
+
+def _iso_date(series):
+    return pd.to_datetime(series, errors="coerce").dt.strftime("%Y-%m-%d")
+
+
+class RaceStore:
+    """スレッドごとに接続を持つSQLiteストア（WALモードなので読み込みは書き込みを待たない）"""
+
+    def __init__(self, path=DB_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+            for table, column, decl in ADDED_COLUMNS:
+                existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+            self._migrate_horses(conn)
+            conn.executescript(POST_MIGRATION)
+
+    @staticmethod
+    def _migrate_horses(conn):
+        """以前のDBの horses から name の UNIQUE を外す（同じ馬名の別の馬を別の行にするため）
+
+        SQLite は制約を ALTER TABLE で外せないので、表を作り直して移す（id はそのまま）。
+        """
+        if not _name_is_unique(conn):
+            return
+        conn.commit()
+        conn.execute("PRAGMA foreign_keys=OFF")
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 別のプロセスが先に作り直していれば何もしない
+                if _name_is_unique(conn):
+                    for sql in HORSES_REBUILD:
+                        conn.execute(sql)
+                    broken = conn.execute("PRAGMA foreign_key_check").fetchall()
+                    if broken:
+                        raise sqlite3.IntegrityError(f"horses の作り直しで外部キーが壊れます: {broken[:5]}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.execute("PRAGMA foreign_keys=ON")
+
+    def connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # ==============================
+    # 一括登録（すでにあれば更新）
+    # ==============================
+    def upsert_horses(self, names, urls=None, netkeiba_ids=None):
+        """馬を登録し、{馬名: horse_id} を返す
+
+        netkeiba_ids（{馬名: netkeibaのID}）があれば、その馬はIDで照合する。
+        同じIDで登録済みなら馬名の表記が違っても同じ馬、同じ馬名でもIDが違えば別の馬にする。
+        """
+        netkeiba_ids = netkeiba_ids or {}
+        names = [n for n in dict.fromkeys(names) if n is not None and not pd.isna(n)]
+        ids = self._resolve_horses([(n, netkeiba_ids.get(n)) for n in names], urls=urls or {}, create=True)
+        return {name: horse_id for (name, _), horse_id in ids.items()}
+
+    def horse_ids(self, names, netkeiba_ids=None):
+        """{馬名: horse_id}（登録されていない馬は含まない。netkeiba_ids の意味は upsert_horses と同じ）"""
+        netkeiba_ids = netkeiba_ids or {}
+        names = [n for n in dict.fromkeys(names) if n is not None and not pd.isna(n)]
+        ids = self._resolve_horses([(n, netkeiba_ids.get(n)) for n in names])
+        return {name: horse_id for (name, _), horse_id in ids.items()}
+
+    def _resolve_horses(self, pairs, urls=None, create=False):
+        """(馬名, netkeibaのID) の組 → horses.id の辞書（キーは _horse_key の形）
+
+        IDが分かる馬はIDで引く。そのIDの行が無ければ、IDの無い同名の行（古いCSVから入った馬）を使う。
+        IDが分からない馬だけ馬名で引き、同名の馬が何頭もいれば最近走った方にする。
+        create=True なら見つからない馬を登録し、分かったIDとURLを書き込む。
+        """
+        keys = list(dict.fromkeys(_horse_key(n, nid) for n, nid in pairs))
+        urls = urls or {}
+        conn = self.connect()
+
+        by_nid = {}
+        wanted = [nid for _, nid in keys if nid is not None]
+        for i in range(0, len(wanted), 500):
+            chunk = wanted[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            by_nid.update(conn.execute(
+                f"SELECT netkeiba_id, id FROM horses WHERE netkeiba_id IN ({placeholders})", chunk
+            ).fetchall())
+        # 同名の馬は最近走った順（成績の無い馬は後ろ）
+        by_name = {}
+        names = list(dict.fromkeys(name for name, _ in keys))
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for horse_id, name, nid in conn.execute(
+                f"SELECT h.id, h.name, h.netkeiba_id FROM horses h WHERE h.name IN ({placeholders}) "
+                "ORDER BY (SELECT MAX(date) FROM results WHERE horse_id = h.id) DESC, h.id DESC",
+                chunk,
+            ):
+                by_name.setdefault(name, []).append([horse_id, nid])
+
+        ids = {}
+        with conn:
+            for name, nid in keys:
+                same_name = by_name.setdefault(name, [])
+                if nid is not None:
+                    horse_id = by_nid.get(nid)
+                    unclaimed = [row for row in same_name if row[1] is None]
+                    if horse_id is None and unclaimed:
+                        horse_id = unclaimed[0][0]
+                        if create:
+                            conn.execute("UPDATE horses SET netkeiba_id = ? WHERE id = ?", (nid, horse_id))
+                            unclaimed[0][1], by_nid[nid] = nid, horse_id
+                else:
+                    horse_id = same_name[0][0] if same_name else None
+                if horse_id is None and create:
+                    # 並行して同じ馬が登録されていれば、そちらを使う
+                    conn.execute("INSERT OR IGNORE INTO horses (name, netkeiba_id) VALUES (?, ?)", (name, nid))
+                    horse_id = conn.execute(
+                        "SELECT id FROM horses WHERE netkeiba_id = ?" if nid is not None else
+                        "SELECT MAX(id) FROM horses WHERE name = ? AND netkeiba_id IS NULL",
+                        (nid if nid is not None else name,),
+                    ).fetchone()[0]
+                    same_name.insert(0, [horse_id, nid])
+                    if nid is not None:
+                        by_nid[nid] = horse_id
+                if horse_id is None:
+                    continue
+                if create and _value(urls.get(name)) is not None:
+                    conn.execute("UPDATE horses SET url = ? WHERE id = ?", (urls[name], horse_id))
+                ids[(name, nid)] = horse_id
+        return ids
+
+    def upsert_people(self, table, names, netkeiba_ids=None):
+        """騎手（table="jockeys"）・調教師（"trainers"）を登録し、{名前: id} を返す
+
+        netkeibaのIDが分かる人はIDで照合する（同じ名前でもIDが違えば別人）。
+        IDで決まらなければ utils.ids.Interner で略称とフルネームを同じ人にまとめ、
+        表示名は長い方（フルネーム）にそろえる。
+        """
+        if table not in ("jockeys", "trainers"):
+            raise ValueError(f"table は jockeys か trainers です: {table}")
+        names = [n for n in dict.fromkeys(names) if normalize_name(n, person=True) is not None]
+        if not names:
+            return {}
+        netkeiba_ids = {k: v for k, v in (netkeiba_ids or {}).items() if v is not None and not pd.isna(v)}
+        conn = self.connect()
+
+        # 人数は多くても数百なので、登録済みの全員を読んで照合する
+        interner = Interner(person=True)
+        by_key, stored_names = {}, {}
+        for person_id, name, nid in conn.execute(f"SELECT id, name, netkeiba_id FROM {table}"):
+            by_key.setdefault(interner.intern(name, nid), person_id)
+            stored_names[person_id] = name
+
+        ids = {}
+        with conn:
+            for name in names:
+                nid = _value(netkeiba_ids.get(name))
+                key = interner.intern(name, nid)
+                person_id = by_key.get(key)
+                if person_id is None:
+                    cur = conn.execute(
+                        f"INSERT INTO {table} (name, netkeiba_id) VALUES (?, ?)", (str(name).strip(), nid)
+                    )
+                    person_id = cur.lastrowid
+                    stored_names[person_id] = str(name).strip()
+                else:
+                    fuller = len(normalize_name(name, True)) > len(normalize_name(stored_names[person_id], True))
+                    if fuller and str(name).strip() not in stored_names.values():
+                        stored_names[person_id] = str(name).strip()
+                    conn.execute(
+                        f"UPDATE {table} SET name = ?, netkeiba_id = COALESCE(netkeiba_id, ?) WHERE id = ?",
+                        (stored_names[person_id], nid, person_id),
+                    )
+                by_key.setdefault(key, person_id)
+                ids[name] = person_id
+        return ids
+
+    def upsert_races(self, races):
+        """races: race_key と各列を持つdictのリスト。{race_key: races.id} を返す"""
+        conn = self.connect()
+        cols = ["race_key", "date", "name", "class", "surface", "distance", "going", "field_size", "pace", "venue"]
+        updates = ", ".join(f"{c} = COALESCE(excluded.{c}, races.{c})" for c in cols[1:])
+        with conn:
+            conn.executemany(
+                f"INSERT INTO races ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+                f"ON CONFLICT(race_key) DO UPDATE SET {updates}",
+                [tuple(_value(r.get(c)) for c in cols) for r in races],
+            )
+        keys = [r["race_key"] for r in races]
+        ids = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for race_id, key in conn.execute(
+                f"SELECT id, race_key FROM races WHERE race_key IN ({placeholders})", chunk
+            ):
+                ids[key] = race_id
+        return ids
+
+    def upsert_results(self, df: pd.DataFrame):
+        """近走データ（race_jp23_data.csv 形式、型変換済みでも未変換でも可）を登録する"""
+        if df.empty:
+            return 0
+        if "タイム" in df.columns and not pd.api.types.is_float_dtype(df["タイム"]):
+            df = apply_race_schema(df)
+        df = df.copy()
+        df["_date"] = _iso_date(df["日付"]) if "日付" in df.columns else None
+        # 過去レースは レースID 列（無ければ開催とR）で見分ける
+        # （取得時に付く race_id 列は出走予定のレースのIDなので使わない）
+        df["_race_key"], legacy_keys = _past_race_keys(df, df["_date"])
+
+        def col(name):
+            return df[name] if name in df.columns else pd.Series(index=df.index, dtype=object)
+
+        # クラスの列が無いか空の行は、レース名（重賞なら '(G1)' など）から決める
+        classes = (col("クラス") if "クラス" in df.columns else col("グレード")).astype(object)
+        classes = classes.where(classes.notna() & classes.ne(""), col("レース名").astype(object).map(race_class))
+
+        race_rows = pd.DataFrame({
+            "race_key": df["_race_key"],
+            "date": df["_date"],
+            "name": col("レース名"),
+            "class": classes,
+            "surface": col("芝ダ"),
+            "distance": col("距離"),
+            "going": col("馬場"),
+            "field_size": col("頭数"),
+            "pace": col("ペース"),
+            "venue": col("場"),
+        }).drop_duplicates("race_key")
+        race_ids = self.upsert_races(race_rows.to_dict("records"))
+        # 馬は行ごとの horse_id（netkeibaのID）で見分ける
+        horse_keys = [
+            _horse_key(h, nid) for h, nid in zip(df["馬名"], pd.to_numeric(col("horse_id"), errors="coerce"))
+        ]
+        horse_ids = self._resolve_horses(horse_keys, create=True)
+        jockey_ids = self.upsert_people("jockeys", col("騎手").dropna().unique().tolist())
+
+        passing = col("コーナー通過") if "コーナー通過" in df.columns else col("通過")
+        rows = [
+            (
+                horse_ids[h], race_ids[k], _value(d), _value(w), _value(u), _value(j),
+                jockey_ids.get(j) if _value(j) is not None else None, _value(kg),
+                _value(t), _value(f), _value(p), _value(pa), _value(l3), _value(m),
+            )
+            for h, k, d, w, u, j, kg, t, f, p, pa, l3, m in zip(
+                horse_keys, df["_race_key"], df["_date"], col("枠番"), col("馬番"), col("騎手"),
+                col("斤量"), col("タイム"), col("着順"), col("人気"), passing, col("上り"), col("着差"),
+            )
+        ]
+        conn = self.connect()
+        with conn:
+            conn.executemany(
+                "INSERT INTO results (horse_id, race_id, date, waku, umaban, jockey, jockey_id, weight, time_sec, "
+                "finish, popularity, passing, last3f, margin) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(horse_id, race_id) DO UPDATE SET "
+                "date = excluded.date, waku = excluded.waku, umaban = excluded.umaban, "
+                "jockey = excluded.jockey, jockey_id = excluded.jockey_id, "
+                "weight = excluded.weight, time_sec = excluded.time_sec, "
+                "finish = excluded.finish, popularity = excluded.popularity, passing = excluded.passing, "
+                "last3f = excluded.last3f, margin = excluded.margin",
+                rows,
+            )
+            # 以前は '日付:レース名' で登録していた。同じ成績が新しいキーで入ったら古い方を消す
+            conn.executemany(
+                "DELETE FROM results WHERE horse_id = ? AND race_id = "
+                "(SELECT id FROM races WHERE race_key = ? AND race_key != ?)",
+                [
+                    (horse_ids[h], old, new)
+                    for h, new, old in zip(horse_keys, df["_race_key"], legacy_keys) if new != old
+                ],
+            )
+        return len(rows)
+
+    def upsert_entries(self, race_key, df: pd.DataFrame, race_info=None):
+        """出馬表（syutubahyo_data.csv 形式）を race_key のレースに登録する"""
+        if df.empty:
+            return 0
+        df = apply_entry_schema(df)
+        race_info = dict(race_info or {})
+        if "date" not in race_info and "日付" in df.columns:
+            # 出馬表ページから取った開催日（差分更新で、どの日に走ったかを見るのに使う）
+            dates = _iso_date(df["日付"]).dropna()
+            if len(dates):
+                race_info["date"] = dates.iloc[0]
+        race_id = self.upsert_races([{"race_key": str(race_key), **race_info}])[str(race_key)]
+        urls = dict(zip(df["馬名"], df["horse_url"])) if "horse_url" in df.columns else None
+        horse_ids = self.upsert_horses(df["馬名"].tolist(), urls=urls, netkeiba_ids=horse_netkeiba_ids(df))
+
+        def col(name):
+            return df[name] if name in df.columns else pd.Series(index=df.index, dtype=object)
+
+        jockey_ids = self.upsert_people(
+            "jockeys", col("騎手").dropna().unique().tolist(), _netkeiba_ids(df, "jockey_id", "騎手"))
+        trainer_ids = self.upsert_people(
+            "trainers", col("調教師").dropna().unique().tolist(), _netkeiba_ids(df, "trainer_id", "調教師"))
+
+        age = col("性齢") if "性齢" in df.columns else col("馬齢")
+        rows = [
+            (
+                race_id, horse_ids[str(h)], *(_value(v) for v in vals),
+                jockey_ids.get(j) if _value(j) is not None else None,
+                trainer_ids.get(t) if _value(t) is not None else None,
+            )
+            for h, j, t, *vals in zip(
+                df["馬名"], col("騎手"), col("調教師"), col("枠番"), col("馬番"), age, col("斤量"), col("騎手"),
+                col("調教師"), col("馬体重"), col("単勝オッズ"), col("人気"),
+            )
+        ]
+        conn = self.connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries (race_id, horse_id, waku, umaban, sex_age, weight, jockey, "
+                "trainer, body_weight, odds, popularity, jockey_id, trainer_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def upsert_marks(self, marks, user="", race_key=None, netkeiba_ids=None):
+        """marks: {馬名: 印}。渡した馬の行だけを書き換える（印が空なら消す）
+
+        印は馬（horses.id）に付く。netkeiba_ids（{馬名: netkeibaのID}）があれば、その馬はIDで引く。
+        """
+        race_id = 0
+        if race_key is not None:
+            race_id = self.upsert_races([{"race_key": str(race_key)}])[str(race_key)]
+        # CSVから読んだ空の印は NaN になっている
+        marks = {name: mark if isinstance(mark, str) else "" for name, mark in marks.items()}
+        horse_ids = self.upsert_horses(list(marks), netkeiba_ids=netkeiba_ids)
+        conn = self.connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO marks (user, race_id, horse_id, mark) VALUES (?, ?, ?, ?)",
+                [(user, race_id, horse_ids[str(name)], mark) for name, mark in marks.items() if mark],
+            )
+            conn.executemany(
+                "DELETE FROM marks WHERE user = ? AND race_id = ? AND horse_id = ?",
+                [(user, race_id, horse_ids[str(name)]) for name, mark in marks.items() if not mark],
+            )
+
+    def get_meta(self, key):
+        """meta テーブルの値（無ければNone）"""
+        row = self.connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        conn = self.connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    # ==============================
+    # 差分更新
+    # ==============================
+    def sync_state(self, horse_names, netkeiba_ids=None):
+        """{馬名: (最新の出走日, 最後に確認した時刻)}。一度も取っていない馬は含まない
+
+        netkeiba_ids（{馬名: netkeibaのID}）を渡すと、その馬はIDで引く（同じ馬名の別の馬と混ぜない）。
+        """
+        horse_ids = self.horse_ids(horse_names, netkeiba_ids)
+        if not horse_ids:
+            return {}
+        names = {horse_id: name for name, horse_id in horse_ids.items()}
+        placeholders = ",".join("?" * len(names))
+        sql = f"""
+            SELECT h.id,
+                   COALESCE(s.latest_date, (SELECT MAX(date) FROM results WHERE horse_id = h.id)),
+                   s.checked_at
+            FROM horses h
+            LEFT JOIN horse_sync s ON s.horse_id = h.id
+            WHERE h.id IN ({placeholders})
+              AND (s.horse_id IS NOT NULL OR EXISTS (SELECT 1 FROM results WHERE horse_id = h.id))
+        """
+        return {
+            names[horse_id]: (latest, checked)
+            for horse_id, latest, checked in self.connect().execute(sql, list(names))
+        }
+
+    def mark_checked(self, horse_name, checked_at, netkeiba_id=None):
+        """馬のページを確認したことを記録する（最新の出走日は results から取り直す）"""
+        horse_id = self.upsert_horses([horse_name], netkeiba_ids={horse_name: netkeiba_id})[str(horse_name)]
+        conn = self.connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO horse_sync (horse_id, latest_date, checked_at) "
+                "VALUES (?, (SELECT MAX(date) FROM results WHERE horse_id = ?), ?) "
+                "ON CONFLICT(horse_id) DO UPDATE SET "
+                "latest_date = excluded.latest_date, checked_at = excluded.checked_at",
+                (horse_id, horse_id, checked_at),
+            )
+        return horse_id
+
+    def merge_new_results(self, horse_name, rows, checked_at, netkeiba_id=None):
+        """取得した近走のうち、把握している最新の出走日より新しい行だけを登録する
+
+        netkeiba_id を省くと行の horse_id を使う。登録した件数を返す。
+        """
+        netkeiba_id = _rows_netkeiba_id(rows, netkeiba_id)
+        latest = self.sync_state([horse_name], {horse_name: netkeiba_id}).get(str(horse_name), (None, None))[0]
+        new_rows = []
+        for row in rows:
+            date = pd.to_datetime(row.get("日付"), errors="coerce")
+            if pd.isna(date):
+                continue
+            if latest is None or date.strftime("%Y-%m-%d") > latest:
+                new_rows.append(row)
+        if new_rows:
+            self.upsert_results(pd.DataFrame(new_rows))
+        self.mark_checked(horse_name, checked_at, netkeiba_id)
+        return len(new_rows)
+
+    def backfilled(self, horse_names, netkeiba_ids=None):
+        """全成績を取り込み済みの馬の馬名の集合（netkeiba_ids の意味は sync_state と同じ）"""
+        horse_ids = self.horse_ids(horse_names, netkeiba_ids)
+        if not horse_ids:
+            return set()
+        names = {horse_id: name for name, horse_id in horse_ids.items()}
+        placeholders = ",".join("?" * len(names))
+        sql = f"""
+            SELECT horse_id FROM horse_sync
+            WHERE horse_id IN ({placeholders}) AND backfilled_at IS NOT NULL
+        """
+        return {names[horse_id] for (horse_id,) in self.connect().execute(sql, list(names))}
+
+    def backfill_results(self, horse_name, rows, checked_at, netkeiba_id=None):
+        """馬の全成績（dictのリスト）を登録し、取り込み済みとして記録する。登録した件数を返す
+
+        merge_new_results と違い、把握している最新の出走日より古い行も登録する。
+        """
+        netkeiba_id = _rows_netkeiba_id(rows, netkeiba_id)
+        rows = [r for r in rows if r.get("レース名") or r.get("日付")]
+        if rows:
+            self.upsert_results(pd.DataFrame(rows))
+        horse_id = self.mark_checked(horse_name, checked_at, netkeiba_id)
+        conn = self.connect()
+        with conn:
+            conn.execute("UPDATE horse_sync SET backfilled_at = ? WHERE horse_id = ?", (checked_at, horse_id))
+        return len(rows)
+
+    def entry_dates(self, horse_names, netkeiba_ids=None):
+        """{馬名: 出馬表に載ったレースの日付（YYYY-MM-DD）のリスト}（netkeiba_ids は sync_state と同じ）"""
+        horse_ids = self.horse_ids(horse_names, netkeiba_ids)
+        if not horse_ids:
+            return {}
+        names = {horse_id: name for name, horse_id in horse_ids.items()}
+        placeholders = ",".join("?" * len(names))
+        sql = f"""
+            SELECT e.horse_id, r.date FROM entries e
+            JOIN races r ON r.id = e.race_id
+            WHERE e.horse_id IN ({placeholders}) AND r.date IS NOT NULL
+        """
+        dates = {}
+        for horse_id, date in self.connect().execute(sql, list(names)):
+            dates.setdefault(names[horse_id], []).append(date)
+        return dates
+
+    def entry_days(self, date_from, date_to):
+        """出馬表を取り込んだレースがある日付（YYYY-MM-DD）の集合（両端を含む）"""
+        sql = """
+            SELECT DISTINCT r.date FROM races r
+            WHERE r.date BETWEEN ? AND ? AND EXISTS (SELECT 1 FROM entries e WHERE e.race_id = r.id)
+        """
+        return {date for (date,) in self.connect().execute(sql, (date_from, date_to))}
+
+    # ==============================
+    # 読み込み
+    # ==============================
+    def recent_results(self, horse_names, n=5, netkeiba_ids=None):
+        """指定した馬の近n走を1回のクエリで取り出す（日付の新しい順。netkeiba_ids は sync_state と同じ）"""
+        horse_ids = list(self.horse_ids(horse_names, netkeiba_ids).values())
+        if not horse_ids:
+            return pd.DataFrame(columns=list(RESULT_COLUMNS.values()))
+        placeholders = ",".join("?" * len(horse_ids))
+        sql = f"""
+            SELECT horse_name, netkeiba_id, replace(date, '-', '/') AS date, race_name, class, field_size,
+                   waku, umaban, jockey, weight, surface, distance, going, time_sec, finish, popularity, passing,
+                   last3f, pace, margin
+            FROM (
+                SELECT h.name AS horse_name, h.netkeiba_id, r.date, r.name AS race_name, r.class,
+                       r.field_size, r.surface, r.distance, r.going, r.pace, res.waku, res.umaban,
+                       COALESCE(j.name, res.jockey) AS jockey,
+                       res.weight, res.time_sec, res.finish, res.popularity, res.passing,
+                       res.last3f, res.margin,
+                       ROW_NUMBER() OVER (PARTITION BY res.horse_id ORDER BY res.date DESC) AS rn
+                FROM horses h
+                JOIN results res ON res.horse_id = h.id
+                JOIN races r ON r.id = res.race_id
+                LEFT JOIN jockeys j ON j.id = res.jockey_id
+                WHERE h.id IN ({placeholders})
+            )
+            WHERE rn <= ?
+            ORDER BY horse_name, date DESC
+        """
+        df = pd.read_sql_query(sql, self.connect(), params=[*horse_ids, n])
+        return df.rename(columns=RESULT_COLUMNS)
+
+    def results_page(self, horse_name, limit=5, offset=0, netkeiba_id=None):
+        """1頭の成績を新しい順に offset 件目から limit 件だけ取り出す（古い成績のページ送り用）"""
+        horse_id = self.horse_ids([horse_name], {horse_name: netkeiba_id}).get(str(horse_name))
+        sql = """
+            SELECT h.name AS horse_name, h.netkeiba_id, replace(r.date, '-', '/') AS date,
+                   r.name AS race_name, r.class, r.field_size, res.waku, res.umaban,
+                   COALESCE(j.name, res.jockey) AS jockey, res.weight, r.surface, r.distance, r.going,
+                   res.time_sec, res.finish, res.popularity, res.passing, res.last3f, r.pace, res.margin
+            FROM horses h
+            JOIN results res ON res.horse_id = h.id
+            JOIN races r ON r.id = res.race_id
+            LEFT JOIN jockeys j ON j.id = res.jockey_id
+            WHERE h.id = ?
+            ORDER BY res.date DESC
+            LIMIT ? OFFSET ?
+        """
+        df = pd.read_sql_query(sql, self.connect(), params=[horse_id, limit, offset])
+        return df.rename(columns=RESULT_COLUMNS)
+
+    def result_counts(self, horse_names, netkeiba_ids=None):
+        """{馬名: 登録されている成績の件数}（netkeiba_ids は sync_state と同じ）"""
+        horse_ids = self.horse_ids(horse_names, netkeiba_ids)
+        if not horse_ids:
+            return {}
+        names = {horse_id: name for name, horse_id in horse_ids.items()}
+        placeholders = ",".join("?" * len(names))
+        sql = f"""
+            SELECT horse_id, COUNT(*) FROM results
+            WHERE horse_id IN ({placeholders})
+            GROUP BY horse_id
+        """
+        return {names[horse_id]: count for horse_id, count in self.connect().execute(sql, list(names))}
+
+    def query_results(
+        self, horse_names=None, date_from=None, date_to=None, surface=None, min_distance=None,
+        max_distance=None, classes=None, going=None, venues=None, last_n=None,
+    ):
+        """条件に合う成績を取り出す（馬名順、同じ馬は新しい順）
+
+        条件はすべてSQLの WHERE に入れるので、合わない行はDBから読まない。
+        指定しなかった条件では絞り込まない。
+
+        date_from / date_to … 'YYYY-MM-DD' または 'YYYY/MM/DD'（両端を含む）
+        surface … '芝' / 'ダ' / '障'
+        min_distance / max_distance … メートル（両端を含む）
+        classes / going / venues … クラス（G1 など）・馬場（良 など）・競馬場（東京 など）のリスト
+        last_n … 条件に合う成績のうち、馬ごとに新しい方から何走までか
+        """
+        where, params = [], []
+
+        def add_in(column, values):
+            values = [str(v) for v in ([values] if isinstance(values, str) else values)]
+            where.append(f"{column} IN ({','.join('?' * len(values))})")
+            params.extend(values)
+
+        if horse_names is not None:
+            add_in("h.name", horse_names)
+        for column, op, value in (
+            ("r.date", ">=", date_from), ("r.date", "<=", date_to),
+            ("r.distance", ">=", min_distance), ("r.distance", "<=", max_distance),
+        ):
+            if value is not None:
+                where.append(f"{column} {op} ?")
+                params.append(str(value).replace("/", "-") if column == "r.date" else int(value))
+        for column, values in (("r.surface", surface), ("r.class", classes), ("r.going", going),
+                               ("r.venue", venues)):
+            if values is not None:
+                add_in(column, values)
+
+        sql = f"""
+            SELECT horse_name, netkeiba_id, replace(date, '-', '/') AS date, venue, race_name, class,
+                   field_size, waku, umaban, jockey, weight, surface, distance, going, time_sec, finish,
+                   popularity, passing, last3f, pace, margin
+            FROM (
+                SELECT h.name AS horse_name, h.netkeiba_id, res.date, r.venue, r.name AS race_name, r.class,
+                       r.field_size, r.surface, r.distance, r.going, r.pace, res.waku, res.umaban,
+                       COALESCE(j.name, res.jockey) AS jockey,
+                       res.weight, res.time_sec, res.finish, res.popularity, res.passing,
+                       res.last3f, res.margin,
+                       ROW_NUMBER() OVER (PARTITION BY res.horse_id ORDER BY res.date DESC) AS rn
+                FROM results res
+                JOIN horses h ON h.id = res.horse_id
+                JOIN races r ON r.id = res.race_id
+                LEFT JOIN jockeys j ON j.id = res.jockey_id
+                {"WHERE " + " AND ".join(where) if where else ""}
+            )
+            {"WHERE rn <= ?" if last_n is not None else ""}
+            ORDER BY horse_name, date DESC
+        """
+        if last_n is not None:
+            params.append(int(last_n))
+        df = pd.read_sql_query(sql, self.connect(), params=params)
+        return df.rename(columns=RESULT_COLUMNS)
+
+    def entries(self, race_key):
+        sql = """
+            SELECT e.umaban, e.waku, h.name AS horse_name, e.sex_age, e.weight, e.jockey, e.trainer,
+                   e.body_weight, e.odds, e.popularity
+            FROM entries e
+            JOIN races r ON r.id = e.race_id
+            JOIN horses h ON h.id = e.horse_id
+            WHERE r.race_key = ?
+            ORDER BY e.umaban
+        """
+        return pd.read_sql_query(sql, self.connect(), params=[str(race_key)]).rename(columns=ENTRY_COLUMNS)
+
+    def marks(self, user="", race_key=None):
+        """{馬名: 印}"""
+        conn = self.connect()
+        race_id = 0
+        if race_key is not None:
+            row = conn.execute("SELECT id FROM races WHERE race_key = ?", (str(race_key),)).fetchone()
+            if row is None:
+                return {}
+            race_id = row[0]
+        sql = """
+            SELECT h.name, m.mark FROM marks m
+            JOIN horses h ON h.id = m.horse_id
+            WHERE m.user = ? AND m.race_id = ?
+        """
+        return dict(conn.execute(sql, (user, race_id)).fetchall())
+
+
+def save_fetched_race(store, race_key, entries_df, rows):
+    """フェッチャーが取った出馬表と近走（dictのリスト）をストアへ書き込む"""
+    store.upsert_entries(race_key, entries_df)
+    rows = [r for r in rows if r.get("レース名") or r.get("日付")]
+    if rows:
+        store.upsert_results(pd.DataFrame(rows))
+
+
+def import_csvs(store, data_dir=Path("data"), race_key="jp23"):
+    """data/ のCSV（近走・出馬表・印）をストアへ取り込む"""
+    from utils.data_loader import ingest_race_csv
+
+    data_dir = Path(data_dir)
+    results = store.upsert_results(ingest_race_csv(data_dir / "race_jp23_data.csv"))
+    entries = store.upsert_entries(race_key, pd.read_csv(data_dir / "syutubahyo_data.csv"))
+    marks_path = data_dir / "marks.csv"
+    if marks_path.exists():
+        marks = pd.read_csv(marks_path)
+        store.upsert_marks(dict(zip(marks["馬名"], marks["印"])))
+    return results, entries
+
+
+def _query_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m utils.race_store query", description="条件に合う成績を出す")
+    parser.add_argument("horses", nargs="*", help="馬名（省略すると全馬）")
+    parser.add_argument("--from", dest="date_from", help="この日以降（YYYY-MM-DD）")
+    parser.add_argument("--to", dest="date_to", help="この日まで（YYYY-MM-DD）")
+    parser.add_argument("--surface", choices=["芝", "ダ", "障"])
+    parser.add_argument("--min-distance", type=int)
+    parser.add_argument("--max-distance", type=int)
+    parser.add_argument("--class", dest="classes", action="append", help="クラス（複数指定可）")
+    parser.add_argument("--going", action="append", help="馬場（複数指定可）")
+    parser.add_argument("--venue", dest="venues", action="append", help="競馬場（複数指定可）")
+    parser.add_argument("--last", dest="last_n", type=int, help="馬ごとに新しい方から何走まで")
+    args = vars(parser.parse_args(argv))
+    args["horse_names"] = args.pop("horses") or None
+    df = RaceStore().query_results(**args)
+    print(df.to_string(index=False) if len(df) else "該当する成績はありません")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["import"]:
+        n_results, n_entries = import_csvs(RaceStore())
+        print(f"✅ 近走{n_results}件・出馬表{n_entries}頭を {DB_PATH} に取り込みました")
+    elif sys.argv[1:2] == ["query"]:
+        _query_main(sys.argv[2:])
+    else:
+        print(__doc__)
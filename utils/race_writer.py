@@ -0,0 +1,156 @@
+import csv
+import json
+import os
+import threading
+from pathlib import Path
+
+from utils.timing import timed
+
+CHECKPOINT_DIR = Path("data/checkpoints")
+
+# rows.jsonl の中で1頭分の書き込みが終わったことを示す行のキー
+_COMMIT_KEY = "_commit"
+
+
+def _repair_tail(path):
+    """書き込み途中で落ちて改行で終わっていなければ改行を足す（次の追記と混ざらないように）"""
+    if not path.exists() or path.stat().st_size == 0:
+        return
+    with open(path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def _truncate_uncommitted(path):
+    """最後の確定行より後ろ（落ちた馬の書きかけの行）を切り捨てる
+
+    残しておくと、次に書いた馬の確定行でその馬の行として出てしまう。
+    """
+    if not path.exists():
+        return
+    end = 0
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            offset += len(line)
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and _COMMIT_KEY in record:
+                end = offset
+    if end < path.stat().st_size:
+        with open(path, "rb+") as f:
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class CheckpointWriter:
+    """取得した近走を1頭ずつ追記し、取得済みの (race_id, 馬名) を記録する
+
+    directory/
+      rows.jsonl  … 近走1件につき1行（追記のみ）。1頭分の最後に確定行を書く
+      done.jsonl  … 書き終えた (race_id, 馬名)。rows を書いた後に追記する
+
+    途中で落ちても、確定行まで書けた馬の行だけを正しいデータとして扱うので、
+    再実行時は done に無い馬だけを取り直せばよい（開くときに確定していない行は切り捨てる）。
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.rows_path = self.directory / "rows.jsonl"
+        self.done_path = self.directory / "done.jsonl"
+        self._lock = threading.Lock()
+        _truncate_uncommitted(self.rows_path)
+        _repair_tail(self.done_path)
+        self._done = self._load_done()
+
+    def _load_done(self):
+        done = set()
+        if not self.done_path.exists():
+            return done
+        with open(self.done_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で落ちた最後の行
+                    continue
+                done.add((entry["race_id"], entry["horse"]))
+        return done
+
+    def is_done(self, race_id, horse):
+        return (race_id, horse) in self._done
+
+    def done_count(self):
+        return len(self._done)
+
+    @timed("write.checkpoint")
+    def write_horse(self, race_id, horse, rows):
+        """1頭分の行を追記してから、取得済みとして記録する"""
+        with self._lock:
+            with open(self.rows_path, "a", encoding="utf-8") as f:
+                for row in rows:
+                    record = {"race_id": race_id, **row}
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                commit = {_COMMIT_KEY: {"race_id": race_id, "horse": horse}}
+                f.write(json.dumps(commit, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.done_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"race_id": race_id, "horse": horse}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._done.add((race_id, horse))
+
+    def iter_rows(self):
+        """確定済みの馬の行だけを1行ずつ返す（同じ馬を取り直した場合は最初の1回分）"""
+        if not self.rows_path.exists():
+            return
+        emitted = set()
+        pending = []
+        with open(self.rows_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で落ちた行
+                    pending = []
+                    continue
+                if _COMMIT_KEY not in record:
+                    pending.append(record)
+                    continue
+                key = (record[_COMMIT_KEY]["race_id"], record[_COMMIT_KEY]["horse"])
+                if key not in emitted:
+                    emitted.add(key)
+                    yield from pending
+                pending = []
+
+    @timed("write.csv")
+    def export_csv(self, path, order=None):
+        """取得済みの行をCSVに書き出す。order（馬名のリスト）を渡すとその順に並べる"""
+        fieldnames = {}
+        by_horse = {}
+        for row in self.iter_rows():
+            for key in row:
+                fieldnames.setdefault(key, None)
+            by_horse.setdefault(row.get("馬名"), []).append(row)
+
+        names = list(order or []) + [h for h in by_horse if h not in set(order or [])]
+        tmp = Path(path).with_name(f".{Path(path).name}.tmp")
+        with open(tmp, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.DictWriter(f, fieldnames=list(fieldnames))
+            writer.writeheader()
+            for name in names:
+                writer.writerows(by_horse.get(name, []))
+        os.replace(tmp, path)
+        return sum(len(rows) for rows in by_horse.values())
+
+
+def checkpoint_for_race(race_id, root=CHECKPOINT_DIR):
+    return CheckpointWriter(Path(root) / str(race_id))
@@ -0,0 +1,94 @@
+"""app3.py の再実行ごとの描画時間とHTMLの大きさ（サイドバーで有効にしたときだけ測る）
+
+    profiler = get_render_profiler(st.session_state, enabled)
+    with profiler.section("出馬表カード"):
+        st.markdown(profiler.payload("出馬表カード", html), unsafe_allow_html=True)
+
+- 区間ごとに、最後に実行したときの時間と送ったHTMLのバイト数、直近 HISTORY_SIZE 回の
+  p50 / p90 / p99 を持つ。fragment だけの再実行でも、その中の区間は記録される
+- 無効のときは何もしない NULL_PROFILER を返す（区間ごとの手間は関数呼び出し1回だけ）
+- 記録はセッションごと（st.session_state）。無効にすると捨てる
+"""
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+import pandas as pd
+
+# 百分位を出すのに使う、区間ごとの直近の回数
+HISTORY_SIZE = 200
+
+_STATE_KEY = "render_profiler"
+
+
+class RenderProfiler:
+    enabled = True
+
+    def __init__(self, history_size: int = HISTORY_SIZE):
+        self.history_size = history_size
+        self.latest = {}   # 区間 → 最後の時間（秒）
+        self.history = {}  # 区間 → 直近の時間（秒）
+        self.bytes = {}    # 区間 → 最後に送ったHTMLのバイト数
+
+    @contextmanager
+    def section(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+        self.latest[name] = seconds
+        history = self.history.get(name)
+        if history is None:
+            history = self.history[name] = deque(maxlen=self.history_size)
+        history.append(seconds)
+
+    def payload(self, name, text):
+        """text（st.markdown に渡すHTML）のバイト数を記録して、text をそのまま返す"""
+        self.bytes[name] = len(text.encode("utf-8"))
+        return text
+
+    def report(self) -> pd.DataFrame:
+        """列: 区間, 今回(ms), p50(ms), p90(ms), p99(ms), 回数, バイト数（記録した順）"""
+        rows = []
+        for name, history in self.history.items():
+            p50, p90, p99 = np.percentile(np.fromiter(history, float), [50, 90, 99]) * 1000
+            rows.append((name, self.latest[name] * 1000, p50, p90, p99, len(history), self.bytes.get(name)))
+        return pd.DataFrame(rows, columns=["区間", "今回(ms)", "p50(ms)", "p90(ms)", "p99(ms)", "回数", "バイト数"])
+
+
+class _NullProfiler:
+    """無効のときの代わり（何も測らない）"""
+
+    enabled = False
+    _null = nullcontext()
+
+    def section(self, name):
+        return self._null
+
+    def record(self, name, seconds):
+        pass
+
+    def payload(self, name, text):
+        return text
+
+
+NULL_PROFILER = _NullProfiler()
+
+
+def get_render_profiler(state, enabled: bool):
+    """セッションの RenderProfiler（enabled でなければ NULL_PROFILER。記録も捨てる）
+
+    state … st.session_state
+    """
+    if not enabled:
+        if _STATE_KEY in state:
+            del state[_STATE_KEY]
+        return NULL_PROFILER
+    profiler = state.get(_STATE_KEY)
+    if profiler is None:
+        profiler = state[_STATE_KEY] = RenderProfiler()
+    return profiler
@@ -0,0 +1,154 @@
+"""保存済みのページから出馬表・近走を作り直す（ネットワークには出ない）
+
+netkeibaのレイアウトが変わってパーサ（utils.extractors）を直したときに、取り直さずに
+data/http_cache/ に残っているページだけからデータを作り直す。パースはプロセスを分けて並列に行う。
+
+    python -m utils.reparse                        # 各ページの最新版から data/reparsed/ に書き出す
+    python -m utils.reparse --kind horse --store   # 馬の成績だけ作り直し、ストアにも入れる
+    python -m utils.reparse --all-versions         # 保存してある全ての版をパースする
+"""
+import argparse
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+from utils.extractors import extract_past_races, extract_shutuba, horse_name_from_page
+from utils.http_cache import CACHE_DIR, ResponseCache
+from utils.ids import netkeiba_id
+
+OUTPUT_DIR = Path("data/reparsed")
+
+# ページの種類 → URLの正規表現
+PAGE_KINDS = {
+    "horse": r"db\.netkeiba\.com/horse/",
+    "shutuba": r"race\.netkeiba\.com/race/shutuba",
+}
+
+
+def _kind(url):
+    for kind, pattern in PAGE_KINDS.items():
+        if re.search(pattern, url):
+            return kind
+    return None
+
+
+def _parse_page(job):
+    """1ページをパースする（ワーカープロセスで実行）。(url, kind, rows, 抽出方法) を返す"""
+    root, url, fetched_at, digest, horse_name = job
+    kind = _kind(url)
+    html = ResponseCache(root, offline=True).load_object(digest)
+    if html is None:
+        return url, kind, [], "missing"
+
+    if kind == "horse":
+        horse_id = netkeiba_id(url, "horse")
+        horse_name = horse_name or horse_name_from_page(html) or str(horse_id)
+        rows, strategy = extract_past_races(html, horse_name, limit=None)
+        extra = {"horse_id": horse_id}
+    else:
+        rows, strategy = extract_shutuba(html)
+        extra = {"race_id": parse_qs(urlsplit(url).query).get("race_id", [""])[0]}
+    for row in rows:
+        row.update(extra, fetched_at=fetched_at)
+    return url, kind, rows, strategy
+
+
+def reparse(cache=None, kinds=tuple(PAGE_KINDS), all_versions=False, workers=None, horse_names=None):
+    """キャッシュのページをまとめてパースし直す。({kind: 行のリスト}, 集計) を返す
+
+    horse_names … {netkeibaの馬ID: 馬名}。ストアの表記に揃えたいときに渡す
+    （無ければ馬ページの <title> から取る）。
+    """
+    cache = cache or ResponseCache(offline=True)
+    horse_names = horse_names or {}
+    pattern = "|".join(PAGE_KINDS[k] for k in kinds)
+    jobs = [
+        (str(cache.root), url, fetched_at, digest, horse_names.get(netkeiba_id(url, "horse")))
+        for url, fetched_at, digest in cache.iter_pages(pattern, all_versions=all_versions)
+    ]
+
+    results = {kind: [] for kind in kinds}
+    stats = Counter()
+    if not jobs:
+        return results, stats
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for url, kind, rows, strategy in pool.map(_parse_page, jobs, chunksize=chunksize):
+            stats["pages"] += 1
+            if rows:
+                stats[f"{kind}:{strategy}"] += 1
+                results[kind].extend(rows)
+            else:
+                stats["failed"] += 1
+    return results, stats
+
+
+def write_outputs(results, out_dir=OUTPUT_DIR):
+    """馬の成績は race_data.csv、出馬表は syutubahyo.csv に書き出す。書いたファイルのリストを返す"""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    written = []
+    for kind, name in (("horse", "race_data.csv"), ("shutuba", "syutubahyo.csv")):
+        rows = results.get(kind)
+        if not rows:
+            continue
+        path = out_dir / name
+        tmp = path.with_name(f".{name}.tmp")
+        pd.DataFrame(rows).to_csv(tmp, index=False, encoding="utf-8-sig")
+        os.replace(tmp, path)
+        written.append(path)
+    return written
+
+
+def save_to_store(store, results):
+    """作り直した成績と出馬表をストアへ入れる"""
+    if results.get("horse"):
+        store.upsert_results(pd.DataFrame(results["horse"]).drop(columns="fetched_at"))
+    if results.get("shutuba"):
+        for race_id, entries in pd.DataFrame(results["shutuba"]).groupby("race_id"):
+            store.upsert_entries(race_id, entries.drop(columns=["race_id", "fetched_at"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m utils.reparse", description="保存済みのページからデータを作り直す")
+    parser.add_argument("--kind", action="append", choices=list(PAGE_KINDS), help="ページの種類（既定は全部）")
+    parser.add_argument("--all-versions", action="store_true", help="最新版だけでなく、保存してある全ての版をパースする")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="並列プロセス数")
+    parser.add_argument("--cache", default=str(CACHE_DIR), help="ページのキャッシュのディレクトリ")
+    parser.add_argument("--out", default=str(OUTPUT_DIR), help="書き出し先ディレクトリ")
+    parser.add_argument("--store", action="store_true", help="ストア（data/keiba.db）にも入れる")
+    args = parser.parse_args(argv)
+
+    store = horse_names = None
+    if args.store:
+        from utils.race_store import RaceStore
+
+        store = RaceStore()
+        # 馬名はストアの表記に揃える
+        horse_names = dict(store.connect().execute(
+            "SELECT netkeiba_id, name FROM horses WHERE netkeiba_id IS NOT NULL").fetchall())
+
+    started = time.perf_counter()
+    results, stats = reparse(
+        ResponseCache(args.cache, offline=True), kinds=tuple(args.kind or PAGE_KINDS),
+        all_versions=args.all_versions, workers=args.workers, horse_names=horse_names,
+    )
+    elapsed = time.perf_counter() - started
+    for path in write_outputs(results, args.out):
+        print(f"💾 {path}")
+    if store is not None:
+        save_to_store(store, results)
+        print(f"💾 {store.path}")
+    detail = "・".join(f"{key} {n}" for key, n in sorted(stats.items()) if ":" in key)
+    print(f"✅ {stats['pages']}ページをパース（失敗 {stats['failed']}）{detail}（{elapsed:.1f}秒）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import re
+import pandas as pd
+
+# ==============================
+# 列の型定義
+# ==============================
+# 同じ値が何度も出てくる文字列列 → category
+RACE_CATEGORY_COLUMNS = ["馬名", "レース名", "クラス", "騎手", "馬場", "ペース", "芝ダ", "場"]
+ENTRY_CATEGORY_COLUMNS = ["性齢", "騎手", "調教師"]
+
+# 着順・人気など小さい整数 → 欠損ありのInt8（"??"や"中"などは欠損になる）
+RACE_INT8_COLUMNS = ["頭数", "枠番", "馬番", "着順", "人気"]
+ENTRY_INT8_COLUMNS = ["馬番", "枠番", "人気"]
+
+RACE_FLOAT_COLUMNS = ["斤量", "上り"]
+ENTRY_FLOAT_COLUMNS = ["斤量", "単勝オッズ"]
+
+_TIME_RE = re.compile(r"^(?:(\d+):)?(\d+(?:\.\d+)?)$")
+_DISTANCE_RE = re.compile(r"^\s*(芝|ダ|障)?\s*(\d+)")
+
+# 競馬場の名前（中央10場と地方）。開催（'5東京8'）やコース（'東京芝2400'）から拾う
+VENUES = [
+    "札幌", "函館", "福島", "新潟", "東京", "中山", "中京", "京都", "阪神", "小倉",
+    "門別", "盛岡", "水沢", "浦和", "船橋", "大井", "川崎", "金沢", "笠松", "名古屋",
+    "園田", "姫路", "高知", "佐賀", "帯広",
+]
+_VENUE_RE = re.compile("(" + "|".join(VENUES) + ")")
+_COURSE_PREFIX_RE = re.compile(r"^\s*\d*(?:" + "|".join(VENUES) + r")\d*")
+
+# レース名からクラスを決める（上から順に最初に一致したもの）。
+# 重賞は 'ジャパンC(G1)' のように括弧で付く。条件戦は旧表記（500万下など）も同じクラスにする
+_ROMAN = {"I": "1", "II": "2", "III": "3", "Ⅰ": "1", "Ⅱ": "2", "Ⅲ": "3"}
+_GRADE_RE = re.compile(r"[(（]\s*(G|Jpn|J・G)\s*(III|II|I|Ⅲ|Ⅱ|Ⅰ|[1-3])\s*[)）]")
+CLASS_RULES = [
+    ("L", re.compile(r"[(（]\s*L\s*[)）]")),
+    ("OP", re.compile(r"[(（]\s*OP\s*[)）]|オープン")),
+    ("新馬", re.compile(r"新馬")),
+    ("未勝利", re.compile(r"未勝利")),
+    ("1勝", re.compile(r"1勝クラス|500万")),
+    ("2勝", re.compile(r"2勝クラス|1000万")),
+    ("3勝", re.compile(r"3勝クラス|1600万")),
+]
+
+
+# ==============================
+# 個別の変換
+# ==============================
+def format_time(seconds):
+    """121.1秒 → '2:01.1'（表示用。欠損は空文字）"""
+    if seconds is None or pd.isna(seconds):
+        return ""
+    minutes, sec = divmod(round(float(seconds), 2), 60)
+    text = f"{sec:04.1f}" if round(sec, 1) == round(sec, 2) else f"{sec:05.2f}"
+    return f"{int(minutes)}:{text}" if minutes else text
+
+
+def to_time_seconds(series: pd.Series) -> pd.Series:
+    """タイム列を秒（float32）に変換する"""
+    extracted = series.astype("string").str.strip().str.extract(_TIME_RE)
+    minutes = pd.to_numeric(extracted[0], errors="coerce").fillna(0)
+    seconds = pd.to_numeric(extracted[1], errors="coerce")
+    return (minutes * 60 + seconds).astype("float32")
+
+
+def split_distance(series: pd.Series):
+    """'芝2000' → ('芝', 2000)。芝ダ列とメートル（Int16）の組で返す"""
+    extracted = series.astype("string").str.extract(_DISTANCE_RE)
+    surface = extracted[0]
+    metres = pd.to_numeric(extracted[1], errors="coerce").astype("Int16")
+    return surface, metres
+
+
+def extract_venue(series: pd.Series) -> pd.Series:
+    """'5東京8' や '東京芝2400' → '東京'（見つからなければ欠損）"""
+    return series.astype("string").str.extract(_VENUE_RE)[0]
+
+
+def race_class(name, grade=None):
+    """レース名（と分かればグレード）からクラス（'G1' / 'Jpn2' / 'L' / 'OP' / '3勝' / '未勝利' …）。分からなければNone
+
+    grade … 'G1' や 'Jpn3' など、ページのグレード表記（アイコンなど）から取ったもの。レース名より優先する
+    """
+    texts = [name] if isinstance(name, str) else []
+    if isinstance(grade, str) and grade.strip():
+        # 括弧を付けてレース名と同じ規則で読む
+        texts.insert(0, f"({grade.strip()})")
+    for text in texts:
+        m = _GRADE_RE.search(text)
+        if m:
+            prefix = "G" if m.group(1) == "J・G" else m.group(1)
+            return f"{prefix}{_ROMAN.get(m.group(2), m.group(2))}"
+        for klass, pattern in CLASS_RULES:
+            if pattern.search(text):
+                return klass
+    return None
+
+
+def to_int8(series: pd.Series) -> pd.Series:
+    return pd.to_numeric(series, errors="coerce").round().astype("Int8")
+
+
+def to_float32(series: pd.Series) -> pd.Series:
+    return pd.to_numeric(series, errors="coerce").astype("float32")
+
+
+def _convert(df, category_columns, int8_columns, float_columns):
+    for col in int8_columns:
+        if col in df.columns:
+            df[col] = to_int8(df[col])
+    for col in float_columns:
+        if col in df.columns:
+            df[col] = to_float32(df[col])
+    for col in category_columns:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
+
+
+# ==============================
+# DataFrame単位の変換
+# ==============================
+def apply_race_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """近走データ（race_jp23_data.csv 形式）を省メモリな型に変換する
+
+    - タイム → 秒（float32）
+    - 距離 → 芝ダ（category）＋ 距離（メートル, Int16）
+    - 着順/人気/枠番/馬番/頭数 → Int8
+    - 騎手/レース名/馬場 など → category
+    - 開催（'5東京8'）かコース（'東京芝2400'）があれば、競馬場を 場（category）に
+    """
+    df = df.copy()
+    if "距離" not in df.columns and "コース" in df.columns:
+        df["距離"] = df["コース"].astype("string").str.replace(_COURSE_PREFIX_RE, "", regex=True)
+    if "場" not in df.columns:
+        for col in ("開催", "コース"):
+            if col in df.columns:
+                df["場"] = extract_venue(df[col])
+                break
+    if "タイム" in df.columns:
+        df["タイム"] = to_time_seconds(df["タイム"])
+    if "距離" in df.columns:
+        surface, metres = split_distance(df["距離"])
+        df.insert(df.columns.get_loc("距離"), "芝ダ", surface)
+        df["距離"] = metres
+    return _convert(df, RACE_CATEGORY_COLUMNS, RACE_INT8_COLUMNS, RACE_FLOAT_COLUMNS)
+
+
+def apply_result_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """ストアの成績（RaceStore.query_results の形。タイム・距離は数値済み）を apply_race_schema と同じ型にする"""
+    df = df.copy()
+    if "タイム" in df.columns:
+        df["タイム"] = to_float32(df["タイム"])
+    if "距離" in df.columns:
+        df["距離"] = pd.to_numeric(df["距離"], errors="coerce").astype("Int16")
+    return _convert(df, RACE_CATEGORY_COLUMNS, RACE_INT8_COLUMNS, RACE_FLOAT_COLUMNS)
+
+
+def apply_entry_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """出馬表（syutubahyo_data.csv 形式）を省メモリな型に変換する"""
+    df = df.copy()
+    if "馬体重" in df.columns:
+        # '470(+2)' のような表記も先頭の数値だけ拾う
+        weight = df["馬体重"].astype("string").str.extract(r"(\d+)")[0]
+        df["馬体重"] = pd.to_numeric(weight, errors="coerce").astype("Int16")
+    return _convert(df, ENTRY_CATEGORY_COLUMNS, ENTRY_INT8_COLUMNS, ENTRY_FLOAT_COLUMNS)
+
+
+def memory_usage_bytes(df: pd.DataFrame) -> int:
+    """文字列の中身まで含めたメモリ使用量"""
+    return int(df.memory_usage(deep=True).sum())
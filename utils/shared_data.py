@@ -0,0 +1,187 @@
+"""全セッションで共有するレースデータと、メモリの内訳
+
+Streamlitはブラウザのセッションごとにスクリプトを実行するが、importしたモジュールは
+プロセスに1つなので、ここで読んだデータはサーバー全体で1つだけ持つ。
+
+- 共有 … 出馬表・近走インデックス・カードのHTML・名前の対応表・印のキャッシュ。
+  読み取り専用で、ファイルが変わったときだけ作り直す
+- セッションごと … st.session_state（印・並び順・開いている馬・ページ）だけ
+
+memory_report() で共有分とセッションごとの分のバイト数を出す。
+"""
+import os
+import sys
+import threading
+import time
+from collections.abc import Mapping
+from pathlib import Path
+
+import pandas as pd
+
+from utils import data_loader, newspaper
+from utils.archive import ARCHIVE_AVAILABLE
+from utils.ids import KEY_COLUMNS
+from utils.schema import memory_usage_bytes
+
+# これだけ操作の無いセッションは閉じたものとして内訳から外す
+SESSION_TTL_SECONDS = 30 * 60
+
+
+# ==============================
+# 共有データ
+# ==============================
+class SharedRace:
+    """1レース分の読み取り専用データ（全セッションで同じオブジェクトを使う）
+
+    shutuba … 出馬表（horse_key などの整数キー付き）
+    horse_index … horse_key → 近n走（読み取り専用の辞書）
+    source … 近走の読み込み元（"store" / "archive" / "csv"）
+    """
+
+    __slots__ = ("shutuba", "horse_index", "source")
+
+    def __init__(self, shutuba, horse_index, source):
+        object.__setattr__(self, "shutuba", shutuba)
+        object.__setattr__(self, "horse_index", horse_index)
+        object.__setattr__(self, "source", source)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SharedRace は全セッションで共有しているので書き換えられません")
+
+
+def _signature(path):
+    try:
+        return data_loader._store_signature(path)
+    except OSError:
+        return None
+
+
+def load_shared_race(shutuba_path, race_data_path, store_path, n: int = 5, archive_path=None) -> SharedRace:
+    """出馬表と近n走をプロセスに1つだけ読み込む（どれかのファイルが変わったときだけ作り直す）
+
+    近走はストア → アーカイブ（archive_path。pyarrow があるときだけ）→ CSV の順に、
+    出走馬の成績が入っている最初のものから読む。
+    """
+    shutuba_path, race_data_path, store_path = (
+        os.path.abspath(os.fspath(p)) for p in (shutuba_path, race_data_path, store_path)
+    )
+    use_archive = archive_path is not None and ARCHIVE_AVAILABLE and os.path.exists(archive_path)
+    archive_path = os.path.abspath(os.fspath(archive_path)) if use_archive else None
+
+    def build():
+        from utils.race_store import horse_netkeiba_ids
+
+        shutuba = data_loader.load_shutsuba_data(shutuba_path, typed=True)
+        # 出馬表に馬のIDがあれば、ストアはIDで引く（同じ馬名の昔の馬と混ぜない）
+        ids = horse_netkeiba_ids(shutuba)
+        # ストアに出走馬の成績が入っていればストアから読む（印しか入っていなければCSVから）
+        use_store = os.path.exists(store_path) and any(
+            data_loader.load_store_counts(shutuba["馬名"], db_path=store_path, netkeiba_ids=ids).values()
+        )
+        if use_store:
+            # 出走馬の近n走だけを1回のクエリで取り出す
+            index = data_loader.load_store_index(
+                shutuba["馬名"], n=n, db_path=store_path, key_col="horse_key", netkeiba_ids=ids)
+            return SharedRace(shutuba, index, "store")
+        if use_archive:
+            # 出走馬を含む行グループだけをメモリマップから読む
+            index = data_loader.load_archive_index(shutuba["馬名"], n=n, path=archive_path, key_col="horse_key")
+            if len(index):
+                return SharedRace(shutuba, index, "archive")
+        # 列数の合わない行は data/quarantine/ に隔離される
+        index = data_loader.load_horse_index(race_data_path, n=n, loader=data_loader.load_race_data, key_col="horse_key")
+        return SharedRace(shutuba, index, "csv")
+
+    paths = (shutuba_path, race_data_path, store_path, archive_path)
+    signature = tuple(_signature(p) for p in paths if p is not None)
+    return data_loader._cached((shutuba_path, "shared_race", *paths[1:], n), signature, build)
+
+
+# ==============================
+# メモリの内訳
+# ==============================
+def deep_size(value, seen=None) -> int:
+    """中身まで含めたバイト数（seen に入っているオブジェクトは数えない。共有されている分の二重計上を防ぐ）"""
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, pd.DataFrame):
+        return memory_usage_bytes(value)
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    size = sys.getsizeof(value)
+    if isinstance(value, Mapping):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(v, seen) for v in value)
+    return size
+
+
+# data_loader のキャッシュのうち、キーが (パス, 種類, ...) のもの
+# （それ以外の cached_load のキーは (パス, モジュール, 関数名, args, kwargs)）
+_KEY_KINDS = {"store_index", "store_page", "store_counts", "archive", "archive_index", "shared_race"}
+
+
+def _cache_label(key):
+    kind = key[1] if key[1] in _KEY_KINDS else key[2]
+    return f"{Path(key[0]).name}: {kind}"
+
+
+def shared_footprint():
+    """共有しているデータの {内容: (件数, バイト数)}"""
+    from utils.marks_store import _marks_stores
+
+    seen = set()
+    totals = {}
+
+    def add(label, value):
+        count, size = totals.get(label, (0, 0))
+        totals[label] = (count + 1, size + deep_size(value, seen))
+
+    for key, value in data_loader.cache_items():
+        add(_cache_label(key), value)
+    for label, values in newspaper.memo_items().items():
+        for value in values:
+            add(label, value)
+    for col, (_, interner) in KEY_COLUMNS.items():
+        add(f"名前の対応表: {col}", interner)
+    for marks_store in list(_marks_stores.values()):
+        add("印のキャッシュ", marks_store)
+    return totals
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def track_session(session_id, state: Mapping):
+    """セッションの持ち物（st.session_state の中身）の大きさを記録する。再実行のたびに呼ぶ"""
+    size = deep_size(dict(state))
+    now = time.time()
+    with _sessions_lock:
+        _sessions[session_id] = (now, len(state), size)
+        for sid, (seen_at, _, _) in list(_sessions.items()):
+            if now - seen_at > SESSION_TTL_SECONDS:
+                del _sessions[sid]
+
+
+def session_footprint():
+    """最近動いているセッションの {セッションID: (項目数, バイト数)}"""
+    with _sessions_lock:
+        return {sid: (count, size) for sid, (_, count, size) in _sessions.items()}
+
+
+def memory_report() -> pd.DataFrame:
+    """共有分とセッションごとの分のメモリ（列: 区分, 内容, 件数, バイト数）"""
+    rows = [("共有", label, count, size) for label, (count, size) in shared_footprint().items()]
+    rows += [("セッション", sid, count, size) for sid, (count, size) in session_footprint().items()]
+    return pd.DataFrame(rows, columns=["区分", "内容", "件数", "バイト数"])
+
+
+def format_bytes(size) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
@@ -0,0 +1,225 @@
+"""取得の各段にかかった時間の計測（スパン）と書き出し
+
+遅い実行が Chrome の起動・ページの表示待ち・ネットワーク・パース・書き込みのどれのせいかを
+見分けるため、各処理を span("名前") で囲み、名前ごとのヒストグラムに足していく。
+
+    with span("parse.next_data"):
+        ...
+
+スパンの名前（「段.中身」）
+    browser.startup / browser.page_wait … Chromeの起動 / ページを開いて要素が出るまで
+    http.wait / http.request … 流量制御の順番待ち / 1回のリクエスト（再試行は1回ずつ）
+    parse.<抽出方法> … 近走・出馬表の各抽出方法（失敗した方法も数える）
+    write.csv / write.checkpoint / write.store … CSV / チェックポイント / ストアへの書き込み
+
+集計はプロセスごと。別プロセスの分は drain() で取り出して親で merge() する。
+書き出しは to_json() / to_prometheus()（Prometheus のテキスト形式）、write_metrics() でファイルへ。
+"""
+import cProfile
+import functools
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+
+METRICS_DIR = Path("data/metrics")
+
+# ヒストグラムの区切り（秒）。Prometheus の le と同じく「以下」で数える
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PROMETHEUS_METRIC = "keiba_fetch_span_seconds"
+
+
+class Histogram:
+    """1スパン分の件数・合計・最大と、BUCKETS ごとの件数（最後は BUCKETS を超えた分）"""
+
+    __slots__ = ("count", "sum", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+    def merge(self, state):
+        self.count += state["count"]
+        self.sum += state["sum"]
+        self.max = max(self.max, state["max"])
+        self.buckets = [a + b for a, b in zip(self.buckets, state["buckets"])]
+
+    def quantile(self, q):
+        """q 分位点のおおよその値（その件が入っている区切りの上端。区切りを超えた分は最大値）"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def state(self):
+        return {"count": self.count, "sum": self.sum, "max": self.max, "buckets": list(self.buckets)}
+
+
+_histograms = {}
+_lock = threading.Lock()
+
+
+def record(name, seconds):
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = Histogram()
+        hist.add(seconds)
+
+
+@contextmanager
+def span(name):
+    """囲んだ処理の時間を name のヒストグラムに足す（例外で抜けても数える）"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def timed(name):
+    """関数全体を span(name) で囲むデコレーター"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """{スパン名: ヒストグラムの中身}（merge() に渡せる形）"""
+    with _lock:
+        return {name: hist.state() for name, hist in _histograms.items()}
+
+
+def drain():
+    """snapshot() を返して集計を空にする（ワーカープロセスから親へ渡すとき）"""
+    global _histograms
+    with _lock:
+        histograms, _histograms = _histograms, {}
+    return {name: hist.state() for name, hist in histograms.items()}
+
+
+def merge(states):
+    """別プロセスの snapshot() / drain() を足し込む"""
+    if not states:
+        return
+    with _lock:
+        for name, state in states.items():
+            hist = _histograms.get(name)
+            if hist is None:
+                hist = _histograms[name] = Histogram()
+            hist.merge(state)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+# ==============================
+# 書き出し
+# ==============================
+def summary():
+    """{スパン名: 件数・合計・平均・p50/p90/p99・最大}（秒）"""
+    with _lock:
+        histograms = {name: Histogram() for name in _histograms}
+        for name, hist in histograms.items():
+            hist.merge(_histograms[name].state())
+    return {
+        name: {
+            "count": h.count, "sum": round(h.sum, 6), "mean": round(h.sum / h.count, 6) if h.count else 0.0,
+            "p50": h.quantile(0.5), "p90": h.quantile(0.9), "p99": h.quantile(0.99), "max": round(h.max, 6),
+        }
+        for name, h in sorted(histograms.items())
+    }
+
+
+def to_json(**meta) -> str:
+    """集計をJSONにする（meta は実行の情報。コマンド名や開始時刻など）"""
+    states = snapshot()
+    return json.dumps({
+        **meta,
+        "buckets": list(BUCKETS),
+        "spans": {
+            name: {**stats, "buckets": states[name]["buckets"]} for name, stats in summary().items()
+        },
+    }, ensure_ascii=False, indent=2)
+
+
+def to_prometheus(metric=PROMETHEUS_METRIC) -> str:
+    """集計を Prometheus のテキスト形式（histogram）にする"""
+    lines = [
+        f"# HELP {metric} 競馬データ取得の段ごとの所要時間",
+        f"# TYPE {metric} histogram",
+    ]
+    for name, state in sorted(snapshot().items()):
+        cumulative = 0
+        for bound, n in zip((*BUCKETS, "+Inf"), state["buckets"]):
+            cumulative += n
+            lines.append(f'{metric}_bucket{{span="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{span="{name}"}} {state["sum"]:.6f}')
+        lines.append(f'{metric}_count{{span="{name}"}} {state["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(name, out_dir=METRICS_DIR, **meta):
+    """<out_dir>/<name>.json と <name>.prom に書き出す（前回の分は上書き）。書いたパスを返す"""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for path, text in ((out_dir / f"{name}.json", to_json(run=name, **meta)), (out_dir / f"{name}.prom", to_prometheus())):
+        tmp = path.with_name(f".{path.name}.tmp")
+        tmp.write_text(text, encoding="utf-8")
+        tmp.replace(path)
+        paths.append(path)
+    return paths
+
+
+def format_summary() -> str:
+    """表示用（スパンごとに1行）"""
+    lines = []
+    for name, s in summary().items():
+        lines.append(
+            f"⏱ {name}: {s['count']}回 合計{s['sum']:.1f}秒 平均{s['mean']:.3f}秒 "
+            f"p90 {s['p90']:.3f}秒 最大{s['max']:.3f}秒"
+        )
+    return "\n".join(lines)
+
+
+# ==============================
+# プロファイル
+# ==============================
+@contextmanager
+def profiled(path=None):
+    """path があれば、囲んだ処理を cProfile で測って pstats 形式で書き出す（メインスレッドの分だけ）"""
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(str(path))
+        print(f"📈 プロファイル → {path}（python -m pstats {path} で見られる）")